@@ -0,0 +1,415 @@
+"""
+Micro-benchmarks for the parts of VocaLights that sit on the hot path between hearing a
+command and sending it to the lights. Run a single benchmark by name, e.g.
+
+    python Benchmarks.py matcher
+    python Benchmarks.py plans
+    python Benchmarks.py asr --wav-dir recordings --vosk-model vosk-model-small-en-us-0.15
+    python Benchmarks.py e2e --lifx 50 --hue 20 --latency 10 --loss 0.01
+    python Benchmarks.py music --wav song.wav
+"""
+
+import argparse
+import logging
+import os
+import re
+import time
+import wave
+
+import CommandMatcher as CM
+
+COMMANDS = ["turn on", "turn off", "change color", "dim", "raise", "colorama on", "colorama off",
+            "disco on", "disco off", "flicker on", "flicker off", "flash on", "flash off"]
+COLORS = ["red", "orange", "yellow", "green", "cyan", "blue", "purple", "pink", "white", "gold"]
+LIGHTS_PER_OBJECT = 10  # Lights are spread over brand objects the way configure_lights would group them
+
+
+def _timeit(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - start) / repeat
+
+
+def _best(func, arg, repeat, rounds=5):
+    # The fastest of a few rounds, as the others were slowed down by something else on the machine
+    return min(_timeit(func, arg, repeat) for _ in range(rounds))
+
+
+def _legacy_scan(light_names):
+    # The substring scans used before the matcher: once in run_commands, once in process_command
+    groups = [light_names[i:i + LIGHTS_PER_OBJECT] for i in range(0, len(light_names), LIGHTS_PER_OBJECT)]
+
+    def scan(words):
+        requested = [names for names in groups for name in names if name in words] or groups
+        for names in requested:
+            light_name = next((name for name in names if name in words), None)
+            for cmd in COMMANDS:
+                if cmd in words:
+                    for spec in words.split():
+                        if spec in COLORS:
+                            break
+                    return cmd, light_name
+    return scan
+
+
+def bench_matcher(sizes=(10, 100, 1000), repeat=2000):
+    print("%8s %14s %14s %9s" % ("lights", "legacy (us)", "matcher (us)", "speedup"))
+    for size in sizes:
+        light_names = ["light %d" % (i + 1) for i in range(size)]
+        utterances = ["turn on light %d" % size, "change color of light 1 to blue",
+                      "dim lights to 40 percent", "disco off"]
+
+        start = time.perf_counter()
+        matcher = CM.CommandMatcher(COMMANDS, light_names, COLORS)
+        build = time.perf_counter() - start
+
+        legacy = _legacy_scan(light_names)
+        old = sum(_timeit(legacy, words, repeat) for words in utterances) / len(utterances)
+        new = sum(_timeit(matcher.match, words, repeat) for words in utterances) / len(utterances)
+        print("%8d %14.2f %14.2f %8.1fx   (built in %.2f ms)" % (size, old * 1e6, new * 1e6, old / new,
+                                                                  build * 1e3))
+
+
+def _legacy_process(obj, V):
+    # How process_command worked out a command from the brand's tables before they were compiled into plans
+    def lifx(intent):
+        args = [[name for name in intent.lights if name in obj.lights] or obj.LIGHT_NAMES]
+        value = obj.LX_COMMANDS[intent.command]
+        for method, specs in value.items():
+            args.append(method)
+            if isinstance(specs, dict):
+                if intent.color in specs:
+                    args.append([specs[intent.color]])
+            elif isinstance(specs, list):
+                obj.scheduler.stop(obj, args[0], specs[1])
+            elif "dynaInt" in specs:
+                if intent.percent is not None:
+                    args.append([int(intent.percent * 650), value["rate"]])
+                else:
+                    args.append([int(re.findall(r'\d+', specs)[-1]), value["rate"]])
+            else:
+                args.append([specs])
+            errors = obj.execute_command(args) if len(args) >= 3 else {}
+            return V.GlobalOps(obj).responses(intent.command, args[0], errors, V.LIFX_BRAND)
+
+    def phue(intent):
+        ids = [obj.PHUE_LIGHT_IDS[name] for name in intent.lights if name in obj.PHUE_LIGHT_IDS]
+        args = [ids or list(obj.PHUE_LIGHT_IDS.values()), obj.PHUE_COMMANDS[intent.command]]
+        specs = obj.PHUE_KEYWORDS[intent.command]
+        if isinstance(specs, dict):
+            if intent.color in specs:
+                args.append(specs[intent.color])
+        elif isinstance(specs, list):
+            obj.scheduler.stop(obj, args[0], specs[1])
+        elif "dynaInt" in str(specs):
+            args.append(int(intent.percent * 2.54) if intent.percent is not None
+                        else int(re.findall(r'\d+', specs)[-1]))
+        else:
+            args.append(specs)
+        errors = {}
+        if len(args) >= 3:
+            response = obj.execute_command(args)
+            errors = {lid: result[0]["error"]["description"] for lid, result in zip(args[0], response)
+                      if "error" in result[0]}
+        return V.GlobalOps(obj).responses(intent.command, args[0], errors, V.PHUE_BRAND)
+
+    return lifx if isinstance(obj, V.Lights.LifX) else phue
+
+
+def _group_frames(frames):
+    # The frames of a tick grouped by what they send, as execute_frames did before effects were bound at start
+    groups = []
+    for light, method, value, duration in frames:
+        for group in groups:
+            if group[1] == method and group[2] == value and group[3] == duration:
+                group[0].append(light)
+                break
+        else:
+            groups.append(([light], method, value, duration))
+    return groups
+
+
+def _legacy_frames(obj, V):
+    # How each effect tick went through execute_command, grouping the frames and working out every write again
+    def lifx(frames):
+        for names, method, value, duration in _group_frames(frames):
+            obj.execute_command(names, method, value, duration)
+
+    def phue(frames):
+        for ids, parameter, value, duration in _group_frames(frames):
+            result = obj.execute_command(ids, parameter, value, duration)
+            for i, lid in enumerate(ids):
+                result[i][0].get("error")
+
+    return lifx if isinstance(obj, V.Lights.LifX) else phue
+
+
+def bench_plans(lights=20, repeat=20000):
+    # Only the work of turning a command or an effect tick into writes is timed: the light objects are
+    # built against the simulators, then commands are timed with an execute_command that sends nothing
+    # and effect ticks with requests that are not sent
+    import VocaLights as V
+    import Simulators as S
+
+    logging.getLogger("phue").setLevel(logging.ERROR)
+    lifx, hue = S.LifxSimulator(lights, 0, 0), S.HueSimulator(lights, 0, 0)
+    setup = V.Lights()
+    setup.configure_lights("lifx", startup="parallel", rate_limit=1e9, **lifx.settings())  # Nothing is queued
+    with S.isolated_phue_config():
+        setup.configure_lights("phue", startup="parallel", rate_limit=1e9, **hue.settings())
+    utterances = ["turn on lights", "change color to blue", "dim lights", "dim lights to 30 percent",
+                  "change color of %s 1 to red", "disco off"]
+
+    print("%8s %-28s %14s %14s %9s" % ("brand", "command", "legacy (us)", "plans (us)", "speedup"))
+    for obj in setup.light_objects:
+        brand = V.LIFX_BRAND if isinstance(obj, V.Lights.LifX) else V.PHUE_BRAND
+
+        def execute(*args):
+            # Legacy commands pass a list of arguments and looked the lights up through a new GlobalOps
+            ops = V.GlobalOps(obj) if len(args) == 1 else obj.ops
+            ids = ops.ready_lights(args[0][0] if len(args) == 1 else args[0])
+            return {} if brand == V.LIFX_BRAND else [[{"success": {}}]] * len(ids)
+
+        obj.execute_command = execute
+        legacy = _legacy_process(obj, V)
+        for words in utterances:
+            words = words % ("bulb" if brand == V.LIFX_BRAND else "hue") if "%" in words else words
+            intent = obj.matcher.match(words)
+            old = _best(legacy, intent, repeat)
+            new = _best(lambda intent: obj.process_command(words, intent), intent, repeat)
+            print("%8s %-28s %14.2f %14.2f %8.1fx" % (brand, words, old * 1e6, new * 1e6, old / new))
+
+        # One tick of a disco on every light, each light on its own color so nothing is grouped. The frames are
+        # written as the senders write them, without handing them over to their threads.
+        del obj.execute_command
+        obj.send = obj.send_light = lambda *args: [{"success": {}}]
+        plan = obj.plans["disco on"]
+        names = list(obj.lights) if brand == V.LIFX_BRAND else list(obj.PHUE_LIGHT_IDS.values())
+        values = {name: [plan.values[i % len(plan.values)]] for i, name in enumerate(names)}
+        frames = [(name, plan.method, values[name][0], plan.duration) for name in names]
+        if brand == V.LIFX_BRAND:  # As the effect is started, not timed
+            values = obj.bind_frames(names, plan.method, values)
+        bound = [(name, plan.method, values[name][0], plan.duration) for name in names]
+        old = _best(_legacy_frames(obj, V), frames, repeat // 10)
+        new = _best(lambda frames: [obj.write_frame(frame) for frame in frames], bound, repeat // 10)
+        print("%8s %-28s %14.2f %14.2f %8.1fx" % (brand, "effect tick (%d lights)" % len(names), old * 1e6,
+                                                  new * 1e6, old / new))
+
+    lifx.stop()
+    hue.stop()
+
+
+def bench_asr(wav_dir, vosk_model=None, google=True):
+    # Each recording should hold one command, e.g. 'turn on light 1.wav'. The file name (without the
+    # extension and any trailing '_2' style suffix) is taken as what was said, for the accuracy column.
+    import speech_recognition as sr
+    import VoiceCommands as VC
+
+    files = sorted(name for name in os.listdir(wav_dir) if name.lower().endswith(".wav"))
+    if not files:
+        raise Exception("No .wav files found in " + wav_dir)
+    recordings = []
+    for name in files:
+        with sr.AudioFile(os.path.join(wav_dir, name)) as source:
+            audio = sr.Recognizer().record(source)
+        recordings.append((os.path.splitext(name)[0].split("_")[0].lower(), audio))
+
+    backends = []
+    if google:
+        backends.append(("google", VC.GoogleBackend(), None))
+    if vosk_model is not None:
+        vosk = VC.VoskBackend(vosk_model)  # The model is loaded once, the second run limits it to a grammar
+        grammar = COMMANDS + COLORS + ["light %d" % (i + 1) for i in range(LIGHTS_PER_OBJECT)]
+        backends.append(("vosk", vosk, None))
+        backends.append(("vosk+grammar", vosk, grammar + ["lights", "to", "of", "percent"]))
+
+    print("%14s %12s %12s %10s" % ("backend", "wall (ms)", "cpu (ms)", "correct"))
+    for label, backend, grammar in backends:
+        if grammar is not None:
+            backend.set_grammar(grammar)
+        inputs = VC.CommandInputs(backend=backend)
+        wall = cpu = 0.0
+        correct = 0
+        for expected, audio in recordings:
+            start, start_cpu = time.perf_counter(), time.process_time()
+            words = inputs.recognize(audio)
+            wall += time.perf_counter() - start
+            cpu += time.process_time() - start_cpu
+            correct += words.lower() == expected
+        count = len(recordings)
+        print("%14s %12.1f %12.1f %6d/%-3d" % (label, wall / count * 1e3, cpu / count * 1e3, correct, count))
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def _settle(lights, timeout=5):
+    # Waits for the writes still queued or being sent, so none of them is sent after the simulators stop
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        if not any(obj.sending or any(stats["depth"] or stats["sending"] for stats in obj.rate_stats().values())
+                   for obj in lights.light_objects):
+            return
+        time.sleep(0.01)
+
+
+def bench_e2e(lifx_bulbs=50, hue_lights=20, latency=0.005, loss=0.0, commands=200, effect_seconds=5,
+              workers=16):
+    # Drives LightAPI and the effect scheduler against the local simulators in Simulators.py
+    import VocaLights as V
+    import Simulators as S
+
+    logging.getLogger("phue").setLevel(logging.ERROR)  # Lights that are off refusing colors is expected
+    lifx = S.LifxSimulator(lifx_bulbs, latency, loss) if lifx_bulbs else None
+    hue = S.HueSimulator(hue_lights, latency, loss) if hue_lights else None
+    lights = V.Lights(max_workers=workers)
+    start = time.perf_counter()
+    if lifx is not None:
+        lights.configure_lights("lifx", startup="parallel", **lifx.settings())
+    if hue is not None:
+        with S.isolated_phue_config():
+            lights.configure_lights("phue", startup="parallel", **hue.settings())
+    print("%d LifX bulbs and %d Hue lights configured in %.0f ms" % (lifx_bulbs, hue_lights,
+                                                                     (time.perf_counter() - start) * 1e3))
+    api = V.Lights.LightAPI(lights.light_objects, workers)
+    simulators = [simulator for simulator in (lifx, hue) if simulator is not None]
+
+    # Commands, alternating so the lights always have something to change
+    utterances = ["turn on lights", "change color to blue", "dim lights to 30 percent", "change color to green",
+                  "raise lights to 80 percent", "change color of bulb 1 to red", "change color of hue 1 to pink",
+                  "turn off lights"]
+    writes = sum(simulator.writes for simulator in simulators)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(commands):
+        began = time.perf_counter()
+        api.run_commands(utterances[i % len(utterances)])
+        latencies.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+    writes = sum(simulator.writes for simulator in simulators) - writes
+    print("commands: %d in %.2f s, %.1f commands/s, p50 %.1f ms, p99 %.1f ms, %d writes applied" % (
+        commands, elapsed, commands / elapsed, _percentile(latencies, 0.5) * 1e3,
+        _percentile(latencies, 0.99) * 1e3, writes))
+
+    # Effects, measured by the writes the simulators applied once the effect is under way, so the frames of the
+    # first tick are not counted. The target is every light once a period, or what the Hue bridge can take.
+    before = lights.scheduler.stats()
+    api.run_commands("turn on lights")
+    api.run_commands("disco on")
+    time.sleep(1)
+    applied = [simulator.writes for simulator in simulators]
+    start = time.perf_counter()
+    time.sleep(effect_seconds)
+    applied = [simulator.writes - count for simulator, count in zip(simulators, applied)]
+    elapsed = time.perf_counter() - start
+    api.run_commands("disco off")
+    after = lights.scheduler.stats()
+    for simulator, count in zip(simulators, applied):
+        if simulator is lifx:
+            target = lifx_bulbs / V.DEFAULTS[V.LIFX_BRAND]["disco_rate"]
+        else:
+            target = min(hue_lights / V.DEFAULTS[V.PHUE_BRAND]["disco_rate"], V.RATE_LIMITS[V.PHUE_BRAND])
+        print("effects on %s: %.1f writes/s applied, %.1f%% of the target %.1f/s" % (
+            type(simulator).__name__, count / elapsed, count / elapsed / target * 100, target))
+    frames = after["frames"] - before["frames"]
+    jitter = (after["jitter_mean_ms"] * after["frames"] - before["jitter_mean_ms"] * before["frames"]) / max(frames, 1)
+    skipped = lights.metrics.snapshot()["counters"].get("frames_skipped", 0)
+    print("scheduler: %d ticks skipped, %d frames skipped for lights still sending, jitter mean %.2f ms max %.2f ms" % (
+        after["skipped_ticks"] - before["skipped_ticks"], skipped, jitter, after["jitter_max_ms"]))
+
+    _settle(lights)
+    for simulator in simulators:
+        print("%s: %s" % (type(simulator).__name__, simulator.stats()))
+        simulator.stop()
+
+
+def _synthesize_music(seconds, sample_rate, bpm=120):
+    # A kick drum on every beat over a held chord, 16 bit mono
+    import numpy as np
+
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    chord = sum(np.sin(2 * np.pi * f * t) for f in (261.6, 329.6, 392.0)) * 0.05
+    since_beat = t % (60 / bpm)
+    kick = np.sin(2 * np.pi * 60 * since_beat) * np.exp(-since_beat * 30) * 0.6
+    return ((chord + kick) * 32767).astype(np.int16).tobytes(), int(seconds * bpm / 60)
+
+
+def bench_music(wav=None, seconds=30, sample_rate=16000, chunk=1024, fft_size=1024):
+    # Runs MusicMode's analysis over recorded audio as fast as it goes, chunk being what the microphone
+    # hands over at a time (speech_recognition reads 1024 samples)
+    import numpy as np
+    import MusicMode as MM
+
+    expected = None
+    if wav is not None:
+        with wave.open(wav, "rb") as recording:
+            if recording.getsampwidth() != 2:
+                raise Exception(wav + " is not 16 bit audio")
+            sample_rate = recording.getframerate()
+            samples = np.frombuffer(recording.readframes(recording.getnframes()), dtype=np.int16)
+            samples = samples.reshape(-1, recording.getnchannels()).mean(axis=1).astype(np.int16)
+        data = samples.tobytes()
+    else:
+        data, expected = _synthesize_music(seconds, sample_rate)
+
+    ring = MM.AudioRing(fft_size * 4)
+    analyzer = MM.MusicAnalyzer(sample_rate, fft_size)
+    step = chunk * 2  # Bytes
+    frames = beats = 0
+    wall = cpu = 0.0
+    for offset in range(0, len(data) - step + 1, step):
+        start, start_cpu = time.perf_counter(), time.process_time()
+        ring.write(np.frombuffer(data[offset:offset + step], dtype=np.int16).astype(np.float32) / 32768)
+        hue, brightness, beat = analyzer.analyze(ring.latest(fft_size), chunk)
+        wall += time.perf_counter() - start
+        cpu += time.process_time() - start_cpu
+        frames += 1
+        beats += beat
+
+    audio_seconds = len(data) / 2 / sample_rate
+    print("%d frames from %.1f s of audio: %.0f frames/s (%.0fx real time), %.3f ms wall %.3f ms cpu per frame" % (
+        frames, audio_seconds, frames / wall, audio_seconds / wall, wall / frames * 1e3, cpu / frames * 1e3))
+    print("beats: %d%s" % (beats, "" if expected is None else " of %d" % expected))
+    print("sound to frame: %.1f ms (a chunk of audio plus its analysis), of a %.0f ms budget" % (
+        (chunk / sample_rate + wall / frames) * 1e3, MM.MusicMode().budget * 1e3))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VocaLights micro-benchmarks")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    matcher = benchmarks.add_parser("matcher", help="command matching against the legacy substring scans")
+    matcher.set_defaults(func=lambda args: bench_matcher())
+
+    plans = benchmarks.add_parser("plans", help="compiled command plans against interpreting the command tables")
+    plans.add_argument("--lights", type=int, default=20, help="simulated lights of each brand")
+    plans.set_defaults(func=lambda args: bench_plans(args.lights))
+
+    asr = benchmarks.add_parser("asr", help="speech recognition latency of each backend over recorded commands")
+    asr.add_argument("--wav-dir", required=True, help="directory of .wav files, each named after the command")
+    asr.add_argument("--vosk-model", help="path to a Vosk model, the offline backend is skipped without one")
+    asr.add_argument("--no-google", action="store_true", help="skip the online backend")
+    asr.set_defaults(func=lambda args: bench_asr(args.wav_dir, args.vosk_model, not args.no_google))
+
+    e2e = benchmarks.add_parser("e2e", help="commands and effects end to end against simulated lights")
+    e2e.add_argument("--lifx", type=int, default=50, help="simulated LifX bulbs")
+    e2e.add_argument("--hue", type=int, default=20, help="simulated lights on one Hue bridge")
+    e2e.add_argument("--latency", type=float, default=5, help="reply latency of every device (in ms)")
+    e2e.add_argument("--loss", type=float, default=0.0, help="fraction of requests the devices never answer")
+    e2e.add_argument("--commands", type=int, default=200, help="commands sent through LightAPI")
+    e2e.add_argument("--effect-seconds", type=float, default=5, help="how long the disco effect is run for")
+    e2e.add_argument("--workers", type=int, default=16, help="max_workers of the Lights object")
+    e2e.set_defaults(func=lambda args: bench_e2e(args.lifx, args.hue, args.latency / 1000, args.loss, args.commands,
+                                                 args.effect_seconds, args.workers))
+
+    music = benchmarks.add_parser("music", help="frames per second and cpu per frame of the music analysis")
+    music.add_argument("--wav", help="16 bit recording to analyze, a synthesized 120 bpm beat without one")
+    music.add_argument("--seconds", type=float, default=30, help="length of the synthesized beat")
+    music.add_argument("--chunk", type=int, default=1024, help="samples the microphone hands over at a time")
+    music.set_defaults(func=lambda args: bench_music(args.wav, args.seconds, chunk=args.chunk))
+
+    args = parser.parse_args()
+    args.func(args)
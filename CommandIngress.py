@@ -0,0 +1,128 @@
+import threading
+import http.server
+import urllib.parse
+import json
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CommandDispatcher:
+
+    """
+    Sends commands from any source (the microphone, a file of commands, other programs over HTTP)
+    through one LightAPI, so they all share the connections, rate limits and remembered state of
+    the configured lights instead of each setting the lights up again.
+
+    Takes a Lights object (or an Activation) once its lights have been configured. Every command
+    returns the same response dicts as LightAPI.run_commands and is timed in lights.metrics. At most
+    max_concurrent commands are sent to the lights at once, later ones wait their turn.
+
+    - dispatch(words): Runs a single command and returns its responses
+    - replay(lines): Runs every line of a file or stdin as a command (blank lines and lines starting with # are
+                     skipped), writing each command with its responses as a line of JSON to output
+    - serve(port): Accepts commands over HTTP on this machine, e.g.
+                   curl -d "turn on lights" http://127.0.0.1:8765/command
+                   curl "http://127.0.0.1:8765/command?words=dim+lights+to+20+percent"
+                   curl "http://127.0.0.1:8765/command?words=turn+on&room=kitchen"
+                   A JSON list of commands posted to /commands is run in order and answered with a list.
+    """
+
+    def __init__(self, lights, max_concurrent=8):
+        if len(lights.light_objects) == 0:
+            raise Exception("ERROR: No lights have been configured for usage. Configure the lights with "
+                            "configure_lights before creating the dispatcher.")
+        self.api = lights.LightAPI(lights.light_objects, lights.max_workers, lights.scenes, lights.rooms,
+                                   lights.music)
+        self.metrics = lights.metrics
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.server = None
+
+    def dispatch(self, words, trace=None, source="voice", room=None):
+        # Commands that name no light go to the lights of the room, by default the one they were heard in
+        self.metrics.count(source + "_commands")
+        if trace is None:  # Commands that were not spoken are timed from when they arrive
+            trace = self.metrics.trace(room=room)
+        with self.slots:
+            response = self.api.run_commands(words, trace, room if room is not None else trace.room)
+        trace.finish(words)
+        return response
+
+    def replay(self, lines=None, output=None, concurrency=1):
+        # Commands are run concurrently when concurrency is above 1, the output keeps their order
+        lines = sys.stdin if lines is None else lines
+        output = sys.stdout if output is None else output
+        commands = [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+        def run(words):
+            return self.dispatch(words, source="replay")
+
+        if concurrency > 1:
+            with ThreadPoolExecutor(concurrency, thread_name_prefix="Replay") as pool:
+                responses = list(pool.map(run, commands))
+        else:
+            responses = [run(words) for words in commands]
+
+        for words, response in zip(commands, responses):
+            output.write(json.dumps({"words": words, "response": response}, default=str) + "\n")
+        output.flush()
+        return responses
+
+    def serve(self, port=8765, host="127.0.0.1"):
+        # Runs in the background, returns the port (useful when port 0 picks a free one)
+        self.server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="CommandServer", daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def _handler(self):
+        dispatcher = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Lets a client send many commands over one connection
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                words, room = query.get("words", [""])[0], query.get("room", [None])[0]
+                if url.path != "/command" or not words:
+                    self._reply(404 if url.path != "/command" else 400, {"ERROR": "Expected /command?words=..."})
+                    return
+                self._reply(200, {"words": words, "response": dispatcher.dispatch(words, source="http", room=room)})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+                path = urllib.parse.urlparse(self.path).path
+                try:
+                    if path == "/command":
+                        # Plain text, or JSON of the form {"words": "...", "room": "..."} (the room is optional)
+                        command = json.loads(body) if body.lstrip().startswith("{") else {"words": body.strip()}
+                        words = command["words"]
+                        self._reply(200, {"words": words, "response": dispatcher.dispatch(words, source="http",
+                                                                                          room=command.get("room"))})
+                    elif path == "/commands":
+                        self._reply(200, [{"words": words, "response": dispatcher.dispatch(words, source="http")}
+                                          for words in json.loads(body)])
+                    else:
+                        self._reply(404, {"ERROR": "Commands are posted to /command or /commands"})
+                except (ValueError, KeyError, TypeError) as Ex:
+                    self._reply(400, {"ERROR": "Could not read command: " + str(Ex)})
+
+            def _reply(self, status, body):
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass  # Keeps requests out of the console
+
+        return Handler
@@ -0,0 +1,106 @@
+import re
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+COMMAND = "command"
+LIGHT = "light"
+COLOR = "color"
+
+
+def tokenize(words):
+    return TOKEN_PATTERN.findall(words.lower())
+
+
+class Intent:
+
+    """
+    The structured result of matching an utterance against the configured phrases.
+
+    - command: The first command phrase spoken (e.g. 'turn on'), or None
+    - lights: The light names spoken, in the order they were heard (empty means all lights)
+    - color: The first color spoken, or None
+    - percent: The last number spoken that is not part of a light name, or None
+    - remainder: Tokens that did not belong to any known phrase (e.g. a scene name)
+    """
+
+    __slots__ = ("words", "command", "lights", "color", "percent", "remainder")
+
+    def __init__(self, words, command=None, lights=None, color=None, percent=None, remainder=None):
+        self.words = words
+        self.command = command
+        self.lights = lights if lights is not None else []
+        self.color = color
+        self.percent = percent
+        self.remainder = remainder if remainder is not None else []
+
+    def __repr__(self):
+        return "Intent(command=%r, lights=%r, color=%r, percent=%r)" % (self.command, self.lights,
+                                                                         self.color, self.percent)
+
+
+class CommandMatcher:
+
+    """
+    Compiles every phrase the program understands (commands, light names and colors) into a
+    single token trie once, when the lights are configured. An utterance is then parsed in one
+    pass over its words, always taking the longest phrase that matches at each position so that
+    overlapping names such as 'light 1' and 'light 10' cannot clash. Numbers that are not part of
+    a light name are treated as the requested percentage.
+    """
+
+    def __init__(self, commands=(), light_names=(), colors=()):
+        self.trie = {}
+        self.commands = tuple(commands)
+        self.light_names = tuple(light_names)
+        self.colors = tuple(colors)
+
+        # Added in order of precedence, a later kind overrides an identical phrase of an earlier one
+        for phrase in self.colors:
+            self.add(COLOR, phrase)
+        for phrase in self.commands:
+            self.add(COMMAND, phrase)
+        for phrase in self.light_names:
+            self.add(LIGHT, phrase)
+
+    def add(self, kind, phrase):
+        node = self.trie
+        for token in tokenize(phrase):
+            node = node.setdefault(token, {})
+        node[None] = (kind, phrase)  # Terminal marker, tokens are never None
+
+    def match(self, words):
+        intent = Intent(words)
+        tokens = tokenize(words)
+        count = len(tokens)
+        i = 0
+        while i < count:
+            node = self.trie
+            found = None
+            j = i
+            while j < count:
+                node = node.get(tokens[j])
+                if node is None:
+                    break
+                j += 1
+                if None in node:  # Keep walking, a longer phrase wins over a shorter one
+                    found = (j, node[None])
+
+            if found is None:
+                if tokens[i].isdigit():
+                    intent.percent = int(tokens[i])
+                else:
+                    intent.remainder.append(tokens[i])
+                i += 1
+                continue
+
+            i, (kind, phrase) = found
+            if kind == LIGHT:
+                if phrase not in intent.lights:
+                    intent.lights.append(phrase)
+            elif kind == COMMAND:
+                if intent.command is None:
+                    intent.command = phrase
+            elif intent.color is None:
+                intent.color = phrase
+
+        return intent
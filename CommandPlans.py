@@ -0,0 +1,74 @@
+import re
+
+SET = "set"  # Sends one fixed value (power on or off)
+COLOR = "color"  # Sends the color that was asked for
+LEVEL = "level"  # Sends the percent that was asked for, or a default level
+START = "start"  # Starts an effect
+STOP = "stop"  # Stops an effect
+
+
+class CommandPlan:
+
+    """
+    What one command does to the lights of a brand, compiled once from the brand's command tables
+    when the lights are configured so that running it is a lookup and binding the spoken parameters
+    rather than working the tables out again every time.
+
+    Plans cannot be changed once compiled, as they are shared by every command and effect.
+    """
+
+    __slots__ = ("command", "kind", "method", "value", "colors", "scale", "duration", "effect", "period", "values")
+
+    def __init__(self, command, kind, method, value=None, colors=None, scale=1, duration=None, effect=None,
+                 period=None, values=()):
+        for slot, setting in zip(self.__slots__, (command, kind, method, value, colors, scale, duration, effect,
+                                                  period, tuple(values))):
+            object.__setattr__(self, slot, setting)
+
+    def __setattr__(self, slot, setting):
+        raise AttributeError("Command plans cannot be changed once compiled")
+
+    def bind(self, intent):
+        # The value the command sends for what was said, None when it has nothing to send (e.g. no color)
+        if self.kind == COLOR:
+            return self.colors.get(intent.color)
+        if self.kind == LEVEL and intent.percent is not None:
+            return int(intent.percent * self.scale)
+        return self.value
+
+    def __repr__(self):
+        return "CommandPlan(%r, %s, %s)" % (self.command, self.kind, self.method)
+
+
+def compile_plan(command, method, specs, scale, duration=None):
+    """
+    Turns the spec of a command in a brand's table into its plan: a dict of colors, a list describing
+    an effect ([True, name, period, values, transition] to start it, [False, name] to stop it), a
+    "dynaInt<level>" string for brightness with a default level, or the value to send.
+    """
+    if isinstance(specs, dict):
+        return CommandPlan(command, COLOR, method, colors=dict(specs), duration=duration)
+    if isinstance(specs, list):
+        if not specs[0]:
+            return CommandPlan(command, STOP, method, effect=specs[1])
+        return CommandPlan(command, START, method, effect=specs[1], period=specs[2], values=specs[3].values(),
+                           duration=specs[4] if len(specs) > 4 else None)
+    if isinstance(specs, str) and specs.startswith("dynaInt"):
+        return CommandPlan(command, LEVEL, method, value=int(re.findall(r'\d+', specs)[-1]), scale=scale,
+                           duration=duration)
+    return CommandPlan(command, SET, method, value=specs, duration=duration)
+
+
+def compile_lifx(commands):
+    # {command: {method: specs, "rate": transition}} -> {command: plan}, transitions default to instant
+    plans = {}
+    for command, spec in commands.items():
+        method, specs = next(iter(spec.items()))
+        plans[command] = compile_plan(command, method, specs, 650, spec.get("rate", 0))
+    return plans
+
+
+def compile_phue(commands, keywords):
+    # {command: attribute} and {command: specs} -> {command: plan}, transitions are left to the bridge
+    return {command: compile_plan(command, attribute, keywords[command], 2.54)
+            for command, attribute in commands.items()}
@@ -0,0 +1,120 @@
+import threading
+import time
+
+CLOSED = "closed"  # Healthy, sent everything
+OPEN = "open"  # Failing, skipped until a probe gets through
+HALF_OPEN = "half-open"  # Being probed
+
+UNAVAILABLE = "unavailable"  # PhilipsHue style error type for lights that were skipped or could not be reached
+
+
+class DeviceHealth:
+
+    """
+    A circuit breaker for each device (a LifX bulb, a PhilipsHue light or bridge), so a device that
+    stops answering is skipped straight away instead of holding up every command sent to it.
+
+    A device's breaker opens after failures requests to it have failed in a row. While it is open
+    the device is not sent anything, and callers report it as unavailable. After reset_after seconds
+    the device's probe (a cheap read registered with register) is run on a background thread: if it
+    succeeds the breaker closes and the device is used again, otherwise it stays open and is probed
+    again later, waiting twice as long each time up to max_reset_after. A device without a probe is
+    let back in after reset_after and its next request decides.
+    """
+
+    def __init__(self, failures=3, reset_after=10, max_reset_after=60, metrics=None):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.max_reset_after = max_reset_after
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.devices = {}  # Device -> {"state", "failures", "wait", "opened", "last_error", "trips"}
+        self.probes = {}  # Device -> function that raises when the device cannot be reached
+
+        # Stats
+        self.skipped = 0  # Requests not sent because the device's breaker was open
+
+    def register(self, device, probe):
+        self.probes[device] = probe
+
+    def available(self, device):
+        # Counts a skip when the device is not, so callers only need to ask once per request
+        with self.lock:
+            health = self.devices.get(device)
+            if health is None or health["state"] == CLOSED:
+                return True
+            self.skipped += 1
+        if self.metrics is not None:
+            self.metrics.count("unavailable_skips")
+        return False
+
+    def call(self, device, func, *args):
+        # Calls func, recording whether the device answered. Exceptions are recorded and re-raised.
+        try:
+            result = func(*args)
+        except Exception as Ex:
+            self.failure(device, Ex)
+            raise
+        self.success(device)
+        return result
+
+    def success(self, device):
+        with self.lock:
+            health = self.devices.get(device)
+            if health is None:
+                return
+            if health["state"] != CLOSED:
+                print(f"{device} is answering again")
+            health.update(state=CLOSED, failures=0, wait=self.reset_after)
+
+    def failure(self, device, error):
+        with self.lock:
+            health = self.devices.setdefault(device, {"state": CLOSED, "failures": 0, "wait": self.reset_after,
+                                                      "opened": None, "last_error": None, "trips": 0})
+            health["failures"] += 1
+            health["last_error"] = str(error)
+            if health["state"] != CLOSED or health["failures"] < self.failures:
+                return
+            health.update(state=OPEN, opened=time.time(), trips=health["trips"] + 1)
+            wait = health["wait"]
+        print(f"{device} is not answering and is skipped until it does: " + str(error))
+        if self.metrics is not None:
+            self.metrics.count("circuits_opened")
+        self._probe_later(device, wait)
+
+    def state(self, device):
+        health = self.devices.get(device)
+        return health["state"] if health is not None else CLOSED
+
+    def stats(self):
+        with self.lock:
+            return {
+                "skipped": self.skipped,
+                "devices": {device: {key: health[key] for key in ("state", "failures", "trips", "last_error")}
+                            for device, health in self.devices.items()},
+            }
+
+    def _probe_later(self, device, wait):
+        timer = threading.Timer(wait, self._probe, (device,))
+        timer.daemon = True
+        timer.start()
+
+    def _probe(self, device):
+        probe = self.probes.get(device)
+        with self.lock:
+            health = self.devices[device]
+            if health["state"] == CLOSED:
+                return  # A request got through in the meantime
+            health["state"] = HALF_OPEN
+            if probe is None:
+                health.update(state=CLOSED, failures=self.failures - 1)  # One more failure opens it again
+                return
+        try:
+            probe()
+        except Exception as Ex:
+            with self.lock:
+                health.update(state=OPEN, last_error=str(Ex), wait=min(health["wait"] * 2, self.max_reset_after))
+                wait = health["wait"]
+            self._probe_later(device, wait)
+            return
+        self.success(device)
@@ -0,0 +1,84 @@
+import threading
+import time
+
+
+class ShadowState:
+
+    """
+    Remembers the last value written to each attribute (e.g. power, color, brightness) of each light
+    so that writes which would not change anything can be dropped before they reach the network.
+
+    A remembered value is only trusted for max_age seconds after it was written or read back from
+    the light, after which the light is treated as unknown and the next write is always sent. This
+    keeps changes made outside of the program (a wall switch, the brand's app) from being masked for
+    long. Light objects refresh the values by reading the lights back with reconcile.
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.state = {}  # light -> {attribute: (value, time)}
+        self.lock = threading.Lock()
+
+        # Stats
+        self.checked = 0  # Writes checked against the shadow
+        self.hits = 0  # Writes where the light's current value was known
+        self.skipped = 0  # Writes dropped because the light already had the value
+
+    def get(self, light, attribute, default=None, stale=False):
+        # A value older than max_age is only returned when stale is set
+        with self.lock:
+            entry = self.state.get(light, {}).get(attribute)
+        if entry is None or (not stale and time.monotonic() - entry[1] > self.max_age):
+            return default
+        return entry[0]
+
+    def changes(self, lights, attribute, value):
+        # Returns the lights that still need the value written to them
+        needed = []
+        now = time.monotonic()
+        with self.lock:
+            for light in lights:
+                self.checked += 1
+                entry = self.state.get(light, {}).get(attribute)
+                if entry is None or now - entry[1] > self.max_age:
+                    needed.append(light)
+                    continue
+                self.hits += 1
+                if entry[0] == value:
+                    self.skipped += 1
+                else:
+                    needed.append(light)
+        return needed
+
+    def update(self, lights, attribute, value):
+        now = time.monotonic()
+        with self.lock:
+            for light in lights:
+                self.state.setdefault(light, {})[attribute] = (value, now)
+
+    def forget(self, lights):
+        with self.lock:
+            for light in lights:
+                self.state.pop(light, None)
+
+    def reconcile(self, light, actual):
+        # Takes the values read back from the light, returns {attribute: remembered value} for the ones that differed
+        now = time.monotonic()
+        differed = {}
+        with self.lock:
+            shadow = self.state.setdefault(light, {})
+            for attribute, value in actual.items():
+                entry = shadow.get(attribute)
+                if entry is not None and entry[0] != value:
+                    differed[attribute] = entry[0]
+                shadow[attribute] = (value, now)
+        return differed
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "hits": self.hits,
+            "skipped": self.skipped,
+            "sent": self.checked - self.skipped,
+            "skip_rate": self.skipped / self.checked if self.checked else 0.0,
+        }
@@ -0,0 +1,163 @@
+import urllib.request
+import threading
+import socket
+import random
+import json
+import time
+import os
+
+import lifxlan as lx
+
+LIFX_PORT = 56700
+BROADCAST_MAC = "00:00:00:00:00:00"
+HUE_PORTAL = "https://discovery.meethue.com/"  # Lists the Hue bridges on the network it is asked from
+
+
+def split_address(address):
+    # "192.168.1.20" or "127.0.0.1:56701" -> (host, port)
+    host, _, port = address.partition(":")
+    return host, int(port or LIFX_PORT)
+
+
+def discover_lifx(timeout=1.0, targets=None, attempts=2):
+    """
+    Broadcasts a single state request that every LifX bulb on the network answers with its label,
+    power and color, so one round trip finds the bulbs and what they are showing. Returns
+    {mac address: {"name": label, "ip": address, "state": {"power": int, "color": [h, s, b, k]}}}.
+    targets are the (address, port) pairs to broadcast to, every local broadcast address by default.
+    """
+    targets = targets or [(address, LIFX_PORT) for address in lx.device.UDP_BROADCAST_IP_ADDRS]
+    source = random.randrange(2, 1 << 32)
+    message = lx.LightGet(BROADCAST_MAC, source, seq_num=0, payload={}, ack_requested=False, response_requested=True)
+    found = {}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind(("", 0))
+        for _ in range(attempts):  # Sent again in case the first broadcast was lost
+            for target in targets:
+                try:
+                    sock.sendto(message.packed_message, target)
+                except OSError:
+                    pass  # Interfaces that are down or cannot broadcast
+            deadline = time.monotonic() + timeout / attempts
+            while time.monotonic() < deadline:
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                try:
+                    data, (host, port) = sock.recvfrom(1024)
+                    reply = lx.unpack_lifx_message(data)
+                except socket.timeout:
+                    break
+                except Exception:
+                    continue  # Not a LifX message
+                if isinstance(reply, lx.LightState) and reply.source_id == source:
+                    found[reply.target_addr.lower()] = {
+                        "name": reply.label, "ip": host if port == LIFX_PORT else "%s:%d" % (host, port),
+                        "state": {"power": 65535 if reply.power_level > 0 else 0, "color": list(reply.color)}}
+    finally:
+        sock.close()
+    return found
+
+
+def discover_hue(bridge):
+    # A single request lists every light on the bridge: {light id: {"name": str, "state": {...}}}
+    return {int(lid): {"name": light["name"], "state": {key: light["state"][key] for key in ("on", "xy", "bri")
+                                                         if key in light["state"]}}
+            for lid, light in bridge.get_light().items()}
+
+
+def hue_bridge_id(bridge):
+    # The id the bridge is listed under by the portal, it stays the same when the bridge gets a new address
+    return bridge.request("GET", "/api/" + str(bridge.username) + "/config")["bridgeid"].lower()
+
+
+def discover_hue_bridges(portal=HUE_PORTAL, timeout=5):
+    # Asks the portal for the bridges on the network: {bridge id: ip address}
+    with urllib.request.urlopen(portal, timeout=timeout) as reply:
+        bridges = json.load(reply)
+    # The portal lists the HTTPS port, phue talks plain HTTP on port 80 of the same address
+    return {bridge["id"].lower(): bridge["internalipaddress"] if bridge.get("port") in (None, 80, 443)
+            else "%s:%d" % (bridge["internalipaddress"], bridge["port"]) for bridge in bridges}
+
+
+class DiscoveryCache:
+
+    """
+    The lights found on the network, saved to a JSON file (~/.vocalights_devices by default) so the
+    program can configure them straight away on the next start instead of waiting on the network.
+
+    LifX bulbs are kept by MAC address with their name and last known address, PhilipsHue lights by
+    bridge and light id with their name. Both keep the state they were last seen in and when that
+    was. Entries are refreshed in the background while the program runs, so a bulb that was given a
+    new address by DHCP is followed to it and the next start uses the new one. Bridges are kept by
+    id as well, so one that moved can be found again through the Hue portal.
+    """
+
+    def __init__(self, path=None, targets=None, portal=HUE_PORTAL):
+        self.path = os.path.expanduser(path if path is not None else "~/.vocalights_devices")
+        self.targets = targets  # LifX broadcast (address, port) pairs, see discover_lifx
+        self.portal = portal  # See discover_hue_bridges
+        self.lock = threading.Lock()
+        self.devices = {"lifx": {}, "phue": {}, "hue_bridges": {}}  # The last also maps bridge ids to addresses
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as file:
+                    self.devices.update(json.load(file))
+            except (OSError, ValueError) as Ex:
+                print("WARNING: Discovered lights could not be read from " + self.path + ": " + str(Ex))
+
+    def lifx(self, names=None):
+        # Returns (ip addresses, light names, mac addresses) of the cached bulbs, only the named ones if given
+        bulbs = [(bulb["ip"], bulb["name"], mac) for mac, bulb in self.devices["lifx"].items()
+                 if names is None or bulb["name"] in names]
+        return tuple(list(column) for column in zip(*bulbs)) if bulbs else ([], [], [])
+
+    def hue(self, bridge, names=None):
+        # Returns (light ids, light names) of the cached lights of the bridge, only the named ones if given
+        lights = [(int(lid), light["name"]) for lid, light in self.devices["phue"].get(bridge, {}).items()
+                  if names is None or light["name"] in names]
+        return tuple(list(column) for column in zip(*lights)) if lights else ([], [])
+
+    def bridges(self):
+        return list(self.devices["phue"])
+
+    def refresh_lifx(self):
+        found = discover_lifx(targets=self.targets)
+        self.update("lifx", found)
+        return found
+
+    def refresh_hue(self, bridge_ip, bridge):
+        found = discover_hue(bridge)
+        self.update("phue", {str(lid): light for lid, light in found.items()}, bridge_ip)
+        if bridge_ip not in self.devices["hue_bridges"].values():  # Asked once, the id does not change
+            with self.lock:
+                self.devices["hue_bridges"][hue_bridge_id(bridge)] = bridge_ip
+                self._write()
+        return found
+
+    def find_hue_bridge(self, bridge_ip):
+        # Returns the address the bridge last seen at bridge_ip has now, None if it is not known or not found
+        bridge_id = next((key for key, ip in self.devices["hue_bridges"].items() if ip == bridge_ip), None)
+        if bridge_id is None:
+            return None
+        moved = discover_hue_bridges(self.portal).get(bridge_id)
+        if moved is not None and moved != bridge_ip:
+            with self.lock:  # Its lights are looked up under the new address on the next start
+                self.devices["hue_bridges"][bridge_id] = moved
+                self.devices["phue"][moved] = self.devices["phue"].pop(bridge_ip, {})
+                self._write()
+        return moved
+
+    def update(self, brand, found, bridge=None):
+        seen = time.time()
+        with self.lock:
+            entries = self.devices[brand] if bridge is None else self.devices[brand].setdefault(bridge, {})
+            for key, device in found.items():
+                entries[key] = dict(device, seen=seen)
+            self._write()
+
+    def _write(self):
+        # Written to a temporary file first so a crash cannot leave half a file behind
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(self.devices, file, indent=2)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,177 @@
+import threading
+import heapq
+import math
+import time
+
+
+class Effect:
+
+    """
+    A running effect on one light: cycles through values, sending one every period seconds.
+    """
+
+    __slots__ = ("owner", "light", "name", "method", "values", "period", "duration", "start", "step", "deadline")
+
+    def __init__(self, owner, light, name, method, values, period, duration, start):
+        self.owner = owner
+        self.light = light
+        self.name = name
+        self.method = method
+        self.values = values
+        self.period = period
+        self.duration = duration
+        self.start = start
+        self.step = 0
+        self.deadline = start
+
+    def __lt__(self, other):  # Order of effects sharing a deadline does not matter
+        return id(self) < id(other)
+
+
+class Callback:
+
+    """
+    A one-off function call scheduled with EffectScheduler.call_later.
+    """
+
+    __slots__ = ("func", "deadline")
+
+    def __init__(self, func, deadline):
+        self.func = func
+        self.deadline = deadline
+
+    def __lt__(self, other):
+        return id(self) < id(other)
+
+
+class EffectScheduler:
+
+    """
+    Runs the effects (colorama, disco, flash, flicker) of every configured light from one thread.
+
+    Each light runs at most one effect, so starting an effect replaces whatever the light was
+    running and stopping one light leaves the others running. Ticks are kept on absolute deadlines
+    (start + step * period) so time spent talking to the lights does not push later ticks back,
+    and a tick that is missed entirely is skipped rather than sent late. All the effects that are
+    due at the same time on the same light object are handed to its execute_frames method as one
+    batch, which can then send them in a single write.
+
+    The scheduler thread never talks to a device itself: execute_frames only hands the frames to the
+    light object's own sender threads and returns, so a light that is slow to answer cannot hold up
+    the ticks of the others.
+    """
+
+    def __init__(self):
+        self.effects = {}  # (owner, light) -> Effect
+        self.heap = []
+        self.condition = threading.Condition()
+        self.thread = None
+
+        # Stats
+        self.ticks = 0
+        self.frames = 0
+        self.skipped = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+    def start(self, owner, lights, name, method, values, period, duration=None):
+        # Lights started together share a start time so they keep ticking in the same batch.
+        # values is either shared by all the lights or a dict with the values of each light.
+        start = time.monotonic()
+        with self.condition:
+            for light in lights:
+                light_values = values[light] if isinstance(values, dict) else values
+                effect = Effect(owner, light, name, method, list(light_values), period, duration, start)
+                self.effects[(owner, light)] = effect
+                heapq.heappush(self.heap, (effect.deadline, effect))
+            self._ensure_thread()
+            self.condition.notify()
+
+    def call_later(self, delay, func):
+        # Runs func on the scheduler thread after delay seconds, it should not block for long
+        with self.condition:
+            callback = Callback(func, time.monotonic() + delay)
+            heapq.heappush(self.heap, (callback.deadline, callback))
+            self._ensure_thread()
+            self.condition.notify()
+
+    def stop(self, owner, lights, name=None):
+        # Only stops the named effect when one is given, the heap entries are dropped when they come due
+        with self.condition:
+            for light in lights:
+                effect = self.effects.get((owner, light))
+                if effect is not None and name in (None, effect.name):
+                    del self.effects[(owner, light)]
+
+    def running(self, owner, light):
+        effect = self.effects.get((owner, light))
+        return effect.name if effect is not None else None
+
+    def stats(self):
+        return {
+            "threads": 1 if self.thread is not None else 0,
+            "process_threads": threading.active_count(),
+            "effects": len(self.effects),
+            "ticks": self.ticks,
+            "frames": self.frames,
+            "skipped_ticks": self.skipped,
+            "jitter_mean_ms": self.jitter_total / self.frames * 1000 if self.frames else 0.0,
+            "jitter_max_ms": self.jitter_max * 1000,
+        }
+
+    def _ensure_thread(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="EffectScheduler", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            batches = {}  # owner -> [(light, method, value, duration)]
+            callbacks = []
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    deadline, effect = heapq.heappop(self.heap)
+                    if isinstance(effect, Callback):
+                        callbacks.append(effect.func)
+                        continue
+                    if self.effects.get((effect.owner, effect.light)) is not effect:
+                        continue  # Stopped or replaced since it was scheduled
+
+                    jitter = now - deadline
+                    self.jitter_total += jitter
+                    self.jitter_max = max(self.jitter_max, jitter)
+                    self.frames += 1
+
+                    value = effect.values[effect.step % len(effect.values)]
+                    batches.setdefault(effect.owner, []).append((effect.light, effect.method, value, effect.duration))
+
+                    # Next deadline from the start time so the effect does not drift, skipping missed ticks
+                    effect.step += 1
+                    due = math.ceil((now - effect.start) / effect.period)
+                    if due > effect.step:
+                        self.skipped += due - effect.step
+                        effect.step = due
+                    effect.deadline = effect.start + effect.step * effect.period
+                    heapq.heappush(self.heap, (effect.deadline, effect))
+                if batches:
+                    self.ticks += 1  # Wake-ups that sent frames, however many effects were due
+
+            for func in callbacks:
+                try:
+                    func()
+                except Exception as Ex:
+                    print("Scheduled call failed: " + str(Ex))
+
+            for batch in batches.items():
+                self._send(batch)
+
+    def _send(self, batch):
+        owner, frames = batch
+        try:
+            owner.execute_frames(frames)
+        except Exception as Ex:
+            print("Effect could not be sent: " + str(Ex))
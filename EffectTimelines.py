@@ -0,0 +1,79 @@
+import collections
+import threading
+
+import numpy as np
+
+HSBK = "hsbk"  # LifX [hue, saturation, brightness, kelvin], hue wraps around at 65536
+XY = "xy"  # PhilipsHue CIE [x, y]
+
+# Easing curves map the progress t (0 to 1) between two colors onto how far the color has moved
+EASINGS = {
+    "linear": lambda t: t,
+    "ease-in-out": lambda t: (1 - np.cos(np.pi * t)) / 2,
+    "ease-in": lambda t: t * t,
+    "ease-out": lambda t: 1 - (1 - t) ** 2,
+    "step": lambda t: np.zeros_like(t),  # Hard jumps from one color to the next
+}
+
+
+def interpolate(colors, frames_per_color, space, easing="linear"):
+    """
+    Returns one cycle through the colors (and back to the first) as an array of frames_per_color
+    frames per color. HSBK hues are moved the shorter way around the color wheel.
+    """
+    keys = np.asarray(colors, dtype=float)
+    delta = np.roll(keys, -1, axis=0) - keys
+    if space == HSBK:
+        delta[:, 0] = (delta[:, 0] + 32768) % 65536 - 32768
+    progress = EASINGS[easing](np.arange(frames_per_color) / frames_per_color)
+    frames = (keys[:, None, :] + progress[None, :, None] * delta[:, None, :]).reshape(-1, keys.shape[1])
+    if space == HSBK:
+        frames[:, 0] %= 65536
+        return np.rint(frames).astype(int)
+    return np.round(frames, 4)
+
+
+def phase_offsets(count, length, spread):
+    # Spreads count lights evenly over the given fraction of the cycle, 0 keeps them all in step
+    return (np.arange(count) * spread * length / max(count, 1)).astype(int) % length
+
+
+class TimelineCache:
+
+    """
+    Builds the frames of every light running a color effect at once and keeps the most recently
+    used timelines, keyed by the effect's colors, frames per color, color space, easing, light
+    count and spread. Starting the same effect again (or on another set of as many lights) reuses
+    the frames rather than computing them again.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.timelines = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def timeline(self, colors, frames_per_color, space, easing="linear", count=1, spread=0.0):
+        # Returns a list with the frames of each light, as plain lists ready to be sent
+        key = (tuple(tuple(color) for color in colors), frames_per_color, space, easing, count, spread)
+        with self.lock:
+            if key in self.timelines:
+                self.hits += 1
+                self.timelines.move_to_end(key)
+                return self.timelines[key]
+            self.misses += 1
+
+        base = interpolate(colors, frames_per_color, space, easing)
+        offsets = phase_offsets(count, len(base), spread)
+        steps = (np.arange(len(base))[None, :] + offsets[:, None]) % len(base)
+        timeline = base[steps].tolist()  # (lights, frames, channels)
+
+        with self.lock:
+            self.timelines[key] = timeline
+            while len(self.timelines) > self.size:
+                self.timelines.popitem(last=False)
+        return timeline
+
+    def stats(self):
+        return {"timelines": len(self.timelines), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,262 @@
+import threading
+import collections
+import http.server
+import json
+import time
+import os
+
+# Upper bounds of the latency histogram buckets (in ms), the last one catches everything slower
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float("inf"))
+
+# Stages of an utterance in the order they happen
+STAGES = ("capture", "gate", "queue", "asr", "reorder", "match", "dispatch", "total")
+
+
+class Histogram:
+
+    """
+    Counts latencies into the fixed buckets of BUCKETS_MS. Quantiles are read from the buckets, so
+    they are the upper bound of the bucket the quantile falls in rather than an exact value.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.sum / self.count if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": self.max,
+        }
+
+
+class Trace:
+
+    """
+    Follows one utterance through the pipeline. It starts when the microphone finishes hearing the
+    phrase, and each stage it passes through is added to the stage histograms as soon as it is timed.
+    finish records the total time and keeps the spans with the most recent traces.
+    """
+
+    def __init__(self, metrics, seq, start=None, room=None):
+        self.metrics = metrics
+        self.seq = seq
+        self.room = room  # Of the microphone that heard the phrase, when rooms are configured
+        self.start = start if start is not None else time.monotonic()
+        self.mark = self.start  # End of the last stage, for stages timed as the gap since then
+        self.spans = {}  # Stage -> seconds
+        self.words = None
+
+    def add(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+        self.metrics.observe(stage, seconds)
+
+    def lap(self, stage):
+        # Times the stage as everything since the last one ended
+        now = time.monotonic()
+        self.add(stage, now - self.mark)
+        self.mark = now
+
+    def span(self, stage):
+        return _Span(self, stage)
+
+    def finish(self, words=None):
+        self.words = words
+        self.add("total", time.monotonic() - self.start)
+        self.metrics.completed(self)
+
+    def snapshot(self):
+        return {"seq": self.seq, "words": self.words, "room": self.room,
+                "spans_ms": {stage: seconds * 1000 for stage, seconds in self.spans.items()}}
+
+
+class _Span:
+
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.mark = time.monotonic()
+        self.trace.add(self.stage, self.trace.mark - self.started)
+        return False
+
+
+class Metrics:
+
+    """
+    Latency histograms for each stage an utterance passes through (capture, gate, queue, asr,
+    reorder, match, dispatch and total) and for each device's reply, along with per-device request and
+    error counts.
+
+    The numbers can be read in-process with snapshot(), written to a JSON file every few seconds
+    with start_writer(path), or scraped from a local HTTP endpoint started with serve(port), which
+    answers /metrics in the Prometheus text format and /metrics.json with the snapshot.
+    """
+
+    def __init__(self, recent=50):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict((stage, Histogram()) for stage in STAGES)
+        self.devices = {}  # Device -> {"latency": Histogram, "requests": int, "errors": int, "last_error": str}
+        self.recent = collections.deque(maxlen=recent)  # Snapshots of the latest finished traces
+        self.seq = 0
+        self.counters = collections.Counter()  # e.g. traces, not_understood, voice_commands
+        self.server = None
+
+    def trace(self, start=None, room=None):
+        with self.lock:
+            self.seq += 1
+            self.counters["traces"] += 1
+            return Trace(self, self.seq, start, room)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def device(self, name, seconds, error=None):
+        # One request to a device, with the time it took to reply and the error if it failed
+        with self.lock:
+            device = self.devices.get(name)
+            if device is None:
+                device = self.devices[name] = {"latency": Histogram(), "requests": 0, "errors": 0, "last_error": None}
+            device["latency"].observe(seconds)
+            device["requests"] += 1
+            if error is not None:
+                device["errors"] += 1
+                device["last_error"] = str(error)
+
+    def timed(self, name, func, *args):
+        # Calls func, recording it as a request to the device. Exceptions are counted and re-raised.
+        start = time.monotonic()
+        try:
+            result = func(*args)
+        except Exception as Ex:
+            self.device(name, time.monotonic() - start, Ex)
+            raise
+        self.device(name, time.monotonic() - start)
+        return result
+
+    def completed(self, trace):
+        with self.lock:
+            self.recent.append(trace.snapshot())
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {stage: histogram.snapshot() for stage, histogram in self.stages.items()},
+                "devices": {name: dict(device["latency"].snapshot(), requests=device["requests"],
+                                       errors=device["errors"], last_error=device["last_error"])
+                            for name, device in self.devices.items()},
+                "recent": list(self.recent),
+            }
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append("# TYPE vocalights_stage_latency_ms histogram")
+            for stage, histogram in self.stages.items():
+                lines += self._histogram_lines("vocalights_stage_latency_ms", 'stage="%s"' % stage, histogram)
+            lines.append("# TYPE vocalights_device_latency_ms histogram")
+            for name, device in self.devices.items():
+                lines += self._histogram_lines("vocalights_device_latency_ms", 'device="%s"' % name,
+                                               device["latency"])
+            lines.append("# TYPE vocalights_device_errors_total counter")
+            for name, device in self.devices.items():
+                lines.append('vocalights_device_errors_total{device="%s"} %d' % (name, device["errors"]))
+            for counter, value in sorted(self.counters.items()):
+                lines.append("# TYPE vocalights_%s_total counter" % counter)
+                lines.append("vocalights_%s_total %d" % (counter, value))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram_lines(metric, labels, histogram):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS_MS, histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else str(bound)
+            lines.append('%s_bucket{%s,le="%s"} %d' % (metric, labels, le, cumulative))
+        lines.append("%s_sum{%s} %f" % (metric, labels, histogram.sum))
+        lines.append("%s_count{%s} %d" % (metric, labels, histogram.count))
+        return lines
+
+    def write(self, path):
+        # Written to a temporary file first so a reader never sees half a file
+        with open(path + ".tmp", "w") as file:
+            json.dump(self.snapshot(), file, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def start_writer(self, path, interval=10):
+        def write_periodically():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write(path)
+                except Exception as Ex:
+                    print("Could not write metrics to " + path + ": " + str(Ex))
+
+        threading.Thread(target=write_periodically, name="MetricsWriter", daemon=True).start()
+
+    def serve(self, port=9108, host="127.0.0.1"):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.snapshot()), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Keeps scrapes out of the console
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True).start()
+        return self.server.server_address[1]
@@ -0,0 +1,251 @@
+import collections
+import threading
+import colorsys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+MUSIC_COMMANDS = ("music on", "music off")
+BANDS = 8  # From the bass (red) up to the treble (purple)
+ANY_ROOM = object()  # Music is taken from the first microphone heard
+
+
+def _hue_xy_table(steps=360):
+    # CIE xy of each fully saturated hue, for lights that take xy (PhilipsHue wide gamut, D65)
+    table = []
+    for step in range(steps):
+        rgb = [((c + 0.055) / 1.055) ** 2.4 if c > 0.04045 else c / 12.92
+               for c in colorsys.hsv_to_rgb(step / steps, 1, 1)]
+        x = rgb[0] * 0.664511 + rgb[1] * 0.154324 + rgb[2] * 0.162028
+        y = rgb[0] * 0.283881 + rgb[1] * 0.668433 + rgb[2] * 0.047685
+        z = rgb[0] * 0.000088 + rgb[1] * 0.072310 + rgb[2] * 0.986039
+        table.append([round(x / (x + y + z), 3), round(y / (x + y + z), 3)])
+    return table
+
+
+HUE_XY = _hue_xy_table()
+
+
+def hue_xy(hue):
+    # hue from 0 to 1 -> [x, y]
+    return HUE_XY[int(hue * len(HUE_XY)) % len(HUE_XY)]
+
+
+class AudioRing:
+
+    """
+    The most recent capacity samples of a microphone, written chunk by chunk as they are read and
+    read back as one window without the chunks ever being joined.
+    """
+
+    def __init__(self, capacity):
+        self.samples = np.zeros(capacity, dtype=np.float32)
+        self.position = 0  # Where the next sample goes
+        self.written = 0
+
+    def write(self, chunk):
+        chunk = chunk[-len(self.samples):]
+        end = self.position + len(chunk)
+        if end <= len(self.samples):
+            self.samples[self.position:end] = chunk
+        else:  # Wraps around
+            split = len(self.samples) - self.position
+            self.samples[self.position:] = chunk[:split]
+            self.samples[:end - len(self.samples)] = chunk[split:]
+        self.position = end % len(self.samples)
+        self.written += len(chunk)
+
+    def latest(self, count):
+        start = self.position - count
+        if start >= 0:
+            return self.samples[start:self.position]
+        return np.concatenate((self.samples[start:], self.samples[:self.position]))
+
+
+class MusicAnalyzer:
+
+    """
+    Turns windows of audio into what the lights show: a hue from the band that stands out most (each
+    band compared with its own recent level, so the mix rather than the volume decides), a brightness
+    from how loud the window is between the recent quietest and loudest, and whether it starts a beat.
+
+    Beats are onsets in the spectral flux (how much the spectrum rose since the last window) that stand
+    out from the flux of the last second. Band edges, the window and the bins of each band are worked
+    out once, each window is then one FFT and one matrix product.
+    """
+
+    def __init__(self, sample_rate, fft_size=1024, bands=BANDS, sensitivity=1.0):
+        self.sample_rate = sample_rate
+        self.fft_size = fft_size
+        self.sensitivity = sensitivity  # Standard deviations above the median recent flux a beat has to be
+        self.window = np.hanning(fft_size).astype(np.float32)
+        freqs = np.fft.rfftfreq(fft_size, 1 / sample_rate)
+        edges = np.geomspace(40, min(8000, sample_rate / 2), bands + 1)
+        self.band_bins = ((freqs[:, None] >= edges[None, :-1]) & (freqs[:, None] < edges[None, 1:])).astype(np.float32)
+        self.band_hues = np.linspace(0, 0.8, bands)
+        self.levels = None  # Recent energy of each band
+        self.previous = None  # Log spectrum of the last window
+        self.flux = collections.deque(maxlen=max(8, int(sample_rate / fft_size * 2)))  # About the last second
+        self.quiet, self.loud = None, None  # dB
+        self.last_beat = -1.0
+        self.clock = 0.0  # Seconds of audio analyzed, for spacing beats
+
+    def analyze(self, samples, hop=None):
+        # Returns (hue 0-1, brightness 0-1, beat) for the latest fft_size samples, hop being how many are new
+        self.clock += (hop if hop is not None else self.fft_size) / self.sample_rate
+        spectrum = np.abs(np.fft.rfft(samples * self.window))
+        power = spectrum * spectrum
+        energies = power @ self.band_bins + 1e-9
+
+        self.levels = energies if self.levels is None else 0.9 * self.levels + 0.1 * energies
+        relative = (energies / self.levels) ** 4  # The band that rose the most takes the hue
+        hue = float((relative * self.band_hues).sum() / relative.sum())
+
+        loudness = 10 * np.log10(power.sum() + 1e-9)
+        self.quiet = loudness if self.quiet is None else min(loudness, self.quiet + 0.05)
+        self.loud = loudness if self.loud is None else max(loudness, self.loud - 0.05)
+        brightness = float(np.clip((loudness - self.quiet) / max(self.loud - self.quiet, 6.0), 0, 1))
+
+        log_spectrum = np.log1p(spectrum)
+        flux = float(np.maximum(log_spectrum - self.previous, 0).sum()) if self.previous is not None else 0.0
+        self.previous = log_spectrum
+        beat = bool(len(self.flux) >= 8 and flux > np.median(self.flux) + self.sensitivity * np.std(self.flux)
+                and self.clock - self.last_beat > 0.1)  # At most 10 beats a second
+        self.flux.append(flux)
+        if beat:
+            self.last_beat = self.clock
+            brightness = 1.0
+        return hue, brightness, beat
+
+
+class MusicMode:
+
+    """
+    Sets the lights to the music the microphone hears. The audio is handed over by the capture threads
+    of VoiceCommands.CommandInputs as they read it, so commands are still recognized from the same
+    device meanwhile.
+
+    A thread analyzes the newest fft_size samples each time a chunk arrives and sends the lights a frame
+    at most frame_rate times a second, and straight away on a beat. A light object still sending the
+    last frame is skipped rather than queued, and a frame older than budget seconds (from the end of the
+    audio it was worked out from) is dropped, so the lights never lag further behind the music than
+    that. The time from sound to each light object's reply is kept as the music stage in metrics.
+    """
+
+    def __init__(self, metrics=None, budget=0.1, frame_rate=20, fft_size=1024, min_brightness=0.1, workers=4):
+        self.metrics = metrics
+        self.budget = budget
+        self.frame_rate = frame_rate
+        self.fft_size = fft_size
+        self.min_brightness = min_brightness
+        self.condition = threading.Condition()
+        self.owners = {}  # Light object -> names of its lights playing music
+        self.busy = set()  # Light objects still sending the last frame
+        self.room = ANY_ROOM  # Of the microphone the music is taken from
+        self.ring = None
+        self.analyzer = None
+        self.heard = 0.0  # When the newest chunk was read
+        self.fresh = 0  # Samples read since the last analysis
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="Music")
+        self.thread = None
+
+        # Stats
+        self.frames = 0
+        self.beats = 0
+        self.sent = 0
+        self.skipped = 0  # Frames a light object was still busy for
+        self.late = 0  # Frames dropped or answered over the budget
+
+    def start(self, light_object, names, room=None):
+        with self.condition:
+            self.owners[light_object] = list(dict.fromkeys(self.owners.get(light_object, []) + list(names)))
+            self.room = room.lower() if room is not None else ANY_ROOM
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="MusicMode", daemon=True)
+                self.thread.start()
+
+    def stop(self, light_object, names=None):
+        # Only the named lights when given, the thread stops with the last of them
+        with self.condition:
+            if light_object not in self.owners:
+                return
+            remaining = [name for name in self.owners[light_object] if names and name not in names]
+            if remaining:
+                self.owners[light_object] = remaining
+            else:
+                del self.owners[light_object]
+            self.condition.notify()
+
+    def playing(self, light_object):
+        return self.owners.get(light_object, [])
+
+    def feed(self, room, data, sample_rate, sample_width):
+        # Called by the capture threads with every chunk of 16 bit audio they read
+        if not self.owners or sample_width != 2:
+            return
+        with self.condition:
+            if self.room is ANY_ROOM:
+                self.room = room
+            if room != self.room:
+                return
+            if self.analyzer is None or self.analyzer.sample_rate != sample_rate:
+                self.analyzer = MusicAnalyzer(sample_rate, self.fft_size)
+                self.ring = AudioRing(self.fft_size * 4)
+            chunk = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768
+            self.ring.write(chunk)
+            self.fresh += len(chunk)
+            self.heard = time.monotonic()
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {"playing": [name for names in self.owners.values() for name in names], "frames": self.frames,
+                    "beats": self.beats, "sent": self.sent, "skipped": self.skipped, "late": self.late}
+
+    def _run(self):
+        last_sent = 0.0
+        while True:
+            with self.condition:
+                while self.owners and not self.fresh:
+                    self.condition.wait(0.5)
+                if not self.owners:
+                    self.thread = None
+                    self.room = ANY_ROOM
+                    return
+                window, hop, heard = self.ring.latest(self.fft_size), self.fresh, self.heard
+                self.fresh = 0
+
+            hue, brightness, beat = self.analyzer.analyze(window, hop)
+            now = time.monotonic()
+            late = now - heard > self.budget  # Analysis fell behind, a newer chunk is already on its way
+            with self.condition:
+                self.frames += 1
+                self.beats += beat
+                self.late += late
+            if late or (not beat and now - last_sent < 1 / self.frame_rate):
+                continue
+            last_sent = now
+            brightness = self.min_brightness + (1 - self.min_brightness) * brightness
+            with self.condition:
+                owners = [(owner, names) for owner, names in self.owners.items() if owner not in self.busy]
+                self.skipped += len(self.owners) - len(owners)
+                self.busy.update(owner for owner, names in owners)
+            for owner, names in owners:
+                self.pool.submit(self._send, owner, names, hue, brightness, heard)
+
+    def _send(self, owner, names, hue, brightness, heard):
+        sent = False
+        try:
+            owner.music_frame(names, hue, brightness, 1 / self.frame_rate)
+            sent = True
+        except Exception as Ex:
+            print("Music could not be sent: " + str(Ex))
+        latency = time.monotonic() - heard
+        with self.condition:
+            self.busy.discard(owner)
+            self.sent += sent
+            self.late += latency > self.budget
+        if self.metrics is not None:
+            self.metrics.observe("music", latency)
@@ -0,0 +1,132 @@
+import collections
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+
+    """
+    Allows rate events per second on average, with bursts of up to burst events at once.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self):
+        # Seconds until the next token is available
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class CoalescingLimiter:
+
+    """
+    Puts the writes to one device (a LifX bulb or a Hue bridge) through a token bucket so the device
+    is never sent more than it can handle. A write is sent straight away when there is a token for it
+    and nothing is waiting, otherwise it is queued under its key (e.g. the light and attribute it sets).
+    A newer write for a key that is still queued replaces the older one, which is dropped, so a backlog
+    can never be longer than the number of distinct keys. A write for a key whose last write is still
+    being sent waits for it in the queue, so the latest write for a key is always the last to land.
+    Queued writes are sent as tokens become available, on the worker pool when one is given or else on
+    a thread of the limiter's own, never on the scheduler thread as a device that is slow to answer
+    would hold up every effect.
+    """
+
+    def __init__(self, rate, scheduler, pool=None, burst=None):
+        self.bucket = TokenBucket(rate, burst)
+        self.scheduler = scheduler
+        # The thread is only started once a write is queued, keeping the writes to the device in order
+        self.pool = pool if pool is not None else ThreadPoolExecutor(1, thread_name_prefix="RateLimiter")
+        self.pending = collections.OrderedDict()  # key -> write, oldest first
+        self.sending = set()  # Keys of the writes being sent
+        self.lock = threading.Lock()
+        self.draining = False
+
+        # Stats
+        self.sent = 0
+        self.queued = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def submit(self, key, write):
+        # Returns the write's result when it was sent straight away, None when it was queued
+        with self.lock:
+            if not self.pending and key not in self.sending and self.bucket.take():
+                self.sent += 1
+                self.sending.add(key)
+            else:
+                if key in self.pending:
+                    self.dropped += 1  # Latest wins, the older write would be overwritten anyway
+                self.pending[key] = write
+                self.queued += 1
+                self.max_depth = max(self.max_depth, len(self.pending))
+                self._schedule_drain()
+                return None
+        try:
+            return write()
+        finally:
+            self._sent(key)
+
+    def _schedule_drain(self):
+        if not self.draining:
+            self.draining = True
+            self.scheduler.call_later(self.bucket.wait_time(), self._drain)
+
+    def _drain(self):
+        writes = []
+        with self.lock:
+            self.draining = False
+            for key in list(self.pending):
+                if key in self.sending:
+                    continue  # Drained again once the write before it has been sent
+                if not self.bucket.take():
+                    break
+                writes.append((key, self.pending.pop(key)))
+                self.sending.add(key)
+            self.sent += len(writes)
+            if any(key not in self.sending for key in self.pending):
+                self._schedule_drain()
+
+        for key, write in writes:
+            self.pool.submit(self._write, key, write)
+
+    def _write(self, key, write):
+        try:
+            write()
+        except Exception as Ex:
+            print("Queued write failed: " + str(Ex))
+        finally:
+            self._sent(key)
+
+    def _sent(self, key):
+        with self.lock:
+            self.sending.discard(key)
+            if key in self.pending:
+                self._schedule_drain()
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "sending": len(self.sending),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "queued": self.queued,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,56 @@
+import threading
+import json
+import os
+
+SCENE_COMMANDS = ("save scene", "restore scene")
+
+# Words spoken around a scene's name that are not part of it, e.g. 'save scene as movie for the lights'
+FILLER_WORDS = {"a", "all", "as", "called", "for", "light", "lights", "my", "named", "of", "the", "to"}
+
+
+def scene_name(intent):
+    return " ".join(word for word in intent.remainder if word not in FILLER_WORDS)
+
+
+class SceneStore:
+
+    """
+    Named scenes, saved to a JSON file (~/.vocalights_scenes by default) so they are kept between runs.
+
+    A scene holds an entry for each light object it was saved from, keyed by the object's scene_key.
+    Each entry has the state of its lights by light name (power, color and brightness in the brand's
+    own units) and, for brands that can store scenes themselves, the id of the native scene.
+    """
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path if path is not None else "~/.vocalights_scenes")
+        self.lock = threading.Lock()
+        self.scenes = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as file:
+                    self.scenes = json.load(file)
+            except (OSError, ValueError) as Ex:
+                print("WARNING: Scenes could not be read from " + self.path + ": " + str(Ex))
+
+    def names(self):
+        return list(self.scenes)
+
+    def get(self, name):
+        return self.scenes.get(name)
+
+    def save(self, name, scene):
+        with self.lock:
+            self.scenes[name] = scene
+            self._write()
+
+    def delete(self, name):
+        with self.lock:
+            if self.scenes.pop(name, None) is not None:
+                self._write()
+
+    def _write(self):
+        # Written to a temporary file first so a crash cannot leave half a file behind
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(self.scenes, file, indent=2)
+        os.replace(self.path + ".tmp", self.path)
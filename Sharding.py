@@ -0,0 +1,226 @@
+import multiprocessing
+import threading
+import itertools
+import ipaddress
+
+from concurrent import futures
+
+import CommandMatcher as CM
+
+LIFX_SUBNET = 24  # LifX bulbs on the same /24 share a shard
+COMMAND_TIMEOUT = 5  # Longest wait (in s) for a shard to answer a command, a few device timeouts
+SETUP_TIMEOUT = 30  # Longest wait (in s) for a shard to configure its lights, which connects to them
+
+
+def shard_key(brand, address):
+    # The shard a light belongs to: its Hue bridge, or the subnet of a LifX bulb ("host" or "host:port")
+    if brand == "lifx":
+        host = address.partition(":")[0]
+        return "lifx " + str(ipaddress.ip_network("%s/%d" % (host, LIFX_SUBNET), strict=False))
+    return "phue " + address
+
+
+def serve_shard(conn, key, max_workers, device_file):
+    """
+    Runs in the shard's own process: configures its light objects with their own worker pool, effect
+    scheduler and health, then runs each request (request id, method, args) read from conn on a thread
+    of its own and sends back (request id, True, result) or (request id, False, error).
+    """
+    import VocaLights as V  # Imported here as VocaLights imports this module
+
+    lights = V.Lights(max_workers, device_file=device_file)
+    send_lock = threading.Lock()
+
+    def configure(brand, settings):
+        count = len(lights.light_objects)
+        lights.configure_lights(brand, **settings)
+        if len(lights.light_objects) == count:
+            raise Exception("The " + brand + " lights of " + key + " could not be configured.")
+        obj = lights.light_objects[-1]
+        return {"index": count, "light_names": list(obj.LIGHT_NAMES), "commands": list(obj.matcher.commands),
+                "colors": list(obj.matcher.colors), "scene_key": obj.scene_key}
+
+    def stats():
+        return {"pid": multiprocessing.current_process().pid, "health": lights.health.stats(),
+                "scheduler": lights.scheduler.stats(), "devices": lights.metrics.snapshot()["devices"]}
+
+    handlers = {
+        "ping": lambda: True,
+        "configure": configure,
+        "stats": stats,
+        "process_command": lambda index, words, intent: lights.light_objects[index].process_command(words, intent),
+        "save_scene": lambda index, name, names, previous: lights.light_objects[index].save_scene(name, names,
+                                                                                                  previous),
+        "restore_scene": lambda index, entry, names: lights.light_objects[index].restore_scene(entry, names),
+        "stop_effects": lambda index, names: lights.light_objects[index].stop_effects(names),
+        "music_frame": lambda index, *frame: lights.light_objects[index].music_frame(*frame),
+    }
+
+    def handle(request_id, method, args):
+        try:
+            reply = (request_id, True, handlers[method](*args))
+        except Exception as Ex:
+            reply = (request_id, False, str(Ex))
+        with send_lock:
+            conn.send(reply)
+
+    with futures.ThreadPoolExecutor(max(4, max_workers), thread_name_prefix="Shard") as pool:
+        while True:
+            try:
+                request_id, method, args = conn.recv()
+            except (EOFError, OSError):
+                break  # The front end went away
+            if method == "stop":
+                break
+            pool.submit(handle, request_id, method, args)
+
+
+class Shard:
+
+    """
+    A worker process that owns the light objects of one Hue bridge or LifX subnet, along with their
+    effects, so that a busy part of a large installation (e.g. disco in one room) has a GIL of its own
+    and cannot slow down the commands sent to the others.
+
+    Requests are sent to the process over a pipe and answered in any order, so several commands can be
+    in flight at once. Each is waited on for at most timeout seconds, and configure for at most
+    setup_timeout. The settings of every configure are kept, so a process that died is started again
+    and set up the same way by revive.
+    """
+
+    def __init__(self, key, max_workers=1, device_file=None, timeout=COMMAND_TIMEOUT, setup_timeout=SETUP_TIMEOUT):
+        self.key = key
+        self.max_workers = max_workers
+        self.device_file = device_file
+        self.timeout = timeout
+        self.setup_timeout = setup_timeout
+        self.configs = []  # (brand, settings) of every configure, replayed on revive
+        self.context = multiprocessing.get_context("spawn")  # Threads of this process are not forked along
+        self.lock = threading.Lock()
+        self.pending = {}  # Request id -> Future, of the running process
+        self.ids = itertools.count()
+        self.process = None
+        self.conn = None
+        self.start()
+
+    def start(self):
+        conn, child = self.context.Pipe()
+        self.pending = {}  # Requests sent to a process that died are failed along with it
+        self.process = self.context.Process(target=serve_shard, name="VocaLights " + self.key, daemon=True,
+                                            args=(child, self.key, self.max_workers, self.device_file))
+        self.process.start()
+        child.close()
+        self.conn = conn
+        threading.Thread(target=self._read, args=(conn, self.pending), name="Shard " + self.key, daemon=True).start()
+
+    def call(self, method, *args, timeout=None):
+        # Runs method in the shard's process and returns its result, raising its error
+        timeout = timeout if timeout is not None else self.timeout
+        future = futures.Future()
+        with self.lock:
+            request_id, pending = next(self.ids), self.pending
+            pending[request_id] = future
+            try:
+                self.conn.send((request_id, method, args))
+            except (OSError, ValueError) as Ex:
+                del pending[request_id]
+                raise Exception("Shard " + self.key + " is not running: " + str(Ex))
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            with self.lock:
+                pending.pop(request_id, None)
+            raise Exception("Shard " + self.key + " did not answer within %s s" % timeout)
+
+    def configure(self, brand, settings):
+        description = self.call("configure", brand, settings, timeout=self.setup_timeout)
+        self.configs.append((brand, settings))
+        return description
+
+    def revive(self):
+        # Health probe: starts the process again when it died, then checks it answers
+        if not self.process.is_alive():
+            print(f"Shard {self.key} stopped, starting it again")
+            self.start()
+            for brand, settings in self.configs:
+                self.call("configure", brand, settings, timeout=self.setup_timeout)
+        self.call("ping")
+
+    def stop(self):
+        try:
+            with self.lock:
+                self.conn.send((None, "stop", ()))
+        except (OSError, ValueError):
+            pass
+        self.process.join(5)
+
+    def _read(self, conn, pending):
+        while True:
+            try:
+                request_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = pending.pop(request_id, None)
+            if future is None:
+                continue  # Timed out already
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(Exception(result))
+        with self.lock:  # Every request still waiting would never be answered
+            waiting = list(pending.values())
+            pending.clear()
+        for future in waiting:
+            future.set_exception(Exception("Shard " + self.key + " stopped"))
+        conn.close()
+
+
+class ShardProxy:
+
+    """
+    Stands in for a LifX or PhilipsHue object running in a Shard, so LightAPI sends it commands and
+    scenes as it would a light object in this process and gets the same responses back. While the
+    shard is not answering its lights are reported as not answering straight away.
+    """
+
+    def __init__(self, shard, brand, description, health, scene_key):
+        self.shard = shard
+        self.brand = brand
+        self.index = description["index"]  # Of the light object in the shard's process
+        self.LIGHT_NAMES = description["light_names"]
+        self.matcher = CM.CommandMatcher(description["commands"], self.LIGHT_NAMES, description["colors"])
+        self.health = health
+        self.scene_key = scene_key
+
+    def process_command(self, words, intent=None):
+        try:
+            return self._call("process_command", self.index, words, intent)
+        except Exception as Ex:
+            return {"ERROR": str(Ex), "Class": self.brand}
+
+    def save_scene(self, name, lights, previous=None):
+        try:
+            return self._call("save_scene", self.index, name, lights, previous)
+        except Exception as Ex:
+            return {"ERROR": str(Ex), "Class": self.brand}, None
+
+    def restore_scene(self, entry, lights):
+        try:
+            return self._call("restore_scene", self.index, entry, lights)
+        except Exception as Ex:
+            return {"ERROR": str(Ex), "Class": self.brand}
+
+    def stop_effects(self, names):
+        try:
+            self._call("stop_effects", self.index, names)
+        except Exception as Ex:
+            print("Could not stop the effects of " + self.shard.key + ": " + str(Ex))
+
+    def music_frame(self, names, hue, brightness, duration):
+        self._call("music_frame", self.index, names, hue, brightness, duration)
+
+    def _call(self, method, *args):
+        if not self.health.available(self.shard.key):
+            raise Exception(self.shard.key + ": not answering")
+        return self.health.call(self.shard.key, self.shard.call, method, *args)
@@ -0,0 +1,334 @@
+"""
+Local stand-ins for LifX bulbs and a PhilipsHue bridge, so the whole program can be run and
+benchmarked without any lights. Each simulator listens on a local port and is configured like
+real devices, e.g.
+
+    lifx = Simulators.LifxSimulator(bulbs=50, latency=0.01, loss=0.01)
+    hue = Simulators.HueSimulator(lights=20, latency=0.02)
+    lights.configure_lights("lifx", **lifx.settings())
+    with Simulators.isolated_phue_config():
+        lights.configure_lights("phue", **hue.settings())
+
+phue registers with a bridge it does not know by rewriting the .python_hue file in the home
+directory, which would lose the registration of a real bridge. Configure simulated bridges inside
+isolated_phue_config() so it is written to a temporary directory instead.
+"""
+
+import contextlib
+import threading
+import http.server
+import tempfile
+import heapq
+import random
+import socket
+import json
+import time
+import os
+import re
+
+import lifxlan as lx
+import phue
+
+import RateLimiter as RL
+
+
+@contextlib.contextmanager
+def isolated_phue_config():
+    previous = os.environ.get(phue.USER_HOME)
+    with tempfile.TemporaryDirectory(prefix="VocaLights-") as home:
+        os.environ[phue.USER_HOME] = home
+        try:
+            yield home
+        finally:
+            if previous is None:
+                del os.environ[phue.USER_HOME]
+            else:
+                os.environ[phue.USER_HOME] = previous
+
+
+class LifxSimulator:
+
+    """
+    Answers the LifX LAN protocol that lifxlan speaks (power, color and state requests) for any
+    number of simulated bulbs sharing one local UDP port. A request sent to the broadcast MAC address
+    is answered by every bulb, like a discovery broadcast. Adding a MAC address to unplugged makes
+    that bulb stop answering altogether. Every reply is held back by latency
+    seconds, a request is lost (never answered) with probability loss, and a bulb sent more than
+    rate_limit messages per second drops the extra ones the way a real bulb does.
+    """
+
+    def __init__(self, bulbs=10, latency=0.0, loss=0.0, rate_limit=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.loss = loss
+        self.bulbs = {}  # MAC address -> {"label": str, "power": int, "color": [h, s, b, k], "limiter": TokenBucket}
+        for i in range(bulbs):
+            mac = "d0:73:d5:%02x:%02x:%02x" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+            self.bulbs[mac] = {"label": "bulb %d" % (i + 1), "power": 0, "color": [0, 0, 65535, 3500],
+                               "limiter": RL.TokenBucket(rate_limit, rate_limit) if rate_limit else None}
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.unplugged = set()  # MAC addresses of bulbs that do not answer
+        self.replies = []  # Heap of (due time, sequence, packet, address)
+        self.condition = threading.Condition()
+        self.running = True
+
+        # Stats
+        self.received = 0
+        self.writes = 0  # Power and color changes applied
+        self.lost = 0
+        self.throttled = 0
+
+        threading.Thread(target=self._receive, name="LifxSimulator", daemon=True).start()
+        threading.Thread(target=self._reply, name="LifxSimulatorReplies", daemon=True).start()
+
+    def settings(self, names=None):
+        # configure_lights arguments for every simulated bulb
+        macs = list(self.bulbs)
+        return {"ip_addresses": ["%s:%d" % self.address] * len(macs), "mac_addresses": macs,
+                "light_names": names or [self.bulbs[mac]["label"] for mac in macs]}
+
+    def stats(self):
+        return {"received": self.received, "writes": self.writes, "lost": self.lost, "throttled": self.throttled}
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+        with self.condition:
+            self.condition.notify()
+
+    def _receive(self):
+        while self.running:
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except OSError:
+                return
+            self.received += 1
+            try:
+                message = lx.unpack_lifx_message(data)
+            except Exception:
+                continue
+            if message.target_addr == "00:00:00:00:00:00":  # Broadcasts are answered by every bulb
+                targets = list(self.bulbs.items())
+            else:
+                targets = [(message.target_addr, self.bulbs[message.target_addr])] \
+                    if message.target_addr in self.bulbs else []
+            for mac, bulb in targets:
+                if mac in self.unplugged:
+                    continue
+                if random.random() < self.loss:
+                    self.lost += 1
+                    continue
+                if bulb["limiter"] is not None and not bulb["limiter"].take():
+                    self.throttled += 1
+                    continue
+                for reply in self._handle(message, mac, bulb):
+                    self._send_later(reply, address)
+
+    def _handle(self, message, mac, bulb):
+        source, seq = message.source_id, message.seq_num
+        replies = []
+        if isinstance(message, (lx.LightSetPower, lx.SetPower)):
+            bulb["power"] = message.power_level
+            self.writes += 1
+        elif isinstance(message, lx.LightSetColor):
+            bulb["color"] = list(message.color)
+            self.writes += 1
+        elif isinstance(message, lx.LightGet):
+            replies.append(lx.LightState(mac, source, seq, {"color": bulb["color"], "reserved1": 0,
+                                                            "power_level": bulb["power"], "label": bulb["label"],
+                                                            "reserved2": 0}))
+        elif isinstance(message, lx.LightGetPower):
+            replies.append(lx.LightStatePower(mac, source, seq, {"power_level": bulb["power"]}))
+        elif isinstance(message, lx.GetPower):
+            replies.append(lx.StatePower(mac, source, seq, {"power_level": bulb["power"]}))
+
+        if message.ack_requested:
+            replies.insert(0, lx.Acknowledgement(mac, source, seq))
+        return [reply.packed_message for reply in replies]
+
+    def _send_later(self, packet, address):
+        with self.condition:
+            heapq.heappush(self.replies, (time.monotonic() + self.latency, id(packet), packet, address))
+            self.condition.notify()
+
+    def _reply(self):
+        while self.running:
+            with self.condition:
+                while self.running and (not self.replies or self.replies[0][0] > time.monotonic()):
+                    self.condition.wait(self.replies[0][0] - time.monotonic() if self.replies else None)
+                due = []
+                while self.replies and self.replies[0][0] <= time.monotonic():
+                    due.append(heapq.heappop(self.replies))
+            for _, _, packet, address in due:
+                try:
+                    self.sock.sendto(packet, address)
+                except OSError:
+                    return
+
+
+class HueSimulator:
+
+    """
+    Serves the parts of the PhilipsHue bridge REST API that phue uses (registration, config, lights,
+    groups, group actions and scenes) over HTTP/1.1 keep-alive connections, and at portal the list of
+    bridges by id that the Hue discovery portal would return for it. Every response is held back
+    by latency seconds, a request is lost with probability loss (the connection is dropped
+    without a response) and writes beyond rate_limit per second are refused with the error a
+    busy bridge returns. Like a real bridge, a light that is off refuses color changes, and a light
+    id added to unreachable still accepts commands but is reported as not reachable.
+    """
+
+    USERNAME = "vocalights-simulator"
+
+    def __init__(self, lights=5, latency=0.0, loss=0.0, rate_limit=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.loss = loss
+        self.limiter = RL.TokenBucket(rate_limit, rate_limit) if rate_limit else None
+        self.lock = threading.Lock()
+        self.lights = {str(i + 1): {"name": "hue %d" % (i + 1), "state": {"on": False, "bri": 254, "xy": [0.31, 0.316]}}
+                       for i in range(lights)}
+        self.unreachable = set()  # Light ids the bridge cannot reach
+        self.groups = {}
+        self.scenes = {}
+        self.scene_ids = 0
+        self.bridge_id = "001788FFFE%06X" % random.randrange(1 << 24)
+
+        # Stats
+        self.received = 0
+        self.writes = 0  # Light and group state changes applied
+        self.lost = 0
+        self.throttled = 0
+
+        self.server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.portal = "http://%s:%d/api/nupnp" % self.address
+        threading.Thread(target=self.server.serve_forever, name="HueSimulator", daemon=True).start()
+
+    def settings(self, names=None):
+        # configure_lights arguments for every simulated light
+        ids = [int(lid) for lid in self.lights]
+        return {"ip_addresses": "%s:%d" % self.address, "light_ids": ids,
+                "light_names": names or [self.lights[str(lid)]["name"] for lid in ids]}
+
+    def stats(self):
+        return {"received": self.received, "writes": self.writes, "lost": self.lost, "throttled": self.throttled}
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, body):
+        # Returns the JSON response for a request, or None to drop the connection
+        self.received += 1
+        if random.random() < self.loss:
+            self.lost += 1
+            return None
+        parts = [part for part in path.split("/") if part][2:]  # Without /api/<username>
+        if method == "POST" and path.rstrip("/") == "/api":
+            return [{"success": {"username": self.USERNAME}}]
+        if method == "GET" and path == "/api/nupnp":
+            return [{"id": self.bridge_id.lower(), "internalipaddress": self.address[0], "port": self.address[1]}]
+
+        with self.lock:
+            for lid, light in self.lights.items():
+                light["state"]["reachable"] = lid not in self.unreachable
+            if method == "GET" and parts == ["config"]:
+                return {"name": "Hue Simulator", "bridgeid": self.bridge_id, "apiversion": "1.50.0"}
+            if method == "GET" and parts == ["lights"]:
+                return self.lights
+            if method == "GET" and len(parts) == 2 and parts[0] == "lights":
+                return self.lights.get(parts[1], [self._error(3, path, "resource not available")])
+            if method == "GET" and parts == ["groups"]:
+                return self.groups
+            if method == "POST" and parts == ["groups"]:
+                group_id = str(len(self.groups) + 1)
+                self.groups[group_id] = {"name": body.get("name"), "lights": [str(lid) for lid in body["lights"]],
+                                         "action": {}}
+                return [{"success": {"id": group_id}}]
+            if method == "GET" and parts == ["scenes"]:
+                return self.scenes
+            if method == "POST" and parts == ["scenes"]:
+                self.scene_ids += 1
+                scene_id = "vl%d" % self.scene_ids
+                self.scenes[scene_id] = {"name": body.get("name"), "lights": [str(lid) for lid in body["lights"]],
+                                         "lightstates": body.get("lightstates", {}), "recycle": body.get("recycle")}
+                return [{"success": {"id": scene_id}}]
+            if method == "DELETE" and len(parts) == 2 and parts[0] == "scenes":
+                if self.scenes.pop(parts[1], None) is None:
+                    return [self._error(3, path, "resource, /scenes/%s, not available" % parts[1])]
+                return [{"success": "/scenes/%s deleted" % parts[1]}]
+            if method == "PUT" and len(parts) == 3 and parts[0] in ("lights", "groups"):
+                if self.limiter is not None and not self.limiter.take():
+                    self.throttled += 1
+                    return [self._error(901, path, "Internal error, 503")]
+                self.writes += 1
+                if parts[0] == "lights":
+                    return self._set_state(parts[1], body, "/lights/%s/state" % parts[1])
+                members = list(self.lights) if parts[1] == "0" else self.groups.get(parts[1], {}).get("lights")
+                if members is None:
+                    return [self._error(3, path, "resource, /groups/%s, not available" % parts[1])]
+                if "scene" in body:  # Recalls the state the scene stored for each of its lights in the group
+                    scene = self.scenes.get(body["scene"])
+                    if scene is None:
+                        return [self._error(7, path + "/scene",
+                                            "invalid value, %s, for parameter, scene" % body["scene"])]
+                    for lid, state in scene["lightstates"].items():
+                        if lid in members:
+                            self._set_state(lid, state, None)
+                    return [{"success": {"/groups/%s/action/scene" % parts[1]: body["scene"]}}]
+                for lid in members:
+                    self._set_state(lid, body, None)
+                return [{"success": {"/groups/%s/action/%s" % (parts[1], key): value}} for key, value in body.items()]
+        return [self._error(4, path, "method, %s, not available for resource, %s" % (method, path))]
+
+    def _set_state(self, lid, body, address):
+        light = self.lights.get(lid)
+        if light is None:
+            return [self._error(3, address, "resource, /lights/%s, not available" % lid)]
+        results = []
+        turning_on = body.get("on", light["state"]["on"])
+        for key, value in body.items():
+            if key not in ("on", "transitiontime") and not turning_on:
+                results.append(self._error(201, "%s/%s" % (address, key),
+                                           "parameter, %s, is not modifiable. Device is set to off." % key))
+                continue
+            if key != "transitiontime":
+                light["state"][key] = value
+            results.append({"success": {"%s/%s" % (address, key): value}})
+        return results
+
+    @staticmethod
+    def _error(error_type, address, description):
+        return {"error": {"type": error_type, "address": address, "description": description}}
+
+    def _handler(self):
+        simulator = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keeps connections open like the bridge
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or "null") if length else None
+                response = simulator.handle(self.command, re.sub(r"/+$", "", self.path) or "/", body)
+                if simulator.latency:
+                    time.sleep(simulator.latency)
+                if response is None:
+                    self.close_connection = True
+                    return
+                data = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_PUT = do_POST = do_DELETE = _respond
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
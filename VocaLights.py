@@ -1,11 +1,30 @@
 import VoiceCommands as VC  # Module for retrieving voice input and giving output
+import CommandMatcher as CM  # Module for parsing spoken words into light commands
+import EffectScheduler as ES  # Module for running the looped light effects
+import DeviceState as DS  # Module for remembering what was last sent to the lights
+import RateLimiter as RL  # Module for keeping the lights from being sent more than they can handle
+import Metrics as MX  # Module for timing each stage of a command and each device's reply
+import CommandIngress as CI  # Module for taking commands from files and other programs
+import EffectTimelines as ET  # Module for computing the frames of the color effects
+import Scenes as SC  # Module for saving the state of the lights under a name
+import Discovery as DC  # Module for finding the lights on the network and remembering them
+import DeviceHealth as DH  # Module for skipping lights that stop answering
+import VoiceGate as VG  # Module for dropping noise and background talk before it is recognized
+import CommandPlans as CP  # Module for compiling the command tables of each brand ahead of time
+import Sharding as SH  # Module for running the lights of each bridge or subnet in a process of their own
+import MusicMode as MM  # Module for setting the lights to the music the microphone hears
 import lifxlan as lx
 import phue
+import http.client
+import socket
+import queue
+import json
+import itertools
 import time
 import sys
-import re
 
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 
 LIFX_BRAND = "lifx"
 PHUE_BRAND = "phue"
@@ -47,6 +66,21 @@ DEFAULTS = {
         }
     }
 
+# Most commands per second each LifX bulb and each Hue bridge can be sent before they start dropping them
+RATE_LIMITS = {
+    LIFX_BRAND: 20,
+    PHUE_BRAND: 10,
+    }
+HUE_GROUP_RATE = 1  # Group actions per second a Hue bridge can apply, on top of its rate_limit
+GROUP = "group"  # Stands for a Hue group action where a light id would be
+
+# Longest wait (in s) for a LifX bulb or a Hue bridge to answer a command before it counts as a failure
+TIMEOUTS = {
+    LIFX_BRAND: 0.5,
+    PHUE_BRAND: 2,
+    }
+SEND_WORKERS = 16  # Most effect frames a light object sends at once, at most one for each of its lights
+
 SPEECH_RESPONSES = {
     "turn on": "turning on",
     "turn off": "turning off",
@@ -61,8 +95,82 @@ SPEECH_RESPONSES = {
     "flicker off": "stopping flicker",
     "flash on": "activating flash",
     "flash off": "stopping flash",
+    "save scene": "saving scene",
+    "restore scene": "restoring scene",
+    "music on": "playing music on",
+    "music off": "stopping music on",
     }
 
+# Words spoken around the commands, light names and colors, for recognizers that are limited to a grammar
+GRAMMAR_WORDS = ["exit voice", "lights", "light", "all", "the", "to", "of", "at", "percent", "please"]
+
+
+def fan_out(pool, func, items):
+    """
+    Calls func on every item, concurrently when a worker pool is given, and returns
+    the results in the same order as the items. The first exception raised is re-raised.
+    """
+    if pool is None or len(items) < 2:
+        return [func(item) for item in items]
+    return list(pool.map(func, items))
+
+
+class PooledBridge(phue.Bridge):
+
+    """
+    A phue.Bridge that sends every request over a small pool of keep-alive HTTP connections
+    instead of opening and closing a new connection for each one. Connections beyond pool_size
+    are opened as needed when many requests are sent at once and closed afterwards.
+    """
+
+    def __init__(self, ip=None, username=None, config_file_path=None, pool_size=4, timeout=10):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connections = queue.LifoQueue()  # Most recently used first, it is the least likely to be stale
+        super().__init__(ip, username, config_file_path)
+
+    def request(self, mode='GET', address=None, data=None):
+        body = json.dumps(data) if mode in ("PUT", "POST") else None
+        try:
+            connection, reused = self.connections.get_nowait(), True
+        except queue.Empty:
+            connection, reused = http.client.HTTPConnection(self.ip, timeout=self.timeout), False
+
+        try:
+            try:
+                connection.request(mode, address, body)
+                response = connection.getresponse().read()
+            except socket.timeout:
+                raise
+            except (http.client.HTTPException, OSError):
+                if not reused:
+                    raise
+                connection.close()  # The bridge closed an idle connection, retry once on a fresh one
+                connection = http.client.HTTPConnection(self.ip, timeout=self.timeout)
+                connection.request(mode, address, body)
+                response = connection.getresponse().read()
+        except socket.timeout:
+            connection.close()
+            raise phue.PhueRequestTimeout(None, "{} Request to {}{} timed out.".format(mode, self.ip, address))
+        except Exception:
+            connection.close()
+            raise
+
+        if self.connections.qsize() < self.pool_size:
+            self.connections.put(connection)
+        else:
+            connection.close()
+        return json.loads(response.decode('utf-8'))
+
+    def move(self, ip):
+        # Follows the bridge to a new address, the connections kept open to the old one are closed
+        self.ip = ip
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except queue.Empty:
+                break
+
 
 class Lights:
 
@@ -123,15 +231,113 @@ class Lights:
 
     - flicker_rate: Similar to flash except without smooth transition and at a faster rate (in s).
         * Subtype Integer. Must be either a list/tuple or single integer (decimal)
+
+    - rapid: Unique to LifX. Send commands as unacknowledged packets to all targeted bulbs in one burst
+             over a single shared socket instead of waiting on each bulb in turn. The state of the bulbs
+             is only confirmed (and re-sent if it was lost) every confirm_interval seconds.
+        * Subtype Boolean. Defaults to False
+
+    - confirm_interval: How often (in s), while commands are being sent, the lights are read back to confirm
+                        the state remembered for them. Commands that would not change that state are not sent.
+        * Subtype Integer. Defaults to 5
+
+    - rate_limit: The most commands per second sent to each LifX bulb or to each PhilipsHue bridge. Commands
+                  beyond the limit are queued, and a queued command is replaced by a newer one for the same
+                  light and attribute. Defaults to the limits in RATE_LIMITS above.
+        * Subtype Integer
+
+    - startup: How the lights are set to their default color and brightness when they are configured.
+               'serial' connects to one light after another, 'parallel' connects to all of them at once and
+               'lazy' waits until a light is first sent a command. Either way each light is sent its defaults
+               in a single command, and a light that cannot be reached is retried the next time it is used
+               rather than holding up the others. The time each light took is kept in init_times.
+        * Subtype String. Defaults to 'serial'
+
+    - group_actions: Unique to PhilipsHue. When a command targets every configured light on the bridge,
+                     send it once to a bridge group of those lights rather than once per light.
+                     The group is looked up or created on the bridge the first time it is needed.
+                     The bridge applies about one group action a second, commands over that are
+                     sent to each light instead.
+        * Subtype Boolean. Defaults to True
+
+    - effect_frames: How many frames colorama sends per color. Each frame is sent with a transition lasting
+                     until the next one so the lights fade between them on their own. PhilipsHue sends fewer
+                     when more would go over the bridge's rate_limit.
+        * Subtype Integer. Defaults to 4
+
+    - effect_easing: How colorama eases from one color to the next: 'linear', 'ease-in-out', 'ease-in' or 'ease-out'
+        * Subtype String. Defaults to 'ease-in-out'
+
+    - effect_spread: The fraction of a colorama or disco cycle spread across the lights, so that they show
+                     different colors at once. 0 keeps every light on the same color.
+        * Subtype Float. Defaults to 0
+
+    - discover: Find the lights on the network instead of listing them. LifX bulbs are found with a broadcast
+                and PhilipsHue lights are listed by their bridge (ip_addresses is then only the bridge, and can
+                be left out once a bridge has been found). The lights found are saved to device_file and loaded
+                from it on the next start without waiting on the network. light_names picks which of them to use.
+        * Subtype Boolean. Defaults to False
+
+    - discover_interval: How often (in s) discovered lights are looked for again in the background. Bulbs given a
+                         new address are followed to it and the saved lights are brought up to date. A PhilipsHue
+                         bridge that stops answering is looked up by its id on the Hue portal and followed as well.
+        * Subtype Integer. Defaults to 300
+
+    - timeout: The longest (in s) a LifX bulb or a PhilipsHue bridge is waited on for each command. A light that
+               fails to answer 3 times in a row is skipped (and reported as an ERROR for that light) until a
+               check in the background finds it answering again, so it cannot hold up the other lights or
+               their effects. Defaults to the values in TIMEOUTS above, the state of each light is in health.
+        * Subtype Float
+
+    - shard: Run the lights in worker processes of their own, one for each PhilipsHue bridge and one for each
+             /24 subnet of LifX bulbs, each with its own effects, so that a busy bridge or room cannot slow
+             down the commands sent to the others. Commands reach them over a pipe and are answered in the
+             usual format, a process that stops answering is reported like a light and started again.
+             Scripts that shard must configure the lights under `if __name__ == "__main__":`.
+        * Subtype Boolean. Defaults to False
+
+    The max_workers parameter given when creating the Lights object sets how many bulbs can be sent
+    a command at the same time. The default of 1 sends to each bulb and brand one after another.
+    Effects are sent to every light at once whatever it is set to, up to SEND_WORKERS per light object.
+    Scenes saved with 'save scene <name>' are kept in scene_file (~/.vocalights_scenes by default).
+    Discovered lights are kept in device_file (~/.vocalights_devices by default).
+
+    Lights can be grouped into rooms with configure_room. A command heard by a room's microphone, or
+    sent for a room, that names no light goes to the lights of that room instead of every light.
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=1, scene_file=None, device_file=None):
         self.light_objects = []
-
-    def configure_lights(self, brand, ip_addresses, light_names=None, light_ids=None, mac_addresses=None,
+        self.max_workers = max_workers
+        # Shared by all light objects to send a command to their bulbs concurrently
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="VocaLights") if max_workers > 1 else None
+        self.scheduler = ES.EffectScheduler()  # Runs the effects of every light from one thread
+        self.metrics = MX.Metrics()  # Stage latencies and device replies, see Metrics.snapshot
+        self.timelines = ET.TimelineCache()  # Frames of the color effects, shared by all light objects
+        self.scenes = SC.SceneStore(scene_file)
+        self.discovery = DC.DiscoveryCache(device_file)  # Lights found on the network, see discover below
+        self.health = DH.DeviceHealth(metrics=self.metrics)  # Circuit breakers of every light and bridge
+        self.shards = {}  # Bridge or LifX subnet -> SH.Shard, see shard below
+        self.rooms = {}  # Room -> {"lights": light names, "microphone": see configure_room}
+        self.music = None  # MM.MusicMode, set up by Activation as it needs the microphone
+
+    def configure_lights(self, brand, ip_addresses=None, light_names=None, light_ids=None, mac_addresses=None,
                          default_colors=None, default_brightness=None, max_brightness=None, min_brightness=None,
                          brightness_rate=None, color_rate=None, flash_rate=None, colorama_rate=None,
-                         disco_rate=None, flicker_rate=None):
+                         disco_rate=None, flicker_rate=None, rapid=False, confirm_interval=5, rate_limit=None,
+                         startup="serial", group_actions=True, effect_frames=4, effect_easing="ease-in-out",
+                         effect_spread=0.0, discover=False, discover_interval=300, timeout=None, shard=False):
+
+        if discover:
+            try:
+                ip_addresses, light_names, light_ids, mac_addresses = self.discovered(brand, ip_addresses,
+                                                                                      light_names)
+            except Exception as Ex:
+                print("Lights could not be discovered: " + str(Ex))
+                return
+            if not light_names:
+                print("WARNING: No " + brand + " lights were found on the network.")
+                return
 
         if len([light_names]) != len([ip_addresses]):
             print("WARNING: Number of lights and addresses do not match which may affect processing speed of requests.")
@@ -165,6 +371,18 @@ class Lights:
                 settings[key] = settings[key] * len(settings["light_names"])
 
         params = list(settings.values())
+        rate_limit = rate_limit if rate_limit is not None else RATE_LIMITS.get(brand)
+        timeout = timeout if timeout is not None else TIMEOUTS.get(brand)
+
+        if shard:
+            self.configure_shards(brand, settings, {
+                "rapid": rapid, "confirm_interval": confirm_interval, "rate_limit": rate_limit, "startup": startup,
+                "group_actions": group_actions, "effect_frames": effect_frames, "effect_easing": effect_easing,
+                "effect_spread": effect_spread, "discover": discover, "discover_interval": discover_interval,
+                "timeout": timeout})
+            return
+        effects = {"timelines": self.timelines, "effect_frames": effect_frames, "effect_easing": effect_easing,
+                   "effect_spread": effect_spread}
 
         if brand == "lifx":
             try:
@@ -172,8 +390,12 @@ class Lights:
                     raise Exception("Insufficient parameters passed for 'mac_addresses'. "
                                     "Make sure MAC addresses are included for all lights.")
 
-                lifx = self.LifX(*params)
+                lifx = self.LifX(*params, pool=self.pool, scheduler=self.scheduler, metrics=self.metrics,
+                                 health=self.health, timeout=timeout, rapid=rapid, confirm_interval=confirm_interval,
+                                 rate_limit=rate_limit, startup=startup, **effects)
                 self.light_objects.append(lifx)
+                if discover:
+                    self.watch(lifx, discover_interval)
             except Exception as Ex:
                 print("Connection to LifX could not be established: " + str(Ex))
         if brand == "phue":
@@ -182,11 +404,108 @@ class Lights:
                     raise Exception("Insufficient parameters passed for 'light_ids'. "
                                     "Make sure each light has it's associated id assigned.")
 
-                philips = self.PhilipsHue(*params)
+                philips = self.PhilipsHue(*params, pool=self.pool, scheduler=self.scheduler, metrics=self.metrics,
+                                          health=self.health, timeout=timeout, confirm_interval=confirm_interval,
+                                          rate_limit=rate_limit, startup=startup, group_actions=group_actions,
+                                          **effects)
                 self.light_objects.append(philips)
+                if discover:
+                    self.watch(philips, discover_interval)
             except Exception as Ex:
                 print("Connection to phue could not be established: " + str(Ex))
 
+    def configure_room(self, name, light_names, microphone=None):
+        # microphone is the index of an input device, part of its name or VC.DEFAULT_MICROPHONE. Rooms
+        # without one can still be sent commands, e.g. over HTTP.
+        light_names = [light_names] if isinstance(light_names, str) else list(light_names)
+        self.rooms[name.lower()] = {"lights": light_names, "microphone": microphone}
+
+    def microphones(self):
+        # Room -> microphone of the rooms that have one, None to listen to the default microphone alone
+        microphones = {room: settings["microphone"] for room, settings in self.rooms.items()
+                       if settings["microphone"] is not None}
+        return microphones or None
+
+    def configure_shards(self, brand, settings, options):
+        # The lights are split up by bridge or LifX subnet, each part configured in the process of its shard
+        try:
+            parts = {}
+            for i, address in enumerate(settings["ip_addresses"]):
+                parts.setdefault(SH.shard_key(brand, address), []).append(i)
+        except Exception as Ex:
+            print("Lights could not be sharded: " + str(Ex))
+            return
+
+        for key, lights in parts.items():
+            if key not in self.shards:
+                self.shards[key] = SH.Shard(key, self.max_workers, self.discovery.path)
+                self.health.register(key, self.shards[key].revive)  # Started again if it died
+            part = {setting: [values[i] for i in lights] for setting, values in settings.items()}
+            try:
+                description = self.shards[key].configure(brand, dict(part, **options))
+            except Exception as Ex:
+                print("Connection to " + key + " could not be established: " + str(Ex))
+                continue
+            self.light_objects.append(SH.ShardProxy(self.shards[key], brand, description, self.health,
+                                                    description["scene_key"]))
+
+    def health_stats(self):
+        # The breakers of the lights and bridges of this process and of every shard, as in DeviceHealth.stats
+        stats = self.health.stats()
+        for key, shard in self.shards.items():
+            if self.health.state(key) != DH.CLOSED:
+                continue  # Already listed as not answering
+            try:
+                health = self.health.call(key, shard.call, "stats")["health"]
+            except Exception as Ex:
+                print("Could not read the health of " + key + ": " + str(Ex))
+                continue
+            stats["skipped"] += health["skipped"]
+            stats["devices"].update(health["devices"])
+        return stats
+
+    def shard_stats(self):
+        # Process id, effects and device replies of each shard
+        stats = {}
+        for key, shard in self.shards.items():
+            try:
+                stats[key] = dict(shard.call("stats"), state=self.health.state(key))
+            except Exception as Ex:
+                stats[key] = {"state": self.health.state(key), "error": str(Ex)}
+        return stats
+
+    def discovered(self, brand, ip_addresses, light_names):
+        # The lights as they were last found, only waiting on the network when none have been found before
+        names = [light_names] if isinstance(light_names, str) else light_names
+        if brand == LIFX_BRAND:
+            ips, found_names, macs = self.discovery.lifx(names)
+            if not macs:
+                self.discovery.refresh_lifx()
+                ips, found_names, macs = self.discovery.lifx(names)
+            return ips, found_names, None, macs
+
+        bridge = ip_addresses[0] if isinstance(ip_addresses, (tuple, list)) else ip_addresses
+        bridge = bridge or next(iter(self.discovery.bridges()), None)
+        if bridge is None:
+            raise Exception("The ip address of the PhilipsHue bridge is needed to find its lights.")
+        ids, found_names = self.discovery.hue(bridge, names)
+        if not ids:
+            self.discovery.refresh_hue(bridge, PooledBridge(bridge))
+            ids, found_names = self.discovery.hue(bridge, names)
+        return bridge, found_names, ids, None
+
+    def watch(self, light_object, interval):
+        # Looks for the lights again in the background, starting straight away to check what was loaded
+        def rediscover():
+            while True:
+                try:
+                    light_object.rediscover(self.discovery)
+                except Exception as Ex:
+                    print("Could not look for the lights again: " + str(Ex))
+                time.sleep(interval)
+
+        Thread(target=rediscover, name="Discovery", daemon=True).start()
+
     class LightAPI:
 
         """
@@ -195,41 +514,151 @@ class Lights:
 
         The class takes in the subclasses (e.g. LifX, PhilipsHue) configured
         by the user and stores them in a dictionary where they can be run
-        together once all other requests have been completed.
+        together once all other requests have been completed. When max_workers
+        is above 1 the requested brands are sent the command at the same time.
+
+        Scenes are saved and restored here for every brand at once: 'save scene movie'
+        saves the state of the lights (or only the ones named) as 'movie' in the scene
+        store, and 'restore scene movie' sets them back to it.
+
+        Commands given for a room (see Lights.configure_room) that name no light are sent
+        to the lights of the room.
+
+        'music on' sets the lights (or only the ones named) to the music the microphone hears
+        until 'music off', or until they are sent any other command.
         """
 
-        def __init__(self, light_objects):
+        def __init__(self, light_objects, max_workers=1, scenes=None, rooms=None, music=None):
             self.light_names = {}
+            self.light_owners = {}  # Light name -> light objects that own a light of that name
             self.light_objects = light_objects
+            colors = []
             for obj in self.light_objects:
-                self.light_names[obj] = GlobalOps(obj).get_light_names()
-
-        def run_commands(self, words):
+                self.light_names[obj] = obj.LIGHT_NAMES
+                for name in self.light_names[obj]:
+                    self.light_owners.setdefault(name, []).append(obj)
+                colors += [color for color in obj.matcher.colors if color not in colors]
+
+            self.matcher = CM.CommandMatcher(SPEECH_RESPONSES, self.light_owners, colors)
+            self.scenes = scenes if scenes is not None else SC.SceneStore()
+            self.music = music
+            self.rooms = {}  # Room -> the names of its lights that are configured
+            configured = {name.lower(): name for name in self.light_owners}  # Rooms can name lights in any case
+            for room, settings in (rooms or {}).items():
+                self.rooms[room] = [configured[name.lower()] for name in settings["lights"]
+                                    if name.lower() in configured]
+                if len(self.rooms[room]) < len(settings["lights"]):
+                    print("WARNING: Some lights of the " + room + " have not been configured: " +
+                          ", ".join(name for name in settings["lights"] if name.lower() not in configured))
+
+            # Kept apart from the bulb pool so brands waiting on their bulbs cannot starve it
+            workers = min(max_workers, len(self.light_objects))
+            self.pool = ThreadPoolExecutor(workers, thread_name_prefix="LightAPI") if workers > 1 else None
+
+        def run_commands(self, words, trace=None, room=None):
             words = words.lower()  # Consistency across commands
+            intent = self.matcher.match(words)
+            if not intent.lights and room is not None and self.rooms.get(room.lower()):
+                intent.lights = list(self.rooms[room.lower()])  # The lights of the room it was said in
+            if trace is not None:
+                trace.lap("match")
             requested_lights = []
             # Look for any light mentioned by name
-            for obj in self.light_objects:
-                for name in self.light_names[obj]:
-                    if name in words:
+            for name in intent.lights:
+                for obj in self.light_owners[name]:
+                    if obj not in requested_lights:
                         requested_lights.append(obj)
 
             if len(requested_lights) == 0:  # If not light specified, default to all lights
                 requested_lights = self.light_objects
 
-            responses = []
-            for obj in requested_lights:
-                response = obj.process_command(words)
-                responses.append(response)
+            if self.music is not None and intent.command not in (None, "save scene", "music on"):
+                for obj in requested_lights:  # Any other command takes the lights out of music mode
+                    self.music.stop(obj, intent.lights)
 
-            return responses
+            if intent.command in SC.SCENE_COMMANDS:
+                response = self.run_scene(intent, requested_lights)
+            elif intent.command in MM.MUSIC_COMMANDS:
+                response = self.run_music(intent, requested_lights, room)
+            else:
+                response = []  # A light object answers with a list when some of its lights could not be reached
+                for result in fan_out(self.pool, lambda obj: obj.process_command(words, intent), requested_lights):
+                    response += result if isinstance(result, list) else [result]
+            if trace is not None:
+                trace.lap("dispatch")  # Includes waiting on every device that was sent the command
+            return response
+
+        def phrase_key(self, words):
+            # What a command would do, so different transcripts of it ('turn on the lights', 'turn on light')
+            # are recognized as the same command. Words that are not a command are compared as they are.
+            intent = self.matcher.match(words.lower())
+            if intent.command is None:
+                return " ".join(intent.words.split())
+            return intent.command, tuple(sorted(intent.lights)), intent.color, intent.percent, SC.scene_name(intent)
+
+        def run_scene(self, intent, requested_lights):
+            name = SC.scene_name(intent)
+            if not name:
+                return [{"INFO": "Scenes need a name, e.g. '" + intent.command + " movie'.", "Class": "scenes"}]
+            scene = self.scenes.get(name)
+
+            if intent.command == "save scene":
+                scene = dict(scene or {})  # Saving some of the lights keeps what was saved for the others
+                saved = fan_out(self.pool, lambda obj: obj.save_scene(name, intent.lights, scene.get(obj.scene_key)),
+                                requested_lights)
+                scene.update((obj.scene_key, entry) for obj, (response, entry) in zip(requested_lights, saved)
+                             if entry is not None)
+                self.scenes.save(name, scene)
+                return [response for response, entry in saved]
+
+            if scene is None:
+                return [{"INFO": "Scene '" + name + "' does not exist.", "Class": "scenes"}]
+            requested_lights = [obj for obj in requested_lights if obj.scene_key in scene]
+            return fan_out(self.pool, lambda obj: obj.restore_scene(scene[obj.scene_key], intent.lights),
+                           requested_lights)
+
+        def run_music(self, intent, requested_lights, room=None):
+            if self.music is None:
+                return [{"INFO": "Music needs the microphone of a voice assistant.", "Class": "music"}]
+            response = []
+            for obj in requested_lights:
+                names = [name for name in intent.lights if name in self.light_names[obj]] or self.light_names[obj]
+                if intent.command == "music on":
+                    obj.stop_effects(names)  # Music replaces whatever effect the lights were running
+                    self.music.start(obj, names, room)
+                else:
+                    self.music.stop(obj, intent.lights)
+                response.append({"SUCCESS": {intent.command: names}, "Class": "music"})
+            return response
+
+        def grammar(self):
+            # Every phrase any of the configured lights understands, for set_grammar on the voice input
+            phrases = list(GRAMMAR_WORDS) + self.scenes.names()
+            for matcher in [self.matcher] + [obj.matcher for obj in self.light_objects]:
+                for phrase in matcher.commands + matcher.light_names + matcher.colors:
+                    if phrase not in phrases:
+                        phrases.append(phrase)
+            return phrases
 
     class LifX:
 
         def __init__(self, ip_addresses, light_names, mac_addresses, default_colors, default_brightness,
                      max_brightness, min_brightness, brightness_rate, color_rate,
-                     flash_rate, colorama_rate, disco_rate, flicker_rate):
+                     flash_rate, colorama_rate, disco_rate, flicker_rate, pool=None, scheduler=None, metrics=None,
+                     health=None, timeout=TIMEOUTS[LIFX_BRAND], rapid=False, confirm_interval=5,
+                     rate_limit=RATE_LIMITS[LIFX_BRAND], startup="serial", timelines=None, effect_frames=4,
+                     effect_easing="ease-in-out", effect_spread=0.0):
 
             self.LIGHT_NAMES = light_names
+            self.pool = pool
+            self.scheduler = scheduler if scheduler is not None else ES.EffectScheduler()
+            self.metrics = metrics if metrics is not None else MX.Metrics()  # Replies are recorded per light name
+            self.health = health if health is not None else DH.DeviceHealth(metrics=self.metrics)
+            self.timeout = timeout
+            self.timelines = timelines if timelines is not None else ET.TimelineCache()
+            self.effect_frames = effect_frames
+            self.effect_easing = effect_easing
+            self.effect_spread = effect_spread
 
             # Color values according to lifxlan.Light module specifications
             self.LX_COLORS = {"red": [65535, 65535, 65535, 3500], "orange": [6500, 65535, 65535, 3500],
@@ -261,96 +690,350 @@ class Lights:
                 "flicker off": {"set_power": [False, "flicker"]},
             }
 
+            self.matcher = CM.CommandMatcher(self.LX_COMMANDS, self.LIGHT_NAMES, self.LX_COLORS)
+            self.plans = CP.compile_lifx(self.LX_COMMANDS)  # What each command sends, worked out once
+            self.ops = GlobalOps(self)
+
             self.lights = {}  # Stores lx.Light objects
-            self.lightThreads = {}  # For purposes of multi-threading functions
-            self.threadVars = {}  # Dynamic True/False values to trigger threaded function
+            # Saved scenes keep the bulbs of each LifX object apart by their MAC addresses, as each bridge's lights
+            self.scene_key = LIFX_BRAND + " " + ",".join(sorted(mac.lower() for mac in mac_addresses))
+
+            # Power level and HSBK color last sent to each light, read back every confirm_interval seconds
+            self.LX_ATTRIBUTES = {"set_power": "power", "set_color": "color"}
+            self.shadow = DS.ShadowState()
+            self.confirm_interval = confirm_interval
+            self.last_confirm = time.time()
+            self.confirming = False
+            self.transitions = {}  # When the last transition sent to each light is done
+
+            # Rapid mode sends unacknowledged packets and relies on the confirmation to re-send lost ones
+            self.rapid = rapid
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if rapid else None
+            self.seq_nums = itertools.count(1)  # Taken by the pool and the effect thread at once, next() is atomic
+
+            self.limiters = {}  # Keeps each bulb under rate_limit commands per second
+            # Effect frames are sent here rather than on the scheduler thread, see GlobalOps.send_frame
+            self.senders = ThreadPoolExecutor(min(SEND_WORKERS, len(light_names)), thread_name_prefix="LifX")
+            self.sending = set()  # Lights whose last frame is still being sent
+            self.send_lock = Lock()
+            self.default_colors = {}  # Default color with the default brightness, sent when a light is connected
+            self.ready = set()  # Lights that have been sent their defaults
+            self.init_times = {}
+            self.init_errors = {}
 
             for i, name in enumerate(light_names):
-                self.lights[name] = lx.Light(mac_addresses[i], ip_addresses[i])  # Set the Light objects
-                self.lights[name].set_color(getattr(lx, default_colors[i].upper()))  # Set the default color
-                self.lights[name].set_brightness(default_brightness[i])  # Set the default brightness
-
-        def process_command(self, words):
-            args = []
-            light_name = None
-            for name in self.LIGHT_NAMES:
-                if name in words:
-                    light_name = name
-                    break
+                self.limiters[name] = RL.CoalescingLimiter(rate_limit, self.scheduler, self.pool)
+                host, _, port = ip_addresses[i].partition(":")  # A port is only given for forwarded or simulated bulbs
+                self.lights[name] = lx.Light(mac_addresses[i], host, port=int(port or 56700))  # Set the Light objects
+                color = list(getattr(lx, default_colors[i].upper()))
+                self.default_colors[name] = color[:2] + [default_brightness[i]] + color[3:]
+                self.health.register(name, self.lights[name].get_power)  # Probe for a bulb that stopped answering
+
+            if startup != "lazy":
+                self.ops.connect_lights(self.LIGHT_NAMES, parallel=startup == "parallel")
+
+        def connect_light(self, name):
+            # Default color and brightness at once
+            self.metrics.timed(name, self.request, name, "set_color", self.default_colors[name], 0)
+            self.shadow.update([name], "color", self.default_colors[name])
+
+        def process_command(self, words, intent=None):
+            if intent is None:
+                intent = self.matcher.match(words)
+
+            plan = self.plans.get(intent.command)
+            if plan is None:
+                return {"INFO": "Voice command '" + str(words) + "' does not exist.", "Class": LIFX_BRAND}
 
             # If no light name was specified, default to all lights
-            if light_name:
-                lx_names = [light_name]
-            else:
-                lx_names = self.LIGHT_NAMES
+            lx_names = [name for name in intent.lights if name in self.lights] or self.LIGHT_NAMES
 
-            args.append(lx_names)
+            try:
+                errors = {}
+                if plan.kind == CP.START:  # Replaces any effect already running on the lights
+                    self.run_effect(lx_names, plan)
+                elif plan.kind == CP.STOP:
+                    self.scheduler.stop(self, lx_names, plan.effect)
+                else:  # Power, color or brightness (dimmed or raised to the default level without a percent)
+                    value = plan.bind(intent)
+                    if value is not None:
+                        errors = self.execute_command(lx_names, plan.method, value, plan.duration)
+                return self.ops.responses(plan.command, lx_names, errors, LIFX_BRAND)
+            except Exception as Ex:
+                return {"ERROR": str(Ex), "Class": LIFX_BRAND}
 
+        def execute_command(self, lx_names, method, value, duration=0):
+            # Returns {light name: error} for the lights that were skipped or did not answer
+            ready = self.ops.ready_lights(lx_names)
+            errors = {name: "not answering" for name in lx_names if name not in ready}
+            targets = {}  # Light name -> (method, value) for the lights the command would change
+            for name in ready:
+                if not self.health.available(name):
+                    errors[name] = "not answering"
+                    continue
+                sent, target = self.resolve_write(name, method, value)
+                if sent == "set_brightness" or self.shadow.changes([name], self.LX_ATTRIBUTES[sent], target):
+                    targets[name] = (sent, target)
+
+            def write(name):
+                try:
+                    self.limiters[name].submit(self.LX_ATTRIBUTES.get(targets[name][0], "color"),
+                                               lambda: self.send(name, *targets[name], duration))
+                except Exception:
+                    errors[name] = "not answering"  # Recorded in health and metrics by send
+
+            if self.rapid:
+                self.send_burst(targets, duration)
+            else:
+                fan_out(self.pool, write, list(targets))
+            self.confirm_due()
+            return errors
+
+        def confirm_due(self):
+            if not self.confirming and time.time() - self.last_confirm >= self.confirm_interval:
+                self.confirming = True
+                Thread(target=self.confirm_state, daemon=True).start()
+
+        def resolve_write(self, name, method, value):
+            # Turns a command into the power level or full color the light should end up with
+            if method == "set_power":
+                return method, 65535 if value in (True, 1, "on", 65535) else 0
+            if method == "set_brightness":
+                # Rapid mode has no way to read the color, so an unconfirmed one is better than none
+                color = self.shadow.get(name, "color", stale=self.rapid)
+                if color is None:
+                    return method, value  # Left to lifxlan which reads the color first
+                return "set_color", color[:2] + [value] + color[3:]
+            return method, list(value)
+
+        def send(self, name, method, value, duration):
+            self.health.call(name, self.metrics.timed, name, self.request, name, method, value, duration)
+            self.remember(name, method, value, duration)
+
+        def request(self, name, method, value, duration):
+            # Power and color are waited on for at most timeout seconds, sent twice in case the first is lost
+            if method == "set_brightness":  # lifxlan reads the color first, with its own timeouts
+                self.lights[name].set_brightness(value, duration)
+                return
+            self.lights[name].req_with_ack(*self.message(method, value, duration), timeout_secs=self.timeout / 2,
+                                           max_attempts=2)
+
+        def message(self, method, value, duration):
+            if method == "set_power":
+                return lx.LightSetPower, {"power_level": value, "duration": duration}
+            return lx.LightSetColor, {"color": value, "duration": duration}
+
+        def send_burst(self, targets, duration):
+            # Same messages lifxlan sends with rapid=True, but packed once per bulb onto one shared socket
+            for name, (method, value) in targets.items():
+                self.limiters[name].submit(self.LX_ATTRIBUTES[method],
+                                           lambda name=name, method=method, value=value:
+                                           self.send_packet(name, method, value, duration))
+
+        def send_packet(self, name, method, value, duration):
+            light = self.lights[name]
+            msg_type, payload = self.message(method, value, duration)
+            msg = msg_type(light.mac_addr, light.source_id, seq_num=next(self.seq_nums) % 256, payload=payload,
+                           ack_requested=False, response_requested=False)
+            self.sock.sendto(msg.packed_message, (light.ip_addr, light.port))
+            self.remember(name, method, value, duration)
+
+        def rate_stats(self):
+            return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+        def light_name(self, name):
+            return name  # Bulbs are already known by name, as in metrics and health
+
+        def remember(self, name, method, value, duration):
+            if method == "set_brightness":
+                self.shadow.forget([name])  # Only lifxlan knows the rest of the color it sent
+            else:
+                self.shadow.update([name], self.LX_ATTRIBUTES[method], value)
+            self.transitions[name] = time.time() + duration / 1000
+
+        def confirm_state(self):
+            # Read each bulb back, re-sending (acknowledged) whatever a lost rapid packet left out of date
             try:
-                # Go through each command and see if it matches the spoken words
-                for cmd, value in self.LX_COMMANDS.items():
-                    if cmd in words:
-                        for method, specs in value.items():
-                            args.append(method)
-                            if isinstance(specs, dict):  # Specific to color adjustment
-                                for spec in words.split():
-                                    if spec in specs.keys():
-                                        args.append([specs[spec]])
-                                        break
-                            elif isinstance(specs, list):  # Specific to continuous functions
-                                for name in lx_names:  # If no light name specified default to all
-                                    if specs[0]:
-                                        global_cmd = specs[1]
-                                        self.threadVars[specs[1]] = True
-                                        self.lightThreads[name] = Thread(target=getattr(GlobalOps(self), global_cmd),
-                                                                         args=(args, self.LX_COMMANDS[cmd]),
-                                                                         daemon=True)
-                                        self.lightThreads[name].start()
-
-                                    else:
-                                        self.threadVars[specs[1]] = False
-                            elif "dynaInt" in specs:  # Specific to brightness adjustment
-                                try:
-                                    args.append([int(int(re.findall(r'\d+', words)[-1]) * 650), value["rate"]])
-                                except IndexError:  # Without specifying percent, dynamically dim or raise the lights
-                                    args.append([int(re.findall(r'\d+', specs)[-1]), value["rate"]])
-                            else:
-                                args.append([specs])  # Power on/off
-
-                            if len(args) >= 3:
-                                self.execute_command(args)
-
-                            return {"SUCCESS": {cmd: lx_names}, "Class": LIFX_BRAND}
+                for name, light in self.lights.items():
+                    if name not in self.ready or time.time() < self.transitions.get(name, 0):
+                        continue  # Not connected yet or mid transition, the bulb would not match yet
+                    if self.health.state(name) != DH.CLOSED:
+                        continue  # Left to the health probes
+                    try:
+                        color = list(self.health.call(name, light.get_color))  # Also refreshes light.power_level
+                        power = 65535 if light.power_level > 0 else 0
+                        differed = self.shadow.reconcile(name, {"power": power, "color": color})
+                        if self.rapid and "power" in differed:
+                            self.send(name, "set_power", differed["power"], 0)
+                        if self.rapid and "color" in differed:
+                            self.send(name, "set_color", differed["color"], 0)
+                    except lx.WorkflowException as Ex:
+                        print(f"Could not confirm state of {name}: " + str(Ex))
+            finally:
+                self.last_confirm = time.time()
+                self.confirming = False
+
+        def rediscover(self, discovery):
+            # Bulbs are found again by their MAC address, following any that were given a new address
+            found = discovery.refresh_lifx()
+            for name, light in self.lights.items():
+                bulb = found.get(light.mac_addr.lower())
+                if bulb is not None and (light.ip_addr, light.port) != DC.split_address(bulb["ip"]):
+                    print(f"Light {name} moved to {bulb['ip']}")
+                    light.ip_addr, light.port = DC.split_address(bulb["ip"])
+
+        def save_scene(self, name, lights, previous=None):
+            # One state request per bulb reads its power and color together, returns (response, scene entry)
+            lx_names = [name for name in self.ops.ready_lights([name for name in lights if name in self.lights]
+                                                               or self.LIGHT_NAMES)
+                        if self.health.available(name)]
+            saved = dict(previous["lights"]) if previous else {}
+
+            def read(name):
+                try:
+                    color = list(self.health.call(name, self.metrics.timed, name, self.lights[name].get_color))
+                except lx.WorkflowException as Ex:
+                    print(f"Could not read state of {name}: " + str(Ex))
+                    return None
+                state = {"power": 65535 if self.lights[name].power_level > 0 else 0, "color": color}
+                self.shadow.reconcile(name, state)
+                return state
+
+            states = dict(zip(lx_names, fan_out(self.pool, read, lx_names)))
+            saved.update((name, state) for name, state in states.items() if state is not None)
+            read_names = [name for name in lx_names if states[name] is not None]
+            if not read_names:
+                return {"ERROR": "None of the lights could be read.", "Class": LIFX_BRAND}, None
+            return {"SUCCESS": {"save scene": read_names}, "Class": LIFX_BRAND}, {"lights": saved}
+
+        def restore_scene(self, entry, lights):
+            # Each bulb is sent its color and power back to back, skipping whatever it already has
+            lx_names = [name for name in (lights or entry["lights"]) if name in entry["lights"] and name in self.lights]
+            if not lx_names:
+                return {"INFO": "The scene has none of these lights.", "Class": LIFX_BRAND}
+            self.scheduler.stop(self, lx_names)
+            send = self.send_packet if self.rapid else self.send
+
+            def restore(name):
+                state = entry["lights"][name]
+                for method, attribute in (("set_color", "color"), ("set_power", "power")):
+                    if self.shadow.changes([name], attribute, state[attribute]):
+                        self.limiters[name].submit(attribute, lambda method=method, attribute=attribute:
+                                                   send(name, method, state[attribute], 0))
 
-                return {"INFO": "Voice command '" + str(words) + "' does not exist.", "Class": LIFX_BRAND}
+            try:
+                ready = [name for name in self.ops.ready_lights(lx_names) if self.health.available(name)]
+                fan_out(None if self.rapid else self.pool, restore, ready)
+                return {"SUCCESS": {"restore scene": lx_names}, "Class": LIFX_BRAND}
             except Exception as Ex:
                 return {"ERROR": str(Ex), "Class": LIFX_BRAND}
 
-        def execute_command(self, args):
-            for name in args[0]:
-                getattr(self.lights[name], args[1])(*args[2])
+        def run_effect(self, lx_names, plan):
+            name, period, values = plan.effect, plan.period, plan.values
+            # lifxlan only takes whole ms, the disco rate (in s) given as its transition rounds to an instant one
+            transition = int(plan.duration)
+            if name in ("colorama", "disco"):
+                frames = self.effect_frames if name == "colorama" else 1
+                easing = self.effect_easing if name == "colorama" else "step"
+                timeline = self.timelines.timeline(values, frames, ET.HSBK, easing, len(lx_names), self.effect_spread)
+                values = dict(zip(lx_names, timeline))
+                period /= frames
+                if name == "colorama":  # Fades into the next frame, color_rate can make it quicker
+                    transition = min(int(period * 1000), transition)
+            self.ops.ready_lights(lx_names)  # Connected once here rather than checked on every tick
+            self.scheduler.start(self, lx_names, name, plan.method, self.bind_frames(lx_names, plan.method, values),
+                                 period, transition)
+
+        def bind_frames(self, lx_names, method, values):
+            # What each bulb is sent for every frame of an effect, as (method, value), worked out when it starts.
+            # Only flash's brightness is left to each tick, as it is sent with whatever color the bulb has then.
+            if method == "set_brightness":
+                return values
+            if not isinstance(values, dict):
+                return [self.resolve_write(None, method, value) for value in values]  # Shared by the bulbs
+            return {name: [self.resolve_write(name, method, value) for value in values[name]] for name in lx_names}
+
+        def execute_frames(self, frames):
+            # Bulbs are written to one by one, so the frames of a tick are sent as they are without grouping.
+            # Rapid mode never waits on a bulb, its packets go out together as one burst.
+            if self.rapid:
+                self.ops.send_frame(None, self.write_burst, frames)
+            else:
+                for frame in frames:
+                    self.ops.send_frame(frame[0], self.write_frame, frame)
+            self.confirm_due()
+
+        def write_burst(self, frames):
+            for frame in frames:
+                self.write_frame(frame)
+
+        def write_frame(self, frame):
+            name, method, value, duration = frame
+            if name not in self.ready or not self.health.available(name):
+                return  # Rejoins the effect once it answers again
+            sent, target = self.resolve_write(name, method, value) if method == "set_brightness" else value
+            attribute = self.LX_ATTRIBUTES[sent]
+            if sent != "set_brightness" and not self.shadow.changes((name,), attribute, target):
+                return
+            send = self.send_packet if self.rapid else self.send
+            try:
+                self.limiters[name].submit(attribute, lambda: send(name, sent, target, duration))
+            except Exception:
+                pass  # Recorded in health and metrics by send
 
-        def run_thread(self, args, elements):
-            while self.threadVars[elements[args[1]][1]]:
-                for key, val in elements[args[1]][3].items():
-                    self.execute_command(args + [[val] + [elements[args[1]][4]]])
-                    time.sleep(elements[args[1]][2])
-                    if not self.threadVars[elements[args[1]][1]]:
-                        break
+        def stop_effects(self, lx_names):
+            self.scheduler.stop(self, [name for name in lx_names if name in self.lights])
+
+        def music_frame(self, lx_names, hue, brightness, duration):
+            # One frame of MM.MusicMode, fading into the next one
+            color = [int(hue * 65535), 65535, int(brightness * 65535), 3500]
+            self.execute_command([name for name in lx_names if name in self.lights], "set_color", color,
+                                 int(duration * 1000))
 
     class PhilipsHue:
 
         def __init__(self, ip_addresses, light_names, light_ids, default_colors,
                      default_brightness, max_brightness, min_brightness,
-                     flash_rate, colorama_rate, disco_rate, flicker_rate):
+                     flash_rate, colorama_rate, disco_rate, flicker_rate, pool=None, scheduler=None, metrics=None,
+                     health=None, timeout=TIMEOUTS[PHUE_BRAND], confirm_interval=5, rate_limit=RATE_LIMITS[PHUE_BRAND],
+                     startup="serial", group_actions=True, timelines=None, effect_frames=4,
+                     effect_easing="ease-in-out", effect_spread=0.0):
 
             self.LIGHT_NAMES = light_names
             self.PHUE_LIGHT_IDS = {}
-
-            self.bridge = phue.Bridge(ip_addresses[0])
+            self.names_by_id = {}  # Light id -> name, looked up for every light on every command and effect tick
+            self.pool = pool
+            self.scheduler = scheduler if scheduler is not None else ES.EffectScheduler()
+            self.metrics = metrics if metrics is not None else MX.Metrics()  # Replies are recorded per light name
+            # The bridge's breaker opens when it stops answering, a light's when the bridge cannot reach it
+            self.health = health if health is not None else DH.DeviceHealth(metrics=self.metrics)
+            self.timelines = timelines if timelines is not None else ET.TimelineCache()
+            self.effect_frames = effect_frames
+            self.effect_easing = effect_easing
+            self.effect_spread = effect_spread
+            self.group_actions = group_actions
+            self.groups = {}  # Sorted light ids -> bridge group id
+
+            # State last sent to each light id, read back from the bridge every confirm_interval seconds
+            self.shadow = DS.ShadowState()
+            self.confirm_interval = confirm_interval
+            self.last_confirm = time.time()
+            self.confirming = False
+
+            self.bridge = PooledBridge(ip_addresses[0], timeout=timeout)
+            self.bridge_name = "phue bridge " + ip_addresses[0]  # Group actions are recorded for the bridge
+            self.scene_key = self.bridge_name  # Saved scenes keep each bridge's lights apart
+            self.health.register(self.bridge_name, self.bridge.get_light)
+            self.rate_limit = rate_limit
+            self.limiter = RL.CoalescingLimiter(rate_limit, self.scheduler, self.pool)  # Shared by the bridge's lights
+            self.group_bucket = RL.TokenBucket(HUE_GROUP_RATE)
+            # Effect frames are sent here rather than on the scheduler thread, see GlobalOps.send_frame
+            self.senders = ThreadPoolExecutor(min(SEND_WORKERS, len(light_names) + 1), thread_name_prefix="PhilipsHue")
+            self.sending = set()  # Light ids (or GROUP for a group action) whose last frame is still being sent
+            self.send_lock = Lock()
+            self.group_lock = Lock()
+            self.music_next = 0.0  # When the bridge can take the next music frame
             self.lights = {}
-            self.lightThreads = {}
-            self.threadVars = {}
 
             self.PHUE_COLORS = {"red": [1, 0], "orange": [0.55, 0.4], "yellow": [0.45, 0.47],
                                 "green": [0, 1], "cyan": [0.196, 0.252], "blue": [0, 0],
@@ -389,86 +1072,396 @@ class Lights:
                 "raise": "dynaInt" + str(max_brightness[0]),
             }
 
+            self.matcher = CM.CommandMatcher(self.PHUE_COMMANDS, self.LIGHT_NAMES, self.PHUE_COLORS)
+            self.plans = CP.compile_phue(self.PHUE_COMMANDS, self.PHUE_KEYWORDS)  # What each command sends
+            self.ops = GlobalOps(self)
+
             # Set the defaults
+            self.defaults = {}  # Light id -> default color and brightness, sent when a light is connected
+            self.ready = set()  # Light ids that have been sent their defaults
+            self.init_times = {}
+            self.init_errors = {}
             for i, name in enumerate(light_names):
                 self.PHUE_LIGHT_IDS[name] = light_ids[i]
-                isOn = self.bridge.get_light(light_ids[i])["state"]["on"]
-                if not isOn:
-                    self.bridge.set_light(light_ids[i], "on", True)  # Can only alter when on
-                    self.bridge.set_light(light_ids[i], "xy", self.PHUE_COLORS[default_colors[i].lower()])
-                    self.bridge.set_light(light_ids[i], "on", False)
-                else:
-                    self.bridge.set_light(light_ids[i], "xy", self.PHUE_COLORS[default_colors[i].lower()])
-                    self.bridge.set_light(light_ids[i], "bri", default_brightness[i])
-
-        def process_command(self, words):
-            args = []
-            light_id = None
-            for name in self.LIGHT_NAMES:
-                if name in words:
-                    light_id = self.PHUE_LIGHT_IDS[name]
-                    break
-
-            if light_id:
-                ids = [light_id]
-            else:  # If no light name was specified, default to all lights
-                ids = list(self.PHUE_LIGHT_IDS.values())
+                self.names_by_id[light_ids[i]] = name
+                self.defaults[light_ids[i]] = {"xy": self.PHUE_COLORS[default_colors[i].lower()],
+                                               "bri": default_brightness[i]}
+                self.health.register(name, lambda lid=light_ids[i]: self.probe_light(lid))
+
+            if startup != "lazy":
+                self.ops.connect_lights(list(self.PHUE_LIGHT_IDS.values()), parallel=startup == "parallel")
+
+        def connect_light(self, lid):
+            # Sent without reading the light first, a light that is off is only turned on when it refuses
+            response = self.timed_request(self.light_name(lid), self.bridge.set_light, lid, dict(self.defaults[lid]))
+            errors = [result["error"] for result in response if "error" in result]
+            if errors and all(error["type"] == 201 for error in errors):  # Can only alter when on
+                self.bridge.set_light(lid, {"on": True, "xy": self.defaults[lid]["xy"]})
+                self.bridge.set_light(lid, "on", False)
+                self.shadow.update([lid], "on", False)
+                self.shadow.update([lid], "xy", self.defaults[lid]["xy"])
+            elif errors:
+                raise Exception(errors[0]["description"])
+            else:
+                self.shadow.update([lid], "on", True)
+                self.shadow.update([lid], "xy", self.defaults[lid]["xy"])
+                self.shadow.update([lid], "bri", self.defaults[lid]["bri"])
 
-            args.append(ids)
-
-            try:  # Go through each command and see if it matches the spoken words
-                for cmd, value in self.PHUE_COMMANDS.items():
-                    if cmd in words:
-                        args.append(value)
-                        if isinstance(self.PHUE_KEYWORDS[cmd], dict):  # For color related functions
-                            for spec in words.split():
-                                if spec in self.PHUE_KEYWORDS[cmd].keys():
-                                    args.append(self.PHUE_KEYWORDS[cmd][spec])
-                                    break
-                        elif isinstance(self.PHUE_KEYWORDS[cmd], list):  # For looped functions
-                            for lid in ids:  # If no light name specified default to all
-                                if self.PHUE_KEYWORDS[cmd][0]:
-                                    global_cmd = self.PHUE_KEYWORDS[cmd][1]  # Get function name in GlobalOps class
-                                    self.threadVars[self.PHUE_KEYWORDS[cmd][1]] = True
-                                    self.lightThreads[lid] = Thread(target=getattr(GlobalOps(self), global_cmd),
-                                                                    args=(args, self.PHUE_KEYWORDS[cmd]), daemon=True)
-                                    self.lightThreads[lid].start()
-                                else:
-                                    self.threadVars[self.PHUE_KEYWORDS[cmd][1]] = False
-                        elif "dynaInt" in str(self.PHUE_KEYWORDS[cmd]):  # For brightness adjustment
-                            try:
-                                args.append(int(int(re.findall(r'\d+', words)[-1]) * 2.54))
-                            except IndexError:  # Without specifying percent, dynamically dim or raise the lights
-                                args.append(int(re.findall(r'\d+', self.PHUE_KEYWORDS[cmd])[-1]))
-                        else:
-                            args.append(self.PHUE_KEYWORDS[cmd])  # For main switch
+        def process_command(self, words, intent=None):
+            if intent is None:
+                intent = self.matcher.match(words)
 
-                        if len(args) >= 3:
-                            response = self.execute_command(args)  # PhilipsHue returns error responses
-                            if list(response[0][0])[0] == "error":
-                                raise Exception(response[0][0]["error"]["description"])
+            plan = self.plans.get(intent.command)
+            if plan is None:
+                return {"INFO": "Voice command '" + str(words) + "' does not exist.", "Class": PHUE_BRAND}
 
-                        return {"SUCCESS": {cmd: ids}, "Class": PHUE_BRAND}
+            ids = [self.PHUE_LIGHT_IDS[name] for name in intent.lights if name in self.PHUE_LIGHT_IDS]
+            if not ids:  # If no light name was specified, default to all lights
+                ids = list(self.PHUE_LIGHT_IDS.values())
 
-                return {"INFO": "Voice command '" + str(words) + "' does not exist.", "Class": PHUE_BRAND}
+            try:
+                errors = {}
+                if plan.kind == CP.START:  # Replaces any effect already running on the lights
+                    self.run_effect(ids, plan)
+                elif plan.kind == CP.STOP:
+                    self.scheduler.stop(self, ids, plan.effect)
+                else:  # Main switch, color or brightness (dimmed or raised to the default level without a percent)
+                    value = plan.bind(intent)
+                    if value is not None:
+                        response = self.execute_command(ids, plan.method, value)  # PhilipsHue returns error responses
+                        errors = {lid: result[0]["error"]["description"] for lid, result in zip(ids, response)
+                                  if "error" in result[0]}
+                return self.ops.responses(plan.command, ids, errors, PHUE_BRAND)
             except Exception as Ex:
                 return {"ERROR": str(Ex), "Class": PHUE_BRAND}
 
-        def execute_command(self, args):
-            return self.bridge.set_light(*args)
+        def execute_command(self, light_ids, parameter, value, transitiontime=None):
+            # Only the lights the command would change are sent it, the others are reported as successful.
+            # Lights that are skipped or could not be reached are reported with an UNAVAILABLE error.
+            ready = self.ops.ready_lights(light_ids)
+            if self.health.available(self.bridge_name):
+                ready = [lid for lid in ready if self.health.available(self.light_name(lid))]
+            else:
+                ready = []
+            ids = self.shadow.changes(ready, parameter, value)
+            results = {lid: [{"success": {}}] if lid in ready else self.unavailable(lid, "not answering")
+                       for lid in light_ids}
+
+            def send(lid_or_ids, write):
+                try:
+                    return write()
+                except Exception as Ex:  # Recorded in health and metrics by timed_request
+                    return self.unavailable(lid_or_ids, str(Ex))
+
+            if self.use_group(ids):
+                # A single group action instead of one request per light, repeated per light for the callers
+                result = send(0, lambda: self.limiter.submit((GROUP, parameter), lambda: self.send_group(
+                    ids, parameter, value, transitiontime)))
+                results.update((lid, result) for lid in ids if result is not None)
+            else:  # One request per light, sent concurrently when a worker pool is available
+                sent = fan_out(self.pool, lambda lid: send(lid, lambda: self.limiter.submit(
+                    (lid, parameter), lambda: self.send_light(lid, parameter, value, transitiontime))), ids)
+                results.update((lid, result) for lid, result in zip(ids, sent) if result is not None)
+            self.confirm_due()
+            return [results[lid] for lid in light_ids]
+
+        def confirm_due(self):
+            if not self.confirming and time.time() - self.last_confirm >= self.confirm_interval:
+                self.confirming = True
+                Thread(target=self.confirm_state, daemon=True).start()
+
+        def groupable(self, ids):
+            return self.group_actions and len(ids) > 1 and set(ids) == set(self.PHUE_LIGHT_IDS.values())
+
+        def use_group(self, ids):
+            # Whether the lights can be sent one group action, taking one of the bridge's group actions if so
+            if not self.groupable(ids):
+                return False
+            with self.group_lock:
+                return self.group_bucket.take()
+
+        def send_light(self, lid, parameter, value, transitiontime=None):
+            result = self.timed_request(self.light_name(lid), self.bridge.set_light, lid, parameter, value,
+                                        transitiontime)
+            if "success" in result[0]:
+                self.shadow.update([lid], parameter, value)
+            return result
+
+        def send_group(self, ids, parameter, value, transitiontime=None):
+            result = self.timed_request(self.bridge_name, self.bridge.set_group, self.get_group_id(ids), parameter,
+                                        value, transitiontime)
+            if "success" in result[0]:
+                self.shadow.update(ids, parameter, value)
+            return result
+
+        def timed_request(self, device, func, *args):
+            # Records the request to the device, an error in the bridge's response counts as a failure.
+            # Only the bridge not answering counts against its health, the lights' is read in confirm_state.
+            start = time.monotonic()
+            try:
+                result = func(*args)[0]
+            except Exception as Ex:
+                self.metrics.device(device, time.monotonic() - start, Ex)
+                self.health.failure(self.bridge_name, Ex)
+                raise
+            self.health.success(self.bridge_name)
+            errors = [item["error"]["description"] for item in result if "error" in item]
+            self.metrics.device(device, time.monotonic() - start, errors[0] if errors else None)
+            return result
+
+        def light_name(self, lid):
+            return self.names_by_id.get(lid, str(lid))
+
+        @staticmethod
+        def unavailable(lid, description):
+            return [{"error": {"type": DH.UNAVAILABLE, "address": "/lights/%s" % lid, "description": description}}]
+
+        def probe_light(self, lid):
+            if not self.bridge.get_light(lid)["state"].get("reachable", True):
+                raise Exception(f"The bridge cannot reach light {lid}")
+
+        def rate_stats(self):
+            return {"bridge": self.limiter.stats()}
+
+        def confirm_state(self):
+            # A single request reads back every light on the bridge
+            try:
+                lights = self.health.call(self.bridge_name, self.bridge.get_light)
+                for lid in self.ready:
+                    state = lights[str(lid)]["state"]
+                    self.shadow.reconcile(lid, {key: state[key] for key in ("on", "xy", "bri") if key in state})
+                    if state.get("reachable", True):
+                        self.health.success(self.light_name(lid))
+                    else:
+                        self.health.failure(self.light_name(lid), "unreachable from the bridge")
+            except Exception as Ex:
+                print("Could not confirm state of phue lights: " + str(Ex))
+            finally:
+                self.last_confirm = time.time()
+                self.confirming = False
+
+        def rediscover(self, discovery):
+            # The bridge lists its lights in a single request, renamed and added lights are saved for the next start.
+            # A bridge that stopped answering is looked up by its id, following it if it was given a new address.
+            # bridge_name is kept, so its health, metrics and saved scenes carry on under the same name.
+            try:
+                self.metrics.timed(self.bridge_name, discovery.refresh_hue, self.bridge.ip, self.bridge)
+            except Exception:
+                moved = discovery.find_hue_bridge(self.bridge.ip)
+                if moved is None or moved == self.bridge.ip:
+                    raise
+                print(f"PhilipsHue bridge {self.bridge_name} moved to {moved}")
+                self.bridge.move(moved)
+                self.metrics.timed(self.bridge_name, discovery.refresh_hue, moved, self.bridge)
+
+        def save_scene(self, name, lights, previous=None):
+            # A single request reads every light, which are also stored on the bridge as a native scene
+            names = [light for light in lights if light in self.PHUE_LIGHT_IDS] or self.LIGHT_NAMES
+            saved = dict(previous["lights"]) if previous else {}
+            try:
+                states = self.metrics.timed(self.bridge_name, self.bridge.get_light)
+                for light in names:
+                    state = states[str(self.PHUE_LIGHT_IDS[light])]["state"]
+                    saved[light] = {key: state[key] for key in ("on", "xy", "bri") if key in state}
+                    self.shadow.reconcile(self.PHUE_LIGHT_IDS[light], saved[light])
+            except Exception as Ex:
+                return {"ERROR": str(Ex), "Class": PHUE_BRAND}, None
+
+            entry = {"lights": saved, "native": None}
+            if previous and previous.get("native") is not None:  # Replaced rather than left behind on the bridge
+                try:
+                    self.metrics.timed(self.bridge_name, self.bridge.delete_scene, previous["native"])
+                except Exception as Ex:
+                    print("Could not delete the old copy of the scene on the bridge: " + str(Ex))
+            scene = {"name": ("VocaLights " + name)[:32], "recycle": False,
+                     "lights": [str(self.PHUE_LIGHT_IDS[light]) for light in saved],
+                     "lightstates": {str(self.PHUE_LIGHT_IDS[light]): self.scene_state(state)
+                                     for light, state in saved.items()}}
+            try:
+                result = self.metrics.timed(self.bridge_name, self.bridge.request, "POST",
+                                            "/api/" + self.bridge.username + "/scenes", scene)
+                if "success" in result[0]:
+                    entry["native"] = result[0]["success"]["id"]
+            except Exception as Ex:  # Restored with group and light requests instead
+                print("Could not store the scene on the bridge: " + str(Ex))
+            saved_ids = [self.PHUE_LIGHT_IDS[light] for light in names]
+            return {"SUCCESS": {"save scene": saved_ids}, "Class": PHUE_BRAND}, entry
+
+        def restore_scene(self, entry, lights):
+            # Recalls the bridge's own copy of the scene when it covers every light, otherwise lights
+            # sharing a state are sent it together as a group action where possible
+            names = [light for light in (lights or entry["lights"])
+                     if light in entry["lights"] and light in self.PHUE_LIGHT_IDS]
+            if not names:
+                return {"INFO": "The scene has none of these lights.", "Class": PHUE_BRAND}
+            ids = [self.PHUE_LIGHT_IDS[light] for light in names]
+            self.scheduler.stop(self, ids)
+            states = {self.PHUE_LIGHT_IDS[light]: self.scene_state(entry["lights"][light]) for light in names}
+
+            try:
+                if entry.get("native") is not None and len(names) == len(entry["lights"]):
+                    results = [self.limiter.submit((GROUP, "scene"),
+                                                   lambda: self.send_scene(entry["native"], states))]
+                else:
+                    by_state = {}  # Lights that end up in the same state share one request
+                    for lid in self.ops.ready_lights(ids):
+                        if any(self.shadow.changes([lid], key, value) for key, value in states[lid].items()):
+                            by_state.setdefault(json.dumps(states[lid], sort_keys=True), []).append(lid)
+                    results = []
+                    for group in by_state.values():
+                        state = states[group[0]]
+                        if self.use_group(group):
+                            results.append(self.limiter.submit((GROUP, "scene"),
+                                                               lambda group=group, state=state:
+                                                               self.send_state(group, state)))
+                        else:
+                            results += fan_out(self.pool, lambda lid, state=state: self.limiter.submit(
+                                (lid, "scene"), lambda: self.send_state([lid], state)), group)
+                errors = [item["error"]["description"] for result in results if result is not None
+                          for item in result if "error" in item]
+                if errors:
+                    raise Exception(errors[0])
+                return {"SUCCESS": {"restore scene": ids}, "Class": PHUE_BRAND}
+            except Exception as Ex:
+                return {"ERROR": str(Ex), "Class": PHUE_BRAND}
 
-        def run_thread(self, args, elements):
-            while self.threadVars[elements[1]]:
-                for key, val in elements[3].items():
-                    result = self.execute_command(args + [val])
-                    for i, light in enumerate(args[0]):  # Unique for phue, check status to make sure error is captured
-                        result_status = list(result[i][0].keys())[0]
-                        if result_status == "error":  # Exit thread for the light(s) that are non-responsive to requests
-                            print(f"Light {i + 1} error: " + str(result[i][0][result_status]["description"]))
-                            return
-                    time.sleep(elements[2])
-                    if not self.threadVars[elements[1]]:
-                        break
+        def send_scene(self, scene_id, states):
+            result = self.timed_request(self.bridge_name, self.bridge.set_group, 0, "scene", scene_id)
+            if "success" in result[0]:
+                for lid, state in states.items():
+                    self.remember_state([lid], state)
+            return result
+
+        def send_state(self, ids, state, transitiontime=None):
+            if len(ids) > 1:
+                result = self.timed_request(self.bridge_name, self.bridge.set_group, self.get_group_id(ids),
+                                            dict(state), None, transitiontime)
+            else:
+                result = self.timed_request(self.light_name(ids[0]), self.bridge.set_light, ids[0], dict(state),
+                                            None, transitiontime)
+            if "success" in result[0]:
+                self.remember_state(ids, state)
+            return result
+
+        def remember_state(self, ids, state):
+            for key, value in state.items():
+                self.shadow.update(ids, key, value)
+
+        @staticmethod
+        def scene_state(state):
+            # A light that is off refuses color changes, so it is only turned off
+            return dict(state) if state.get("on", True) else {"on": False}
+
+        def get_group_id(self, ids):
+            key = tuple(sorted(ids))
+            if key not in self.groups:
+                if sorted(int(lid) for lid in self.bridge.get_light()) == list(key):
+                    self.groups[key] = 0  # Group 0 always holds every light on the bridge
+                else:
+                    for group_id, group in self.bridge.get_group().items():
+                        if sorted(int(lid) for lid in group["lights"]) == list(key):
+                            self.groups[key] = int(group_id)
+                            break
+                    else:
+                        response = self.bridge.create_group("VocaLights", list(key))
+                        if "error" in response[0]:
+                            raise Exception(response[0]["error"]["description"])
+                        self.groups[key] = int(response[0]["success"]["id"])
+            return self.groups[key]
+
+        def run_effect(self, ids, plan):
+            name, period, values = plan.effect, plan.period, plan.values
+            transition = None  # The bridge's default
+            if name in ("colorama", "disco"):
+                frames, easing, transition = 1, "step", 0
+                if name == "colorama":  # As many frames as the bridge can take, lights in step share a group action
+                    rate = self.rate_limit / len(ids)  # Frames a second when each light is sent its own
+                    if not self.effect_spread and len(ids) > 1:
+                        rate = max(rate, HUE_GROUP_RATE)
+                    frames = max(1, min(self.effect_frames, int(rate * period)))
+                    easing = self.effect_easing
+                    transition = round(period / frames * 10)  # Deciseconds, fades into the next frame
+                timeline = self.timelines.timeline(values, frames, ET.XY, easing, len(ids), self.effect_spread)
+                values = dict(zip(ids, timeline))
+                period /= frames
+            self.ops.ready_lights(ids)  # Connected once here rather than checked on every tick
+            self.scheduler.start(self, ids, name, plan.method, values, period, transition)
+
+        def execute_frames(self, frames):
+            # The duration of a frame is its transition time, when the effect gives one
+            if not self.health.available(self.bridge_name):
+                return
+            first = frames[0]
+            if len(frames) > 1 and len(frames) == len(self.PHUE_LIGHT_IDS) and all(
+                    frame[1] == first[1] and frame[2] == first[2] and frame[3] == first[3] for frame in frames):
+                ids = [frame[0] for frame in frames]  # Every light in step, sent as one group action if it can be
+                if self.use_group(ids):
+                    self.ops.send_frame(GROUP, self.write_group, ids, first[1], first[2], first[3])
+                    self.confirm_due()
+                    return
+            for frame in frames:
+                self.ops.send_frame(frame[0], self.write_frame, frame)
+            self.confirm_due()
+
+        def write_group(self, ids, parameter, value, transitiontime):
+            ready = [lid for lid in ids if lid in self.ready and self.health.available(self.light_name(lid))]
+            if not self.shadow.changes(ready, parameter, value):
+                return
+            try:
+                result = self.limiter.submit((GROUP, parameter),
+                                             lambda: self.send_group(ready, parameter, value, transitiontime))
+            except Exception:
+                return  # Recorded in health and metrics by timed_request
+            for lid in ready:
+                self.check_frame(lid, result)
+
+        def write_frame(self, frame):
+            lid, parameter, value, transitiontime = frame
+            if lid not in self.ready or not self.health.available(self.light_name(lid)):
+                return  # Rejoins the effect once it answers again
+            if not self.shadow.changes((lid,), parameter, value):
+                return
+            try:
+                result = self.limiter.submit((lid, parameter),
+                                             lambda: self.send_light(lid, parameter, value, transitiontime))
+            except Exception:
+                return  # Recorded in health and metrics by timed_request
+            self.check_frame(lid, result)
+
+        def check_frame(self, lid, result):
+            # Lights the bridge refuses the effect (e.g. ones that are off) are stopped, None is a queued frame
+            error = result[0].get("error") if result is not None else None
+            if error is not None and error["type"] != DH.UNAVAILABLE:
+                print(f"Light {lid} error: " + str(error["description"]))
+                self.scheduler.stop(self, [lid])
+
+        def stop_effects(self, names):
+            self.scheduler.stop(self, [self.PHUE_LIGHT_IDS[name] for name in names if name in self.PHUE_LIGHT_IDS])
+
+        def music_frame(self, names, hue, brightness, duration):
+            # One frame of MM.MusicMode, color and brightness in one request. Frames that come sooner than the
+            # bridge can take them (a group action, or one request per light) are dropped.
+            ids = [self.PHUE_LIGHT_IDS[name] for name in names if name in self.PHUE_LIGHT_IDS]
+            if not self.health.available(self.bridge_name):
+                return
+            ids = [lid for lid in self.ops.ready_lights(ids) if self.health.available(self.light_name(lid))]
+            if not ids:
+                return
+            now = time.monotonic()
+            with self.group_lock:
+                if now < self.music_next:
+                    return
+                interval = len(ids) / self.rate_limit
+                if self.groupable(ids):
+                    interval = min(interval, 1 / HUE_GROUP_RATE)
+                self.music_next = now + interval
+            state = {"xy": MM.hue_xy(hue), "bri": max(1, int(brightness * 254))}
+            transition = max(round(duration * 10), round(interval * 10))  # Deciseconds, fades until the next frame
+            if self.use_group(ids):
+                self.limiter.submit((GROUP, "music"), lambda: self.send_state(ids, state, transition))
+            else:
+                fan_out(self.pool, lambda lid: self.limiter.submit(
+                    (lid, "music"), lambda: self.send_state([lid], state, transition)), ids)
 
 
 class GlobalOps:
@@ -477,28 +1470,76 @@ class GlobalOps:
     These functions are shared across the Lights subclasses (i.e. LifX, PhilipsHue, etc).
     The functions pass the request back to the object that called it.
 
-    NOTE: The run_thread and execute_command methods vary across the Lights subclasses
-    and are treated uniquely based on how they are controlled by their respective libraries.
+    NOTE: The run_effect, execute_frames and execute_command methods vary across the Lights subclasses
+    and are treated uniquely based on how they are controlled by their respective libraries. Each
+    light object keeps a single GlobalOps as its ops attribute.
     """
 
     def __init__(self, LightObj):
         self.LightObj = LightObj
 
-    def colorama(self, args, elements):
-        self.LightObj.run_thread(args, elements)
-
-    def disco(self, args, elements):
-        self.LightObj.run_thread(args, elements)
-
-    def flash(self, args, elements):
-        self.LightObj.run_thread(args, elements)
-
-    def flicker(self, args, elements):
-        self.LightObj.run_thread(args, elements)
-
     def get_light_names(self):
         return self.LightObj.LIGHT_NAMES
 
+    def connect_lights(self, lights, parallel=True):
+        # Sends each light its defaults, recording how long it took and whether it could be reached
+        def connect(light):
+            start = time.time()
+            try:
+                self.LightObj.health.call(self.LightObj.light_name(light), self.LightObj.connect_light, light)
+                self.LightObj.ready.add(light)
+                self.LightObj.init_errors.pop(light, None)
+            except Exception as Ex:
+                self.LightObj.init_errors[light] = str(Ex)
+                print(f"Light {light} could not be connected: " + str(Ex))
+            self.LightObj.init_times[light] = time.time() - start
+
+        pool = self.LightObj.pool
+        if parallel and pool is None and len(lights) > 1:
+            pool = ThreadPoolExecutor(min(32, len(lights)), thread_name_prefix="Connect")
+        try:
+            fan_out(pool if parallel else None, connect, lights)
+        finally:
+            if pool is not None and pool is not self.LightObj.pool:
+                pool.shutdown(wait=False)
+
+    def ready_lights(self, lights):
+        # Connects any of the lights that have not been yet, returns the ones that are connected.
+        # Lights that keep failing to connect are only tried again once their health probe succeeds.
+        waiting = [light for light in lights if light not in self.LightObj.ready
+                   and self.LightObj.health.state(self.LightObj.light_name(light)) == DH.CLOSED]
+        if waiting:
+            self.connect_lights(waiting)
+        return [light for light in lights if light in self.LightObj.ready]
+
+    def send_frame(self, light, write, *args):
+        # Hands an effect frame to the light object's senders without waiting on it. A light still sending its
+        # last frame skips this one, so a light that is slow to answer holds up neither the effect scheduler nor
+        # the other lights, and never has more than one frame waiting.
+        with self.LightObj.send_lock:
+            if light in self.LightObj.sending:
+                self.LightObj.metrics.count("frames_skipped")
+                return
+            self.LightObj.sending.add(light)
+        self.LightObj.senders.submit(self._send_frame, light, write, args)
+
+    def _send_frame(self, light, write, args):
+        try:
+            write(*args)
+        except Exception as Ex:
+            print("Effect could not be sent: " + str(Ex))
+        finally:
+            with self.LightObj.send_lock:
+                self.LightObj.sending.discard(light)
+
+    def responses(self, command, lights, errors, brand):
+        # A SUCCESS for the lights the command reached, or a list with an ERROR for each light it did not
+        reached = [light for light in lights if light not in errors]
+        response = [{"SUCCESS": {command: reached}, "Class": brand}] if reached else []
+        response += [{"ERROR": self.LightObj.light_name(light) + ": " + error, "Light": self.LightObj.light_name(light),
+                      "Class": brand} for light, error in errors.items()]
+        return response[0] if len(response) == 1 and not errors else response
+
 
 class Activation(Lights):
 
@@ -510,29 +1551,65 @@ class Activation(Lights):
     using the configure_lights method inherited from the Lights object. When setup is complete
     then the run() function below can be used. The voice_response parameter can be set to True
     in order to receive a response back from the machine on the status of a completed request.
+
+    Speech is recognized with the Google Web Speech API unless another backend is given, e.g.
+    VC.VoskBackend("path/to/model") to recognize offline on this machine. Backends that support it
+    are limited to the phrases of the configured lights when run() starts.
+
+    Phrases that are unlikely to be commands (noise, music, long stretches of talk) are dropped before
+    they are recognized by a VG.SpeechGate, which can be given with its own sensitivity and wake phrase.
+    gate=False hands every phrase to the recognizer. A wake phrase is recorded on the first run().
+
+    The audio the microphone hears is also handed to music, an MM.MusicMode, so 'music on' can set the
+    lights to it without opening the microphone a second time.
     """
 
-    def __init__(self, pause_threshold=0.5):
-        super().__init__()
-        self.vIn = VC.CommandInputs(pause_threshold)
+    def __init__(self, pause_threshold=0.5, max_workers=1, recognition_workers=2, backend=None, scene_file=None,
+                 device_file=None, gate=None):
+        super().__init__(max_workers, scene_file, device_file)
+        gate = VG.SpeechGate() if gate is None else gate or None
+        self.vIn = VC.CommandInputs(pause_threshold, recognition_workers, backend=backend, metrics=self.metrics,
+                                    gate=gate)
+        self.music = MM.MusicMode(self.metrics)
+        self.vIn.listeners.append(self.music.feed)
         self.vOut = VC.CommandOutputs()
+        self.vIn.speech = self.vOut  # Replies are not taken for commands
 
-    def run(self, voice_response=False, debug=False):
+    def run(self, voice_response=False, debug=False, metrics_file=None, metrics_port=None, metrics_interval=10,
+            command_port=None):
         if len(self.light_objects) == 0:
             raise Exception("ERROR: No lights have been configured for usage. To set up lights "
                             "use configure_lights and pass it the type of light (e.g. lifx, phue), "
                             "the light names, and any additional customizable parameters listed. ")
 
-        light_api = self.LightAPI(self.light_objects)
-        while True:
-            words = self.vIn.get_voice_input()
-
+        # Commands sent over HTTP on command_port share the dispatcher, and so the lights, with the voice commands
+        dispatcher = CI.CommandDispatcher(self)
+        light_api = dispatcher.api
+        self.vIn.set_grammar(light_api.grammar())
+        if self.vIn.gate is not None and self.vIn.gate.wake_phrase and not self.vIn.gate.templates:
+            self.vIn.enroll_wake_phrase()
+        if self.rooms and self.vIn.microphones is None:  # Every room's microphone is listened to at once
+            self.vIn.microphones = self.microphones()
+        self.vIn.recent.key = light_api.phrase_key  # A command heard by two microphones is only sent once
+        if voice_response:  # Every reply _voice_response can give, rendered ahead so they play back straight away
+            nouns = ["lights"] + list(light_api.light_owners)
+            self.vOut.prepare([SPEECH_RESPONSES[command] + " " + noun for command in SPEECH_RESPONSES
+                               for noun in nouns])
+        if metrics_file is not None:
+            self.metrics.start_writer(metrics_file, metrics_interval)
+        if metrics_port is not None:
+            self.metrics.serve(metrics_port)
+        if command_port is not None:
+            dispatcher.serve(command_port)
+
+        # Keeps listening while earlier commands are handled
+        for words, trace in self.vIn.stream_voice_input(traced=True):
             if "exit voice" in words:
                 sys.exit(0)
-            elif words == "Audio not understood":
+            elif words == VC.AUDIO_NOT_UNDERSTOOD:
                 continue
 
-            response = light_api.run_commands(words)
+            response = dispatcher.dispatch(words, trace)
             if debug:
                 print(response)
             if voice_response:
@@ -552,5 +1629,5 @@ class Activation(Lights):
             elif list(result)[0] == "ERROR":
                 speech_responses.add(result["ERROR"])
 
-        for res in speech_responses:
-            self.vOut.speak(res)
+        for i, res in enumerate(speech_responses):  # A new reply cuts off whatever is left of the last one
+            self.vOut.speak(res, interrupt=i == 0)
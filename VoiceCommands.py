@@ -1,11 +1,215 @@
 import speech_recognition as sr  # Module for getting microphone audio to text
 import pyttsx3  # Module for computer speaking back to user
+import Metrics as MX
+import collections
+import itertools
+import abc
+import threading
+import tempfile
+import queue
+import json
+import time
+import wave
+import os
+import re
+
+try:
+    import winsound  # Plays back pre-rendered phrases, only available on Windows like the sapi5 voice
+except ImportError:
+    winsound = None
+
+AUDIO_NOT_UNDERSTOOD = "Audio not understood"
+DEFAULT_MICROPHONE = "default"  # The system's default input device, for a room's microphone
+
+# Spoken numbers for engines whose vocabulary has no digits, converted back to digits after recognition
+ONES = ["zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "eleven",
+        "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen", "nineteen"]
+TENS = ["", "", "twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety"]
+
+
+def number_to_words(number):
+    if number < 20:
+        return ONES[number]
+    if number < 100:
+        return TENS[number // 10] + ("" if number % 10 == 0 else " " + ONES[number % 10])
+    if number == 100:
+        return "one hundred"
+    return " ".join(ONES[int(digit)] for digit in str(number))  # Spelled out digit by digit
+
+
+def words_to_numbers(words, keep=()):
+    # Words in keep are left spelled out, e.g. when they are part of a light name like 'lamp two'
+    result = []
+    for word in words.split():
+        value = None if word in keep else ONES.index(word) if word in ONES else \
+            TENS.index(word) * 10 if word in TENS[2:] else None
+        if word == "hundred" and result and result[-1] == "1":
+            result[-1] = "100"
+        elif value is not None and 0 < value < 10 and result and re.fullmatch(r"[2-9]0", result[-1]):
+            result[-1] = str(int(result[-1]) + value)  # e.g. twenty five
+        elif value is not None:
+            result.append(str(value))
+        else:
+            result.append(word)
+    return " ".join(result)
+
+
+class RecognizerBackend(abc.ABC):
+
+    """
+    The speech recognition engine CommandInputs uses to turn a phrase of audio into words.
+    recognize should raise sr.UnknownValueError when nothing was understood and sr.RequestError
+    when the engine could not be used. Engines that can be limited to the phrases the program
+    understands are given them with set_grammar once the lights are configured.
+    """
+
+    def set_grammar(self, phrases):
+        pass
+
+    @abc.abstractmethod
+    def recognize(self, recognizer, audio):
+        pass
+
+
+class GoogleBackend(RecognizerBackend):
+
+    """
+    Open dictation through the Google Web Speech API. Needs a network connection.
+    """
+
+    def recognize(self, recognizer, audio):
+        return recognizer.recognize_google(audio)
+
+
+class VoskBackend(RecognizerBackend):
+
+    """
+    Offline recognition on this machine with a Vosk model (https://alphacephei.com/vosk/models) loaded
+    once from model_path. Once set_grammar is called, recognition is limited to the words of the commands,
+    light names, colors and numbers the program understands, which is both faster and more accurate than
+    open dictation. Requires the vosk package.
+    """
+
+    SAMPLE_RATE = 16000
+
+    def __init__(self, model_path):
+        try:
+            import vosk
+        except ImportError:
+            raise Exception("The vosk package is required for offline recognition (pip install vosk).")
+        vosk.SetLogLevel(-1)
+        self.vosk = vosk
+        self.model = vosk.Model(model_path)
+        self.grammar = None  # JSON list of phrases, None for open dictation
+        self.spelled = set()  # Number words that are spelled out in the phrases themselves
+
+    def set_grammar(self, phrases):
+        vocabulary = []
+        self.spelled = {word for phrase in phrases for word in phrase.lower().split() if word in ONES + TENS}
+        for phrase in phrases:
+            phrase = re.sub(r"\d+", lambda number: number_to_words(int(number.group())), phrase.lower())
+            vocabulary += [phrase] + phrase.split()  # Whole phrases help, single words allow any order
+        vocabulary += [number_to_words(number) for number in range(101)]  # Percentages
+        self.grammar = json.dumps(sorted(set(vocabulary)) + ["[unk]"])
+
+    def recognize(self, recognizer, audio):
+        if self.grammar is None:
+            engine = self.vosk.KaldiRecognizer(self.model, self.SAMPLE_RATE)
+        else:
+            engine = self.vosk.KaldiRecognizer(self.model, self.SAMPLE_RATE, self.grammar)
+        engine.AcceptWaveform(audio.get_raw_data(convert_rate=self.SAMPLE_RATE, convert_width=2))
+        words = json.loads(engine.FinalResult()).get("text", "").replace("[unk]", "").strip()
+        if not words:
+            raise sr.UnknownValueError()
+        return words_to_numbers(words, self.spelled)
+
+
+def find_microphone(microphone):
+    # The device index of a microphone given by index or by part of its name, None for the default one
+    if microphone is None or microphone == DEFAULT_MICROPHONE or isinstance(microphone, int):
+        return None if microphone == DEFAULT_MICROPHONE else microphone
+    for index, name in enumerate(sr.Microphone.list_microphone_names()):
+        if microphone.lower() in name.lower():
+            return index
+    raise Exception("No microphone named '" + microphone + "' was found.")
+
+
+class RecentPhrases:
+
+    """
+    The phrases recently heard and which microphone heard them, so that a phrase heard by a second
+    microphone within window seconds of the first (measured from when each finished hearing it) is
+    recognized as the same utterance. The microphone that heard it first decides its room.
+
+    Phrases are compared by key(words), which should give the same key for different transcripts of
+    the same command (e.g. what it does, see LightAPI.phrase_key). Without one the words are compared.
+    """
+
+    def __init__(self, window=1.0, key=None):
+        self.window = window
+        self.key = key
+        self.heard = {}  # Key -> (when the phrase ended, microphone)
+
+    def repeated(self, words, microphone, when):
+        key = self.key(words) if self.key is not None else " ".join(words.lower().split())
+        last = self.heard.get(key)
+        if last is not None and last[1] != microphone and abs(when - last[0]) <= self.window:
+            return True
+        self.heard[key] = (when, microphone)
+        if len(self.heard) > 64:  # Only the last few seconds are ever compared
+            self.heard = {words: heard for words, heard in self.heard.items() if when - heard[0] <= self.window}
+        return False
+
+
+class TappedStream:
+
+    """
+    Wraps the stream of an open sr.Microphone, handing every chunk read from it for recognition to
+    the listeners as well, so they can use the microphone's audio without opening the device again.
+    """
+
+    def __init__(self, stream, listeners, room, sample_rate, sample_width):
+        self.stream = stream
+        self.listeners = listeners
+        self.room = room
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+
+    def read(self, size):
+        data = self.stream.read(size)
+        for listener in self.listeners:
+            listener(self.room, data, self.sample_rate, self.sample_width)
+        return data
+
+    def close(self):
+        self.stream.close()
 
 
 class CommandInputs:
-    def __init__(self, pause_threshold=0.5):
+    # gate is a VoiceGate.SpeechGate that drops phrases unlikely to be commands before they are recognized.
+    # microphones maps each room to its microphone (see find_microphone), all of them are listened to at
+    # once and a phrase heard by more than one of them within dedupe_window seconds is only yielded once.
+    # Functions in listeners are called with (room, chunk, sample rate, sample width) for all the audio read.
+    # speech is the CommandOutputs replying to the commands. A phrase heard while it spoke is dropped when it
+    # is the reply itself, otherwise it is a command spoken over the reply, which is cut off for it.
+    def __init__(self, pause_threshold=0.5, workers=2, queue_size=8, backend=None, metrics=None, gate=None,
+                 microphones=None, dedupe_window=1.0):
         self.recognizer = sr.Recognizer()
         self.pause_duration = pause_threshold  # Time it gives to register a phrase once completed (in seconds)
+        self.workers = workers  # Phrases recognized at the same time when streaming
+        self.queue_size = queue_size  # Phrases captured but not yet recognized before capture waits
+        self.backend = backend if backend is not None else GoogleBackend()
+        self.metrics = metrics if metrics is not None else MX.Metrics()
+        self.gate = gate
+        self.microphones = microphones  # Room -> microphone, None listens to the default one without a room
+        self.recent = RecentPhrases(dedupe_window)
+        self.listeners = []
+        self.speech = None
+
+    def set_grammar(self, phrases):
+        if self.gate is not None and self.gate.wake_phrase:
+            phrases = list(phrases) + [self.gate.wake_phrase]
+        self.backend.set_grammar(phrases)
 
     def get_voice_input(self):
         # obtain audio from the microphone
@@ -13,22 +217,290 @@ class CommandInputs:
             print("Say something!")
             self.recognizer.pause_threshold = self.pause_duration
             audio = self.recognizer.listen(source)
-        # recognize speech using Google Speech Recognition
+        if not self.passes_gate(audio):
+            return AUDIO_NOT_UNDERSTOOD
+        return self.recognize(audio)
+
+    def passes_gate(self, audio):
+        if self.gate is None:
+            return True
+        passed, reason = self.gate.check(audio)
+        self.metrics.count("gate_passed" if passed else "gate_rejected")
+        return passed
+
+    def enroll_wake_phrase(self, times=3):
+        # Records the gate's wake phrase from the microphone, it is then required in front of every command
+        with sr.Microphone() as source:
+            self.recognizer.pause_threshold = self.pause_duration
+            for i in range(times):
+                print(f"Say '{self.gate.wake_phrase}' ({i + 1} of {times})")
+                self.gate.enroll(self.recognizer.listen(source))
+
+    def recognize(self, audio):
+        # recognize speech using the configured backend
         try:
-            return self.recognizer.recognize_google(audio)
+            return self.backend.recognize(self.recognizer, audio)
         except sr.UnknownValueError:
-            return "Audio not understood"
-        except sr.RequestError as e:
-            return "Could not request results from Google Speech Recognition service; {0}".format(e)
+            return AUDIO_NOT_UNDERSTOOD
+        except sr.RequestError as e:  # Reported here rather than handed on to be parsed as a command
+            print("Could not request results from the speech recognition service; {0}".format(e))
+            return AUDIO_NOT_UNDERSTOOD
+
+    def stream_voice_input(self, traced=False):
+        # Yields each phrase in the order it was spoken, from a microphone that is kept open. A capture
+        # thread keeps splitting the audio into phrases while earlier ones are still being recognized by
+        # the worker threads, so nothing said in the meantime is lost. It waits when the queue is full.
+        # When traced, (words, trace) is yielded so the caller can time the rest of the phrase's handling.
+        # With several microphones each has a capture thread of its own, trace.room tells them apart.
+        # A microphone that cannot be opened or read is reported, and its error raised once none are left.
+        phrases = queue.Queue(maxsize=self.queue_size)  # (sequence number, audio, trace)
+        results = queue.Queue()  # (sequence number, words, trace) in the order they finish, (None, error, room)
+        stop = threading.Event()
+        microphones = self.microphones or {None: None}
+        sequence = itertools.count()  # Shared by the microphones, phrases are yielded in the order they ended
+
+        for room, microphone in microphones.items():
+            threading.Thread(target=self._capture, args=(phrases, results, stop, sequence, room, microphone),
+                             name="Capture" if room is None else f"Capture-{room}", daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._recognize_phrases, args=(phrases, results, stop),
+                             name=f"Recognizer-{i}", daemon=True).start()
+
+        finished = {}
+        next_seq = 0
+        failed = 0  # Microphones that stopped
+        try:
+            while True:
+                seq, words, trace = results.get()
+                if seq is None:  # words is the error that stopped the microphone of room trace
+                    failed += 1
+                    if failed == len(microphones):
+                        raise words
+                    continue
+                finished[seq] = (words, trace)
+                while next_seq in finished:  # Hold back phrases that finished before an earlier one
+                    words, trace = finished.pop(next_seq)
+                    next_seq += 1
+                    trace.lap("reorder")
+                    if words == AUDIO_NOT_UNDERSTOOD:
+                        self.metrics.count("not_understood")
+                    elif self._own_speech(words, trace):
+                        self.metrics.count("own_speech")  # A reply would be heard as the command it repeats
+                        trace.finish(words)
+                        continue
+                    elif len(microphones) > 1 and self.recent.repeated(words, trace.room, trace.start):
+                        self.metrics.count("duplicate_phrases")  # Heard by a nearby microphone as well
+                        trace.finish(words)
+                        continue
+                    yield (words, trace) if traced else words
+        finally:
+            stop.set()
+
+    def _own_speech(self, words, trace):
+        # Whether the phrase is a reply the microphone picked up. Anything else said over a reply cuts it off.
+        if self.speech is None:
+            return False
+        began = trace.start - trace.spans.get("capture", 0.0)
+        if self.speech.heard_itself(words, began, trace.start):
+            return True
+        if self.speech.spoke_during(began, trace.start):
+            self.speech.stop()
+        return False
+
+    def _capture(self, phrases, results, stop, sequence, room=None, microphone=None):
+        try:
+            self._listen(phrases, stop, sequence, room, microphone)
+        except Exception as Ex:
+            print("The microphone" + ("" if room is None else f" of {room}") + " stopped: " + str(Ex))
+            self.metrics.count("microphone_errors")
+            results.put((None, Ex, room))
+
+    def _listen(self, phrases, stop, sequence, room, microphone):
+        recognizer = sr.Recognizer()  # Each microphone adjusts to the noise of its own room
+        recognizer.pause_threshold = self.pause_duration
+        with sr.Microphone(device_index=find_microphone(microphone)) as source:
+            print("Say something!" if room is None else f"Say something! (listening in {room})")
+            if self.listeners:
+                source.stream = TappedStream(source.stream, self.listeners, room, source.SAMPLE_RATE,
+                                             source.SAMPLE_WIDTH)
+            while not stop.is_set():
+                try:
+                    audio = recognizer.listen(source, timeout=1)  # Wakes up to check if it should stop
+                except sr.WaitTimeoutError:
+                    continue
+                start = time.monotonic()  # Once the phrase is over
+                duration = len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+                if not self.passes_gate(audio):
+                    continue  # Never takes up a recognizer or a place in the sequence
+                trace = self.metrics.trace(start, room)
+                trace.add("capture", duration)
+                trace.lap("gate")
+                item = (next(sequence), audio, trace)
+                while not stop.is_set():  # Waits for a recognizer, unless the stream was closed meanwhile
+                    try:
+                        phrases.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+
+    def _recognize_phrases(self, phrases, results, stop):
+        while not stop.is_set():
+            try:
+                seq, audio, trace = phrases.get(timeout=0.5)  # Wakes up to check if it should stop
+            except queue.Empty:
+                continue
+            trace.lap("queue")
+            try:
+                with trace.span("asr"):
+                    words = self.recognize(audio)
+                if self.gate is not None:
+                    words = self.gate.strip_wake_phrase(words)
+            except Exception:  # Its place in the sequence still has to be filled
+                words = AUDIO_NOT_UNDERSTOOD
+            results.put((seq, words, trace))
 
 
 class CommandOutputs:
-    def __init__(self):
-        self.engine = pyttsx3.init('sapi5')
-        self.voices = self.engine.getProperty('voices')
-        self.engine.setProperty('voice', self.voices[0].id)
+    def __init__(self, queue_size=4):
+        # Messages are spoken by a worker thread of their own so the microphone keeps listening meanwhile
+        self.messages = queue.Queue(maxsize=queue_size)  # (generation, message)
+        self.renders = queue.Queue()  # Phrases waiting to be rendered to audio files
+        self.cache = {}  # Phrase -> (wav file, duration in seconds)
+        self.cache_dir = tempfile.TemporaryDirectory(prefix="VocaLights-")
+        self.generation = 0  # Raised by an interrupting message, anything queued or spoken before it is dropped
+        self.lock = threading.Lock()
+        self.speaking = 0  # Generation of the message being spoken
+        # [started, ended, message] of the latest messages, ended is None while it is spoken
+        self.spoken = collections.deque(maxlen=8)
+
+        self.engine = None
+        self.voices = None
+        errors = []
+        started = threading.Event()
+        threading.Thread(target=self._speak_messages, args=(started, errors), name="Speech", daemon=True).start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+    def speak(self, audio, interrupt=False):
+        # Returns straight away. When the queue is full the oldest waiting message is dropped for this one.
+        with self.lock:
+            if interrupt:
+                self.generation += 1
+                self._drop_waiting()
+            while True:
+                try:
+                    self.messages.put_nowait((self.generation, audio))
+                    break
+                except queue.Full:
+                    self._drop_waiting(1)
+
+    def stop(self):
+        # Cuts off whatever is being spoken and drops the messages waiting
+        with self.lock:
+            self.generation += 1
+            self._drop_waiting()
 
-    def speak(self, audio):
-        self.engine.say(audio)
-        self.engine.runAndWait()
+    def spoke_during(self, began, ended, echo=0.3):
+        # Whether anything was being spoken between began and ended (time.monotonic), or echo seconds before
+        return bool(self._spoken_during(began, ended, echo))
+
+    def heard_itself(self, words, began, ended, echo=0.3):
+        # Whether words, heard between began and ended, are a run of the words of a message spoken meanwhile
+        heard = re.findall(r"[a-z0-9]+", words.lower())
+        for message in self._spoken_during(began, ended, echo):
+            said = re.findall(r"[a-z0-9]+", str(message).lower())
+            if heard and any(said[i:i + len(heard)] == heard for i in range(len(said) - len(heard) + 1)):
+                return True
+        return False
+
+    def _spoken_during(self, began, ended, echo):
+        with self.lock:
+            return [message for started, stopped, message in self.spoken
+                    if started <= ended and (stopped is None or stopped + echo >= began)]
+
+    def prepare(self, phrases):
+        # Renders the phrases in the background while nothing is being spoken, they play back instantly after
+        if winsound is None:
+            return
+        for phrase in phrases:
+            self.renders.put(phrase)
+        try:
+            self.messages.put_nowait((None, None))  # Wakes the worker if it is waiting for a message
+        except queue.Full:
+            pass  # Busy speaking, it renders once the messages run out
 
+    def _drop_waiting(self, count=None):
+        while count is None or count > 0:
+            try:
+                self.messages.get_nowait()
+            except queue.Empty:
+                break
+            count = count - 1 if count is not None else None
+
+    def _speak_messages(self, started, errors):
+        # The engine is created here as sapi5 can only be driven from the thread that made it
+        try:
+            self.engine = pyttsx3.init('sapi5')
+            self.voices = self.engine.getProperty('voices')
+            self.engine.setProperty('voice', self.voices[0].id)
+            self.engine.connect('started-word', self._check_interrupt)
+        except Exception as Ex:
+            errors.append(Ex)
+            return
+        finally:
+            started.set()
+
+        while True:
+            if self.renders.empty():
+                message = self.messages.get()
+            else:
+                try:
+                    message = self.messages.get_nowait()
+                except queue.Empty:
+                    self._render(self.renders.get())
+                    continue
+
+            generation, audio = message
+            if generation != self.generation:
+                continue  # Interrupted before it was spoken
+            self.speaking = generation
+            spoken = [time.monotonic(), None, audio]
+            with self.lock:
+                self.spoken.append(spoken)
+            try:
+                if audio in self.cache:
+                    self._play(*self.cache[audio], generation)
+                else:
+                    self.engine.say(audio)
+                    self.engine.runAndWait()
+            except Exception as Ex:
+                print("Could not speak response: " + str(Ex))
+            finally:
+                with self.lock:
+                    spoken[1] = time.monotonic()
+
+    def _check_interrupt(self, name, location, length):
+        if self.speaking != self.generation:
+            self.engine.stop()
+
+    def _play(self, path, duration, generation):
+        winsound.PlaySound(path, winsound.SND_FILENAME | winsound.SND_ASYNC | winsound.SND_NODEFAULT)
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            if generation != self.generation:
+                winsound.PlaySound(None, 0)  # Stops the sound playing
+                return
+            time.sleep(0.02)
+
+    def _render(self, phrase):
+        if phrase in self.cache:
+            return
+        path = os.path.join(self.cache_dir.name, "%d.wav" % len(self.cache))
+        try:
+            self.engine.save_to_file(phrase, path)
+            self.engine.runAndWait()
+            with wave.open(path) as rendered:
+                self.cache[phrase] = (path, rendered.getnframes() / rendered.getframerate())
+        except Exception as Ex:
+            print("Could not render '" + phrase + "': " + str(Ex))
@@ -0,0 +1,168 @@
+import collections
+import threading
+import os
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+FRAME = 400  # 25 ms analysis frames
+HOP = 160  # every 10 ms
+FFT_SIZE = 512
+SPEECH_BAND = (300, 3400)  # Hz, where most of the energy of speech is
+BANDS = np.geomspace(200, 7000, 21)  # Edges of the band energies compared against the wake phrase
+
+
+def frame_features(samples):
+    """
+    Splits 16 kHz samples into overlapping frames and returns, for each frame, its energy (dB), its
+    spectral flatness and the share of its energy in SPEECH_BAND, along with the log energy of each
+    band in BANDS. Noise has a flat spectrum spread over every frequency, voiced speech a peaky one
+    concentrated in the speech band.
+    """
+    samples = np.asarray(samples, dtype=float) / 32768
+    if len(samples) < FRAME:
+        samples = np.pad(samples, (0, FRAME - len(samples)))
+    count = 1 + (len(samples) - FRAME) // HOP
+    frames = samples[np.arange(FRAME)[None, :] + HOP * np.arange(count)[:, None]] * np.hanning(FRAME)
+    power = np.abs(np.fft.rfft(frames, FFT_SIZE)) ** 2 + 1e-12
+    freqs = np.fft.rfftfreq(FFT_SIZE, 1 / SAMPLE_RATE)
+
+    speech = power[:, (freqs >= SPEECH_BAND[0]) & (freqs <= SPEECH_BAND[1])]
+    energy = 10 * np.log10(power.sum(axis=1))
+    flatness = np.exp(np.log(speech).mean(axis=1)) / speech.mean(axis=1)
+    ratio = speech.sum(axis=1) / power.sum(axis=1)
+    bands = np.stack([power[:, (freqs >= low) & (freqs < high)].sum(axis=1)
+                      for low, high in zip(BANDS[:-1], BANDS[1:])], axis=1)
+    return energy, flatness, ratio, np.log(bands + 1e-12)
+
+
+def longest_run(mask):
+    # Length of the longest stretch of True values
+    if not mask.any():
+        return 0
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.astype(int), [0]))))
+    return int((edges[1::2] - edges[::2]).max())
+
+
+def dtw_distance(template, sequence):
+    """
+    How far the start of sequence is from the template (both frames x bands), by dynamic time warping
+    with a free end, so the template can match however much of the sequence the phrase took. Rows are
+    filled with a running minimum instead of a loop over every cell.
+    """
+    cost = np.sqrt(((template[:, None, :] - sequence[None, :, :]) ** 2).sum(axis=2))
+    row = np.cumsum(cost[0])
+    for i in range(1, len(template)):
+        above = np.minimum(row, np.concatenate(([np.inf], row[:-1])))  # From the cell above or diagonal
+        total = np.cumsum(cost[i])
+        row = total + np.minimum.accumulate(above + cost[i] - total)  # Or from the cell to the left
+    lengths = len(template) + np.arange(1, len(sequence) + 1)
+    return float((row / lengths).min())
+
+
+class SpeechGate:
+
+    """
+    Decides from the raw audio of each phrase the microphone captures whether it is likely to be a
+    command, so noise, music and background talk are dropped before they reach the recognizer.
+
+    Each 10 ms frame counts as speech when it is louder than the noise floor (tracked from the quiet
+    parts of recent phrases), has a peaky rather than a flat spectrum and has most of its energy in
+    the speech band. A phrase passes when it has a long enough stretch of speech, and not so much of
+    it that it is more likely a conversation or the TV than a command. sensitivity (0 to 1) lowers
+    every threshold as it is raised, letting quieter and noisier phrases through.
+
+    A wake phrase can also be required: once it has been recorded a few times with enroll, only
+    phrases that start with something close to a recording (compared frame by frame on their band
+    energies) pass. Recordings are kept in templates_file so they only have to be made once.
+
+    Counts of the phrases passed and rejected (by reason) are kept for stats().
+    """
+
+    def __init__(self, sensitivity=0.5, min_speech=0.25, max_speech=6.0, wake_phrase=None, templates_file=None):
+        self.sensitivity = sensitivity
+        self.min_speech = min_speech  # Shortest stretch of speech a command has (in s)
+        self.max_speech = max_speech  # Most speech a command has (in s)
+        self.wake_phrase = wake_phrase.lower() if wake_phrase else None
+        self.templates_file = os.path.expanduser(templates_file or "~/.vocalights_wake.npz")
+        self.templates = []
+        if wake_phrase and os.path.exists(self.templates_file):
+            with np.load(self.templates_file) as saved:
+                self.templates = [saved[key] for key in sorted(saved.files)]
+        self.noise_floor = None  # dB
+        self.lock = threading.Lock()
+
+        # Stats
+        self.passed = 0
+        self.rejected = collections.Counter()  # Reason -> phrases
+
+    def check(self, audio):
+        # Returns (passed, reason) for a speech_recognition AudioData phrase
+        samples = np.frombuffer(audio.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=2), dtype=np.int16)
+        energy, flatness, ratio, bands = frame_features(samples)
+        reason = self._reason(energy, flatness, ratio, bands)
+        with self.lock:
+            if reason is None:
+                self.passed += 1
+            else:
+                self.rejected[reason] += 1
+        return reason is None, reason
+
+    def _reason(self, energy, flatness, ratio, bands):
+        # Quiet frames of this phrase and the recent ones give the noise floor
+        with self.lock:
+            floor = np.percentile(energy, 10)
+            self.noise_floor = floor if self.noise_floor is None else 0.9 * self.noise_floor + 0.1 * floor
+            floor = min(floor, self.noise_floor)
+
+        margin = 4 + 12 * (1 - self.sensitivity)  # dB above the floor
+        loud = energy > floor + margin
+        speech = loud & (flatness < 0.25 + 0.2 * self.sensitivity) & (ratio > 0.6 - 0.2 * self.sensitivity)
+        frames_per_second = SAMPLE_RATE / HOP
+        if not loud.any():
+            return "quiet"
+        if not speech.any():
+            return "noise"
+        if longest_run(speech) < self.min_speech * (1.5 - self.sensitivity) * frames_per_second:
+            return "short"
+        if speech.sum() > self.max_speech * frames_per_second:
+            return "long"
+        if self.templates and not self._starts_with_wake_phrase(bands, speech):
+            return "wake"
+        return None
+
+    def _starts_with_wake_phrase(self, bands, speech):
+        start = int(np.flatnonzero(speech)[0])
+        shapes = bands - bands.mean(axis=1, keepdims=True)  # Spectral shape, however loud it was said
+        threshold = 2.0 + 2.0 * self.sensitivity
+        for template in self.templates:
+            window = shapes[start:start + int(len(template) * 1.5)]
+            if dtw_distance(template, window) < threshold:
+                return True
+        return False
+
+    def enroll(self, audio, save=True):
+        # Records one more example of the wake phrase, only its speech is kept
+        samples = np.frombuffer(audio.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=2), dtype=np.int16)
+        energy, flatness, ratio, bands = frame_features(samples)
+        loud = energy > np.percentile(energy, 10) + 4 + 12 * (1 - self.sensitivity)
+        if not loud.any():
+            raise Exception("No speech was heard in the recording of the wake phrase.")
+        voiced = np.flatnonzero(loud)
+        template = bands[voiced[0]:voiced[-1] + 1]
+        self.templates.append(template - template.mean(axis=1, keepdims=True))
+        if save:
+            np.savez(self.templates_file, *self.templates)
+
+    def strip_wake_phrase(self, words):
+        # The recognized words without the wake phrase in front of the command
+        if self.wake_phrase and words.lower().startswith(self.wake_phrase):
+            return words[len(self.wake_phrase):].strip()
+        return words
+
+    def stats(self):
+        with self.lock:
+            return {"passed": self.passed, "rejected": dict(self.rejected),
+                    "total_rejected": sum(self.rejected.values()),
+                    "noise_floor_db": None if self.noise_floor is None else float(self.noise_floor),
+                    "wake_templates": len(self.templates)}
@@ -0,0 +1,30 @@
+import logging
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import VocaLights as V  # noqa: E402
+import Simulators as S  # noqa: E402
+
+logging.getLogger("phue").setLevel(logging.ERROR)  # Simulated lights that are off refusing colors is expected
+
+
+@pytest.fixture
+def simulated_lifx(tmp_path):
+    # Configures simulated LifX bulbs, call it with the number of bulbs and any configure_lights options.
+    # Returns (simulator, Lights, LightAPI), the scenes and devices are saved in the test's own directory.
+    simulators = []
+
+    def configure(bulbs=2, latency=0, loss=0.0, names=None, startup="parallel", **options):
+        lifx = S.LifxSimulator(bulbs, latency, loss)
+        simulators.append(lifx)
+        lights = V.Lights(scene_file=str(tmp_path / "scenes.json"), device_file=str(tmp_path / "devices.json"))
+        lights.configure_lights("lifx", startup=startup, **options, **lifx.settings(names))
+        return lifx, lights, V.Lights.LightAPI(lights.light_objects, scenes=lights.scenes)
+
+    yield configure
+    for lifx in simulators:
+        lifx.stop()
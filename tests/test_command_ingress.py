@@ -0,0 +1,48 @@
+import io
+import json
+import urllib.request
+import urllib.error
+
+import pytest
+
+import CommandIngress as CI
+import VocaLights as V
+
+
+def test_dispatcher_needs_configured_lights():
+    with pytest.raises(Exception):
+        CI.CommandDispatcher(V.Lights())
+
+
+def test_replay_skips_comments_and_keeps_the_order(simulated_lifx):
+    lifx, lights, api = simulated_lifx()
+    dispatcher = CI.CommandDispatcher(lights)
+    output = io.StringIO()
+    responses = dispatcher.replay(["# setup\n", "turn on bulb 1\n", "\n", "turn on bulb 2\n"], output, concurrency=2)
+    assert responses == [[{"SUCCESS": {"turn on": ["bulb 1"]}, "Class": "lifx"}],
+                         [{"SUCCESS": {"turn on": ["bulb 2"]}, "Class": "lifx"}]]
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line["words"] for line in lines] == ["turn on bulb 1", "turn on bulb 2"]
+    assert all(bulb["power"] for bulb in lifx.bulbs.values())
+    assert lights.metrics.snapshot()["counters"]["replay_commands"] == 2
+
+
+def test_commands_over_http(simulated_lifx):
+    lifx, lights, api = simulated_lifx()
+    dispatcher = CI.CommandDispatcher(lights)
+    port = dispatcher.serve(0)
+    url = "http://127.0.0.1:%d" % port
+    try:
+        with urllib.request.urlopen(url + "/command?words=turn+on+bulb+1") as reply:
+            assert json.load(reply)["response"] == [{"SUCCESS": {"turn on": ["bulb 1"]}, "Class": "lifx"}]
+        with urllib.request.urlopen(url + "/commands", json.dumps(["turn off bulb 1"]).encode()) as reply:
+            assert json.load(reply)[0]["words"] == "turn off bulb 1"
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + "/command")
+        assert error.value.code == 400
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + "/commands", b"not json")
+        assert error.value.code == 400
+    finally:
+        dispatcher.stop()
+    assert lights.metrics.snapshot()["counters"]["http_commands"] == 2
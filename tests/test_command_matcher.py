@@ -0,0 +1,60 @@
+import CommandMatcher as CM
+
+COMMANDS = ["turn on", "turn off", "change color", "dim", "disco on", "disco off"]
+LIGHTS = ["light 1", "light 10", "desk lamp", "lamp"]
+COLORS = ["red", "blue", "light blue"]
+
+
+def matcher():
+    return CM.CommandMatcher(COMMANDS, LIGHTS, COLORS)
+
+
+def test_tokenize_lowercases_and_drops_punctuation():
+    assert CM.tokenize("Turn ON, light 1!") == ["turn", "on", "light", "1"]
+
+
+def test_longest_light_name_wins():
+    assert matcher().match("turn on light 10").lights == ["light 10"]
+    assert matcher().match("turn on light 1").lights == ["light 1"]
+    assert matcher().match("turn off desk lamp").lights == ["desk lamp"]
+
+
+def test_longest_color_wins_over_light_name_prefix():
+    intent = matcher().match("change color of lamp to light blue")
+    assert (intent.command, intent.lights, intent.color) == ("change color", ["lamp"], "light blue")
+
+
+def test_percent_is_a_number_outside_light_names():
+    intent = matcher().match("dim light 10 to 30 percent")
+    assert (intent.lights, intent.percent) == (["light 10"], 30)
+    assert matcher().match("dim light 1").percent is None
+
+
+def test_last_number_is_the_percent():
+    assert matcher().match("dim to 20 no 40").percent == 40
+
+
+def test_first_command_and_color_are_kept():
+    intent = matcher().match("turn on change color red blue")
+    assert (intent.command, intent.color) == ("turn on", "red")
+
+
+def test_lights_are_listed_once_in_order_heard():
+    assert matcher().match("turn on lamp light 1 lamp").lights == ["lamp", "light 1"]
+
+
+def test_unknown_words_are_the_remainder():
+    intent = matcher().match("disco on for the party")
+    assert (intent.command, intent.remainder) == ("disco on", ["for", "the", "party"])
+
+
+def test_no_command():
+    intent = matcher().match("hello there")
+    assert intent.command is None and intent.lights == []
+
+
+def test_light_api_sends_matched_command_to_simulated_lights(simulated_lifx):
+    lifx, lights, api = simulated_lifx(3)
+    assert api.run_commands("turn on bulb 2") == [{"SUCCESS": {"turn on": ["bulb 2"]}, "Class": "lifx"}]
+    assert api.run_commands("change color of bulb 1 to red") == [
+        {"SUCCESS": {"change color": ["bulb 1"]}, "Class": "lifx"}]
@@ -0,0 +1,66 @@
+import pytest
+
+import CommandMatcher as CM
+import CommandPlans as CP
+import VocaLights as V
+import Simulators as S
+
+COLORS = {"red": [1, 0], "blue": [0, 0]}
+
+
+def intent(**fields):
+    return CM.Intent("", **fields)
+
+
+def test_color_plan_binds_the_spoken_color():
+    plan = CP.compile_plan("change color", "xy", COLORS, 2.54)
+    assert plan.kind == CP.COLOR
+    assert plan.bind(intent(color="red")) == [1, 0]
+    assert plan.bind(intent()) is None
+
+
+def test_level_plan_scales_a_percent_or_sends_its_default():
+    plan = CP.compile_plan("dim", "bri", "dynaInt5", 2.54)
+    assert (plan.kind, plan.value) == (CP.LEVEL, 5)
+    assert plan.bind(intent(percent=50)) == 127
+    assert plan.bind(intent()) == 5
+
+
+def test_effect_plans():
+    start = CP.compile_plan("disco on", "xy", [True, "disco", 0.1, COLORS], 2.54)
+    stop = CP.compile_plan("disco off", "xy", [False, "disco"], 2.54)
+    assert (start.kind, start.effect, start.period, start.values) == (CP.START, "disco", 0.1, ([1, 0], [0, 0]))
+    assert (stop.kind, stop.effect) == (CP.STOP, "disco")
+
+
+def test_set_plan_sends_its_value():
+    plan = CP.compile_plan("turn on", "on", True, 2.54)
+    assert (plan.kind, plan.bind(intent(percent=10))) == (CP.SET, True)
+
+
+def test_plans_cannot_be_changed():
+    plan = CP.compile_plan("turn on", "on", True, 2.54)
+    with pytest.raises(AttributeError):
+        plan.value = False
+
+
+def test_lifx_plans_carry_the_rate_as_duration():
+    plans = CP.compile_lifx({"dim": {"set_brightness": "dynaInt32500", "rate": 3000}, "turn on": {"set_power": "on"}})
+    assert (plans["dim"].bind(intent(percent=10)), plans["dim"].duration) == (6500, 3000)
+    assert plans["turn on"].duration == 0
+
+
+def test_compiled_plans_drive_simulated_hue_lights():
+    hue = S.HueSimulator(2, 0, 0)
+    try:
+        lights = V.Lights()
+        with S.isolated_phue_config():
+            lights.configure_lights("phue", startup="parallel", group_actions=False, **hue.settings())
+        obj = lights.light_objects[0]
+        assert obj.plans["dim"].kind == CP.LEVEL
+        obj.process_command("turn on hue 2")
+        response = obj.process_command("dim hue 2 to 50 percent")
+        assert response == {"SUCCESS": {"dim": [2]}, "Class": "phue"}
+        assert obj.shadow.get(2, "bri") == 127
+    finally:
+        hue.stop()
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+import DeviceHealth as DH
+
+
+def fail():
+    raise OSError("timed out")
+
+
+def test_opens_after_failures_in_a_row():
+    health = DH.DeviceHealth(failures=3, reset_after=60)
+    for _ in range(2):
+        health.failure("bulb", "timed out")
+    assert health.state("bulb") == DH.CLOSED and health.available("bulb")
+    health.failure("bulb", "timed out")
+    assert health.state("bulb") == DH.OPEN
+    assert not health.available("bulb")
+    assert health.stats()["skipped"] == 1
+    assert health.stats()["devices"]["bulb"] == {"state": DH.OPEN, "failures": 3, "trips": 1,
+                                                 "last_error": "timed out"}
+
+
+def test_success_resets_the_count():
+    health = DH.DeviceHealth(failures=2, reset_after=60)
+    health.failure("bulb", "timed out")
+    health.success("bulb")
+    health.failure("bulb", "timed out")
+    assert health.state("bulb") == DH.CLOSED
+
+
+def test_call_records_and_reraises():
+    health = DH.DeviceHealth(failures=1, reset_after=60)
+    assert health.call("bulb", lambda x: x + 1, 1) == 2
+    with pytest.raises(OSError):
+        health.call("bulb", fail)
+    assert health.state("bulb") == DH.OPEN
+
+
+def test_probe_closes_the_breaker_once_it_succeeds():
+    answering = []
+    health = DH.DeviceHealth(failures=1, reset_after=0.02, max_reset_after=0.04)
+    health.register("bulb", lambda: None if answering else fail())
+    health.failure("bulb", "timed out")
+    time.sleep(0.1)
+    assert health.state("bulb") == DH.OPEN  # Probed and still failing
+    answering.append(True)
+    time.sleep(0.15)
+    assert health.state("bulb") == DH.CLOSED
+
+
+def test_without_a_probe_the_next_request_decides():
+    health = DH.DeviceHealth(failures=2, reset_after=0.02)
+    health.failure("bulb", "timed out")
+    health.failure("bulb", "timed out")
+    time.sleep(0.08)
+    assert health.state("bulb") == DH.CLOSED
+    health.failure("bulb", "timed out")
+    assert health.state("bulb") == DH.OPEN
+
+
+def test_lost_simulated_bulb_is_reported_and_skipped(simulated_lifx):
+    lifx, lights, api = simulated_lifx(loss=1.0, startup="lazy", timeout=0.05)
+    obj = lights.light_objects[0]
+    for _ in range(3):
+        response = obj.process_command("turn on bulb 1")
+    assert response == [{"ERROR": "bulb 1: not answering", "Light": "bulb 1", "Class": "lifx"}]
+    assert lights.health.state("bulb 1") == DH.OPEN
@@ -0,0 +1,46 @@
+import time
+
+import DeviceState as DS
+
+
+def test_only_lights_without_the_value_need_it():
+    shadow = DS.ShadowState()
+    shadow.update(["a", "b"], "power", 65535)
+    assert shadow.changes(["a", "b", "c"], "power", 65535) == ["c"]
+    assert shadow.changes(["a"], "power", 0) == ["a"]
+    assert shadow.stats() == {"checked": 4, "hits": 3, "skipped": 2, "sent": 2, "skip_rate": 0.5}
+
+
+def test_old_values_are_not_trusted():
+    shadow = DS.ShadowState(max_age=0.01)
+    shadow.update(["a"], "power", 0)
+    time.sleep(0.02)
+    assert shadow.changes(["a"], "power", 0) == ["a"]
+    assert shadow.get("a", "power") is None
+    assert shadow.get("a", "power", stale=True) == 0
+
+
+def test_reconcile_returns_what_differed():
+    shadow = DS.ShadowState()
+    shadow.update(["a"], "power", 65535)
+    shadow.update(["a"], "color", [1, 2, 3, 4])
+    assert shadow.reconcile("a", {"power": 0, "color": [1, 2, 3, 4]}) == {"power": 65535}
+    assert shadow.get("a", "power") == 0
+
+
+def test_forget():
+    shadow = DS.ShadowState()
+    shadow.update(["a"], "power", 0)
+    shadow.forget(["a"])
+    assert shadow.changes(["a"], "power", 0) == ["a"]
+
+
+def test_repeated_command_is_not_resent_to_simulated_bulbs(simulated_lifx):
+    lifx, lights, api = simulated_lifx(3)
+    api.run_commands("turn on lights")
+    time.sleep(0.05)
+    writes = lifx.writes
+    assert api.run_commands("turn on lights") == [
+        {"SUCCESS": {"turn on": ["bulb 1", "bulb 2", "bulb 3"]}, "Class": "lifx"}]
+    time.sleep(0.05)
+    assert lifx.writes == writes
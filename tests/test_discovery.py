@@ -0,0 +1,83 @@
+import socket
+
+import Discovery as D
+import VocaLights as V
+import Simulators as S
+
+
+def test_split_address():
+    assert D.split_address("192.168.1.20") == ("192.168.1.20", D.LIFX_PORT)
+    assert D.split_address("127.0.0.1:56701") == ("127.0.0.1", 56701)
+
+
+def test_one_broadcast_finds_every_bulb():
+    lifx = S.LifxSimulator(3, 0, 0)
+    try:
+        found = D.discover_lifx(0.5, targets=[lifx.address])
+        assert set(found) == set(lifx.bulbs)
+        bulb = found[list(lifx.bulbs)[0]]
+        assert bulb["name"] == "bulb 1"
+        assert bulb["ip"] == "%s:%d" % lifx.address
+        assert bulb["state"] == {"power": 0, "color": [0, 0, 65535, 3500]}
+    finally:
+        lifx.stop()
+
+
+def test_unplugged_bulbs_are_not_found():
+    lifx = S.LifxSimulator(3, 0, 0)
+    try:
+        lifx.unplugged.add(list(lifx.bulbs)[1])
+        assert len(D.discover_lifx(0.5, targets=[lifx.address])) == 2
+    finally:
+        lifx.stop()
+
+
+def test_cache_is_saved_and_read_back(tmp_path):
+    lifx = S.LifxSimulator(2, 0, 0)
+    hue = S.HueSimulator(2, 0, 0)
+    path = str(tmp_path / "devices.json")
+    try:
+        cache = D.DiscoveryCache(path, targets=[lifx.address])
+        cache.refresh_lifx()
+        lights = V.Lights()
+        with S.isolated_phue_config():
+            lights.configure_lights("phue", startup="parallel", **hue.settings())
+        bridge = lights.light_objects[0].bridge
+        assert D.discover_hue(bridge)[1]["name"] == "hue 1"
+        cache.refresh_hue("bridge", bridge)
+
+        cached = D.DiscoveryCache(path)
+        ips, names, macs = cached.lifx()
+        assert names == ["bulb 1", "bulb 2"] and macs == list(lifx.bulbs)
+        assert cached.lifx(["bulb 2"])[1] == ["bulb 2"]
+        assert cached.hue("bridge") == ([1, 2], ["hue 1", "hue 2"])
+        assert cached.hue("elsewhere") == ([], [])
+        assert cached.bridges() == ["bridge"]
+    finally:
+        lifx.stop()
+        hue.stop()
+
+
+def test_a_hue_bridge_given_a_new_address_is_followed(tmp_path):
+    hue = S.HueSimulator(2, 0, 0)
+    try:
+        lights = V.Lights(device_file=str(tmp_path / "devices.json"))
+        lights.discovery.portal = hue.portal
+        with S.isolated_phue_config():
+            lights.configure_lights("phue", startup="parallel", **hue.settings())
+        obj = lights.light_objects[0]
+        obj.rediscover(lights.discovery)  # Done straight away when the lights are watched, the id is cached
+        address = "%s:%d" % hue.address
+        assert lights.discovery.devices["hue_bridges"] == {hue.bridge_id.lower(): address}
+
+        with socket.socket() as closed:  # An address nothing answers on, as the old one once DHCP moved the bridge
+            closed.bind(("127.0.0.1", 0))
+            old = "%s:%d" % closed.getsockname()
+        obj.bridge.move(old)
+        lights.discovery.devices["hue_bridges"] = {hue.bridge_id.lower(): old}  # As cached before it moved
+        obj.rediscover(lights.discovery)
+        assert obj.bridge.ip == address
+        assert lights.discovery.hue(address) == ([1, 2], ["hue 1", "hue 2"])
+        assert obj.process_command("turn on hue 1") == {"SUCCESS": {"turn on": [1]}, "Class": "phue"}
+    finally:
+        hue.stop()
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import EffectScheduler as ES
+
+
+class Recorder:
+
+    def __init__(self):
+        self.frames = []
+        self.lock = threading.Lock()
+
+    def execute_frames(self, frames):
+        with self.lock:
+            self.frames.append(list(frames))
+
+
+def test_lights_started_together_tick_in_one_batch():
+    scheduler = ES.EffectScheduler()
+    owner = Recorder()
+    scheduler.start(owner, ["a", "b"], "disco", "xy", ["red", "blue"], 0.02)
+    time.sleep(0.07)
+    scheduler.stop(owner, ["a", "b"])
+    batches = owner.frames
+    assert len(batches) >= 3
+    assert batches[0] == [("a", "xy", "red", None), ("b", "xy", "red", None)] or \
+        batches[0] == [("b", "xy", "red", None), ("a", "xy", "red", None)]
+    assert [frame[2] for frame in batches[1]] == ["blue", "blue"]
+    assert scheduler.stats()["ticks"] == len(batches)
+
+
+def test_each_light_can_have_its_own_values():
+    scheduler = ES.EffectScheduler()
+    owner = Recorder()
+    scheduler.start(owner, ["a", "b"], "colorama", "xy", {"a": [1], "b": [2]}, 0.05)
+    time.sleep(0.02)
+    scheduler.stop(owner, ["a", "b"])
+    assert sorted(owner.frames[0]) == [("a", "xy", 1, None), ("b", "xy", 2, None)]
+
+
+def test_starting_an_effect_replaces_the_running_one():
+    scheduler = ES.EffectScheduler()
+    owner = Recorder()
+    scheduler.start(owner, ["a"], "disco", "xy", ["red"], 0.02)
+    scheduler.start(owner, ["a"], "flash", "bri", [254], 0.02)
+    assert scheduler.running(owner, "a") == "flash"
+    scheduler.stop(owner, ["a"], "disco")  # Not the effect it runs
+    assert scheduler.running(owner, "a") == "flash"
+    scheduler.stop(owner, ["a"])
+    assert scheduler.running(owner, "a") is None
+
+
+def test_stale_entries_do_not_count_as_ticks():
+    scheduler = ES.EffectScheduler()
+    owner = Recorder()
+    for _ in range(5):  # Each replaces the last, leaving stale entries on the heap
+        scheduler.start(owner, ["a"], "disco", "xy", ["red"], 0.05)
+    time.sleep(0.02)
+    scheduler.stop(owner, ["a"])
+    assert scheduler.stats()["ticks"] == 1 and scheduler.stats()["frames"] == 1
+
+
+def test_call_later():
+    scheduler = ES.EffectScheduler()
+    called = threading.Event()
+    start = time.monotonic()
+    scheduler.call_later(0.03, called.set)
+    assert called.wait(1)
+    assert time.monotonic() - start >= 0.03
+
+
+def test_a_bulb_that_does_not_answer_holds_up_neither_the_ticks_nor_the_other_bulbs(simulated_lifx):
+    lifx, lights, api = simulated_lifx(4, timeout=0.3)
+    lifx.unplugged.add(list(lifx.bulbs)[0])  # Each frame sent to it waits out the timeout
+    writes = lifx.writes
+    api.run_commands("disco on")
+    time.sleep(1.0)
+    api.run_commands("disco off")
+    assert lifx.writes - writes >= 3 * 8  # The other bulbs still get their 10 frames a second
+    stats = lights.scheduler.stats()
+    assert stats["skipped_ticks"] == 0 and stats["jitter_max_ms"] < 50
@@ -0,0 +1,36 @@
+import EffectTimelines as ET
+
+
+def test_step_holds_each_color():
+    frames = ET.interpolate([[0, 0], [1, 1]], 2, ET.XY, "step")
+    assert frames.tolist() == [[0, 0], [0, 0], [1, 1], [1, 1]]
+
+
+def test_linear_moves_evenly_and_back_to_the_first_color():
+    frames = ET.interpolate([[0, 0], [1, 0.5]], 2, ET.XY, "linear")
+    assert frames.tolist() == [[0, 0], [0.5, 0.25], [1, 0.5], [0.5, 0.25]]
+
+
+def test_hsbk_hue_takes_the_short_way_round():
+    frames = ET.interpolate([[65000, 1, 1, 3500], [1000, 1, 1, 3500]], 2, ET.HSBK)
+    assert [frame[0] for frame in frames.tolist()] == [65000, 232, 1000, 232]
+
+
+def test_easing_starts_slow():
+    linear = ET.interpolate([[0, 0], [1, 1]], 4, ET.XY, "linear")
+    eased = ET.interpolate([[0, 0], [1, 1]], 4, ET.XY, "ease-in-out")
+    assert eased[1][0] < linear[1][0] and eased[2][0] == linear[2][0]
+
+
+def test_phase_offsets_spread_lights_over_the_cycle():
+    assert ET.phase_offsets(4, 8, 1.0).tolist() == [0, 2, 4, 6]
+    assert ET.phase_offsets(4, 8, 0.0).tolist() == [0, 0, 0, 0]
+
+
+def test_cache_reuses_timelines():
+    cache = ET.TimelineCache(size=1)
+    first = cache.timeline([[0, 0], [1, 1]], 2, ET.XY, count=2, spread=1.0)
+    assert first[1] == first[0][2:] + first[0][:2]  # The second light is half a cycle on
+    assert cache.timeline([[0, 0], [1, 1]], 2, ET.XY, count=2, spread=1.0) is first
+    cache.timeline([[0, 0], [1, 1]], 3, ET.XY)
+    assert cache.stats() == {"timelines": 1, "hits": 1, "misses": 2}
@@ -0,0 +1,40 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import lifxlan as lx
+
+
+class RecordingSocket:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append(data)
+        return self.sock.sendto(data, address)
+
+
+def test_rapid_packets_sent_at_once_take_different_sequence_numbers(simulated_lifx):
+    lifx, lights, api = simulated_lifx(4, rapid=True)
+    obj = lights.light_objects[0]
+    obj.sock = RecordingSocket(obj.sock)
+    with ThreadPoolExecutor(8) as pool:  # As the LightAPI pool and the effect senders would
+        list(pool.map(lambda i: obj.send_packet(obj.LIGHT_NAMES[i % 4], "set_power", 65535, 0), range(256)))
+    assert len({lx.unpack_lifx_message(data).seq_num for data in obj.sock.sent}) == 256
+
+
+def test_state_a_lost_rapid_packet_left_out_is_sent_again(simulated_lifx):
+    lifx, lights, api = simulated_lifx(rapid=True)
+    obj = lights.light_objects[0]
+    obj.process_command("turn on lights")
+    obj.process_command("change color to red")
+    deadline = time.time() + 2
+    while time.time() < deadline and any(bulb["color"] != obj.LX_COLORS["red"] for bulb in lifx.bulbs.values()):
+        time.sleep(0.01)
+    lost = list(lifx.bulbs)[1]
+    lifx.bulbs[lost]["color"] = list(obj.LX_COLORS["blue"])  # As if the red packet never reached it
+    obj.transitions.clear()
+    obj.confirm_state()
+    assert lifx.bulbs[lost]["color"] == list(obj.LX_COLORS["red"])
+    assert lifx.bulbs[list(lifx.bulbs)[0]]["color"] == list(obj.LX_COLORS["red"])
@@ -0,0 +1,32 @@
+import time
+
+import VocaLights as V
+import Simulators as S
+
+
+def test_room_lights_are_found_whatever_their_case(simulated_lifx):
+    lifx, lights, api = simulated_lifx(3, names=["Kitchen Lamp", "Counter", "Desk Lamp"])
+    lights.configure_room("Kitchen", ["kitchen lamp", "COUNTER"])
+    api = V.Lights.LightAPI(lights.light_objects, rooms=lights.rooms)
+    assert api.rooms == {"kitchen": ["Kitchen Lamp", "Counter"]}
+    assert api.run_commands("turn on", room="kitchen") == [
+        {"SUCCESS": {"turn on": ["Kitchen Lamp", "Counter"]}, "Class": "lifx"}]
+    assert api.run_commands("turn off kitchen lamp") == [
+        {"SUCCESS": {"turn off": ["Kitchen Lamp"]}, "Class": "lifx"}]
+
+
+def test_brands_answered_concurrently_keep_the_order_of_the_light_objects():
+    simulators = [S.LifxSimulator(1, 0.4, 0), S.LifxSimulator(1, 0, 0), S.LifxSimulator(1, 0.4, 0)]
+    try:
+        lights = V.Lights()
+        for i, simulator in enumerate(simulators):
+            lights.configure_lights("lifx", startup="parallel", **simulator.settings(["bulb %d" % (i + 1)]))
+        api = V.Lights.LightAPI(lights.light_objects, max_workers=3)
+        start = time.perf_counter()
+        response = api.run_commands("turn on lights")
+        elapsed = time.perf_counter() - start
+        assert response == [{"SUCCESS": {"turn on": ["bulb %d" % (i + 1)]}, "Class": "lifx"} for i in range(3)]
+        assert elapsed < 0.7  # The two slow bulbs were waited on at once, not one after the other
+    finally:
+        for simulator in simulators:
+            simulator.stop()
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import Metrics as M
+
+
+def test_histogram_quantiles_are_bucket_bounds():
+    histogram = M.Histogram()
+    for ms in (1, 3, 3, 40, 900):
+        histogram.observe(ms / 1000)
+    assert histogram.count == 5
+    assert histogram.quantile(0.5) == 5  # 3 ms falls in the 5 ms bucket
+    assert histogram.quantile(1.0) == 900  # Capped at the slowest seen
+    assert histogram.snapshot()["mean_ms"] == pytest.approx(189.4)
+    assert M.Histogram().quantile(0.5) == 0.0
+
+
+def test_trace_records_its_stages():
+    metrics = M.Metrics()
+    trace = metrics.trace(room="kitchen")
+    trace.add("asr", 0.01)
+    with trace.span("dispatch"):
+        pass
+    trace.finish("turn on kitchen")
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"]["traces"] == 1
+    assert snapshot["stages"]["asr"]["count"] == 1
+    assert snapshot["stages"]["dispatch"]["count"] == 1
+    assert snapshot["stages"]["total"]["count"] == 1
+    assert snapshot["recent"][0]["words"] == "turn on kitchen"
+    assert snapshot["recent"][0]["room"] == "kitchen"
+
+
+def test_timed_counts_device_errors():
+    metrics = M.Metrics()
+    assert metrics.timed("bridge", sum, [1, 2]) == 3
+
+    def unreachable():
+        raise Exception("timed out")
+
+    with pytest.raises(Exception):
+        metrics.timed("bridge", unreachable)
+    device = metrics.snapshot()["devices"]["bridge"]
+    assert device["requests"] == 2 and device["errors"] == 1
+    assert device["last_error"] == "timed out"
+
+
+def test_simulated_lights_report_their_replies(simulated_lifx):
+    lifx, lights, api = simulated_lifx()
+    api.run_commands("turn on bulb 1")
+    devices = lights.metrics.snapshot()["devices"]
+    assert devices["bulb 1"]["requests"] >= 1 and devices["bulb 1"]["errors"] == 0
+
+
+def test_prometheus_and_json_output(tmp_path):
+    metrics = M.Metrics()
+    metrics.observe("match", 0.002)
+    metrics.count("voice_commands")
+    text = metrics.prometheus()
+    assert 'vocalights_stage_latency_ms_bucket{stage="match",le="2"} 1' in text
+    assert 'vocalights_stage_latency_ms_count{stage="match"} 1' in text
+    assert "vocalights_voice_commands_total 1" in text
+    path = str(tmp_path / "metrics.json")
+    metrics.write(path)
+    with open(path) as file:
+        assert json.load(file)["counters"]["voice_commands"] == 1
@@ -0,0 +1,66 @@
+import time
+
+import numpy as np
+import pytest
+
+import Benchmarks as B
+import MusicMode as MM
+import VocaLights as V
+import Simulators as S
+
+
+def test_audio_ring_wraps_around():
+    ring = MM.AudioRing(8)
+    ring.write(np.arange(6, dtype=np.float32))
+    assert list(ring.latest(4)) == [2, 3, 4, 5]
+    ring.write(np.arange(6, 10, dtype=np.float32))  # Wraps
+    assert list(ring.latest(8)) == [2, 3, 4, 5, 6, 7, 8, 9]
+    ring.write(np.arange(20, dtype=np.float32))  # Longer than the ring, only the end is kept
+    assert list(ring.latest(3)) == [17, 18, 19]
+    assert ring.written == 18
+
+
+def test_hue_xy():
+    assert MM.hue_xy(0) == pytest.approx([0.70, 0.30], abs=0.01)  # Red, at the edge of the wide gamut
+    assert MM.hue_xy(1) == MM.hue_xy(0)
+    assert MM.hue_xy(1 / 3)[1] > 0.6  # Green
+
+
+def test_analyzer_finds_the_beats():
+    data, expected = B._synthesize_music(10, 16000)
+    samples = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768
+    ring = MM.AudioRing(4096)
+    analyzer = MM.MusicAnalyzer(16000)
+    beats = 0
+    for offset in range(0, len(samples) - 1024 + 1, 1024):
+        ring.write(samples[offset:offset + 1024])
+        hue, brightness, beat = analyzer.analyze(ring.latest(1024), 1024)
+        assert 0 <= hue <= 1 and 0 <= brightness <= 1
+        beats += beat
+    assert expected * 0.8 <= beats <= expected
+
+
+def test_music_mode_drives_the_simulated_lights():
+    lifx = S.LifxSimulator(2, 0, 0)
+    hue = S.HueSimulator(2, 0, 0)
+    try:
+        lights = V.Lights()
+        lights.configure_lights("lifx", startup="parallel", **lifx.settings())
+        with S.isolated_phue_config():
+            lights.configure_lights("phue", startup="parallel", **hue.settings())
+        music = MM.MusicMode(lights.metrics)
+        api = V.Lights.LightAPI(lights.light_objects, music=music)
+        api.run_commands("turn on lights")
+        assert all(response.get("SUCCESS") for response in api.run_commands("music on"))
+        writes = lifx.writes + hue.writes
+        data, expected = B._synthesize_music(1, 16000)
+        for offset in range(0, len(data), 2048):  # Chunks of 1024 samples as the microphone reads them
+            music.feed("kitchen", data[offset:offset + 2048], 16000, 2)
+            time.sleep(0.064)
+        assert lifx.writes + hue.writes > writes
+        assert music.stats()["frames"] > 0 and music.stats()["sent"] > 0
+        api.run_commands("music off")
+        assert music.stats()["playing"] == []
+    finally:
+        lifx.stop()
+        hue.stop()
@@ -0,0 +1,40 @@
+import socket
+import time
+
+import VocaLights as V
+import Simulators as S
+
+
+def test_a_stale_pooled_connection_is_retried_on_a_fresh_one():
+    hue = S.HueSimulator(2, 0, 0)
+    try:
+        with S.isolated_phue_config():
+            bridge = V.PooledBridge("%s:%d" % hue.address, S.HueSimulator.USERNAME)
+        assert bridge.get_light(1)["name"] == hue.lights["1"]["name"]
+        assert bridge.connections.qsize() == 1
+        bridge.connections.queue[-1].sock.shutdown(socket.SHUT_RDWR)  # As if the bridge dropped it while idle
+        assert bridge.set_light(1, "on", True) == [[{"success": {"/lights/1/state/on": True}}]]
+        assert hue.lights["1"]["state"]["on"] is True
+        assert bridge.connections.qsize() == 1  # The stale connection was replaced, not kept
+    finally:
+        hue.stop()
+
+
+def test_group_actions_fall_back_to_each_light_once_the_group_rate_is_used_up():
+    hue = S.HueSimulator(3, 0, 0)
+    try:
+        lights = V.Lights()
+        with S.isolated_phue_config():
+            lights.configure_lights("phue", startup="parallel", **hue.settings())
+        obj = lights.light_objects[0]
+        sent = []
+        send_group, send_light = obj.send_group, obj.send_light
+        obj.send_group = lambda ids, *args: sent.append("group") or send_group(ids, *args)
+        obj.send_light = lambda lid, *args: sent.append(lid) or send_light(lid, *args)
+        time.sleep(1 / V.HUE_GROUP_RATE)  # Startup may have taken the group action
+        obj.process_command("turn on lights")
+        assert obj.process_command("change color to red") == {"SUCCESS": {"change color": [1, 2, 3]}, "Class": "phue"}
+        assert sent[0] == "group" and sorted(sent[1:]) == [1, 2, 3]
+        assert all(light["state"]["on"] and light["state"]["xy"] == [1, 0] for light in hue.lights.values())
+    finally:
+        hue.stop()
@@ -0,0 +1,71 @@
+import threading
+import time
+
+import RateLimiter as RL
+import EffectScheduler as ES
+
+
+def test_bucket_allows_a_burst_then_waits():
+    bucket = RL.TokenBucket(10, burst=3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    assert 0 < bucket.wait_time() <= 0.1
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = RL.TokenBucket(50, burst=1)
+    assert bucket.take() and not bucket.take()
+    time.sleep(0.03)
+    assert bucket.take()
+
+
+def test_limiter_sends_straight_away_with_a_token():
+    limiter = RL.CoalescingLimiter(10, ES.EffectScheduler(), burst=1)
+    assert limiter.submit("light", lambda: "sent") == "sent"
+    assert limiter.stats()["sent"] == 1
+
+
+def test_limiter_keeps_only_the_latest_queued_write_per_key():
+    sent = []
+    done = threading.Event()
+    limiter = RL.CoalescingLimiter(20, ES.EffectScheduler(), burst=1)
+    limiter.submit(("1", "color"), lambda: sent.append("first"))
+    for value in ("red", "green", "blue"):
+        assert limiter.submit(("1", "color"), lambda value=value: sent.append(value)) is None
+    limiter.submit(("1", "power"), lambda: (sent.append("on"), done.set()))
+    assert done.wait(2)
+    assert sent == ["first", "blue", "on"]
+    stats = limiter.stats()
+    assert (stats["dropped"], stats["queued"], stats["max_depth"], stats["depth"]) == (2, 4, 2, 0)
+
+
+def test_queued_writes_run_off_the_scheduler_thread():
+    threads = []
+    done = threading.Event()
+    limiter = RL.CoalescingLimiter(20, ES.EffectScheduler(), burst=1)
+    limiter.submit("a", lambda: None)
+    limiter.submit("b", lambda: (threads.append(threading.current_thread().name), done.set()))
+    assert done.wait(2)
+    assert threads[0].startswith("RateLimiter")
+
+
+def test_failed_queued_write_does_not_stop_the_queue():
+    done = threading.Event()
+    limiter = RL.CoalescingLimiter(20, ES.EffectScheduler(), burst=1)
+    limiter.submit("a", lambda: None)
+    limiter.submit("b", lambda: 1 / 0)
+    limiter.submit("c", done.set)
+    assert done.wait(2)
+
+
+def test_a_newer_write_lands_after_the_one_being_sent():
+    landed = []
+    done = threading.Event()
+    limiter = RL.CoalescingLimiter(50, ES.EffectScheduler(), burst=1)
+    limiter.submit("color", lambda: landed.append("first"))
+    # Queued for lack of a token, then sent slowly by the limiter's thread
+    limiter.submit("color", lambda: (time.sleep(0.2), landed.append("slow")))
+    time.sleep(0.1)  # Being sent, and there is a token again
+    assert limiter.submit("color", lambda: (landed.append("latest"), done.set())) is None
+    assert done.wait(2)
+    assert landed == ["first", "slow", "latest"]
+    assert limiter.stats()["sending"] == 0
@@ -0,0 +1,19 @@
+import pytest
+
+import VoiceCommands as VC
+
+
+def test_numbers_round_trip_through_words():
+    for number in (0, 7, 13, 20, 45, 100):
+        assert VC.words_to_numbers(VC.number_to_words(number)) == str(number)
+    assert VC.words_to_numbers("dim lamp two to twenty five percent", keep={"two"}) == "dim lamp two to 25 percent"
+
+
+def test_backends_must_recognize():
+    class Echo(VC.RecognizerBackend):
+        def recognize(self, recognizer, audio):
+            return audio
+
+    assert Echo().recognize(None, "turn on") == "turn on"
+    with pytest.raises(TypeError):
+        VC.RecognizerBackend()
@@ -0,0 +1,87 @@
+import time
+
+import CommandMatcher as CM
+import Scenes as SC
+import VocaLights as V
+import Simulators as S
+
+
+def name_of(words):
+    return SC.scene_name(CM.CommandMatcher(SC.SCENE_COMMANDS).match(words))
+
+
+def test_scene_name_drops_filler_words():
+    assert name_of("save scene as movie night for the lights") == "movie night"
+    assert name_of("restore scene called reading") == "reading"
+    assert name_of("save scene") == ""
+
+
+def test_store_keeps_scenes_between_runs(tmp_path):
+    path = str(tmp_path / "scenes.json")
+    store = SC.SceneStore(path)
+    store.save("movie", {"lifx": {"lights": {"bulb 1": {"power": 0}}}})
+    store.save("party", {})
+    store.delete("party")
+    assert SC.SceneStore(path).names() == ["movie"]
+    assert SC.SceneStore(path).get("movie") == {"lifx": {"lights": {"bulb 1": {"power": 0}}}}
+
+
+def test_unreadable_store_starts_empty(tmp_path):
+    path = tmp_path / "scenes.json"
+    path.write_text("{not json")
+    assert SC.SceneStore(str(path)).names() == []
+
+
+def test_save_and_restore_against_simulated_bulbs(simulated_lifx):
+    lifx, lights, api = simulated_lifx()
+    api.run_commands("turn on lights")
+    api.run_commands("change color to red")
+    assert api.run_commands("save scene as movie") == [
+        {"SUCCESS": {"save scene": ["bulb 1", "bulb 2"]}, "Class": "lifx"}]
+    api.run_commands("change color to blue")
+    assert api.run_commands("restore scene movie") == [
+        {"SUCCESS": {"restore scene": ["bulb 1", "bulb 2"]}, "Class": "lifx"}]
+    time.sleep(0.1)
+    obj = lights.light_objects[0]
+    saved = lights.scenes.get("movie")[obj.scene_key]["lights"]["bulb 1"]
+    assert list(obj.lights["bulb 1"].get_color()) == saved["color"]
+
+
+def test_each_lifx_object_keeps_its_own_bulbs_in_a_scene(tmp_path):
+    lifx = S.LifxSimulator(4, 0, 0)
+    try:
+        lights = V.Lights(scene_file=str(tmp_path / "scenes.json"))
+        settings = lifx.settings()
+        for half in (slice(0, 2), slice(2, 4)):  # Two configure_lights calls, each with two of the bulbs
+            half_settings = {key: values[half] for key, values in settings.items()}
+            lights.configure_lights("lifx", startup="parallel", **half_settings)
+        api = V.Lights.LightAPI(lights.light_objects, scenes=lights.scenes)
+        api.run_commands("turn on lights")
+        api.run_commands("change color to red")
+        api.run_commands("save scene movie")
+        assert len(lights.scenes.get("movie")) == 2
+        api.run_commands("change color to blue")
+        assert api.run_commands("restore scene movie") == [
+            {"SUCCESS": {"restore scene": ["bulb 1", "bulb 2"]}, "Class": "lifx"},
+            {"SUCCESS": {"restore scene": ["bulb 3", "bulb 4"]}, "Class": "lifx"}]
+    finally:
+        lifx.stop()
+
+
+def test_hue_scene_is_saved_when_the_old_copy_cannot_be_deleted(tmp_path):
+    hue = S.HueSimulator(2, 0, 0)
+    try:
+        lights = V.Lights(scene_file=str(tmp_path / "scenes.json"))
+        with S.isolated_phue_config():
+            lights.configure_lights("phue", startup="parallel", **hue.settings())
+        api = V.Lights.LightAPI(lights.light_objects, scenes=lights.scenes)
+        api.run_commands("save scene movie")
+
+        def unreachable(scene_id):
+            raise Exception("timed out")
+
+        lights.light_objects[0].bridge.delete_scene = unreachable
+        assert api.run_commands("save scene movie") == [{"SUCCESS": {"save scene": [1, 2]}, "Class": "phue"}]
+        assert len(hue.scenes) == 2  # The old copy is left behind
+    finally:
+        hue.stop()
@@ -0,0 +1,62 @@
+import os
+import signal
+import time
+
+import pytest
+
+import Sharding as SH
+import VocaLights as V
+import Simulators as S
+
+
+def test_shard_key():
+    assert SH.shard_key("lifx", "192.168.1.20") == "lifx 192.168.1.0/24"
+    assert SH.shard_key("lifx", "192.168.1.200:56701") == SH.shard_key("lifx", "192.168.1.20")
+    assert SH.shard_key("lifx", "192.168.2.20") != SH.shard_key("lifx", "192.168.1.20")
+    assert SH.shard_key("phue", "192.168.1.2") == "phue 192.168.1.2"
+
+
+def test_shard_answers_and_reports_errors():
+    shard = SH.Shard("test", timeout=10)
+    try:
+        assert shard.call("ping") is True
+        with pytest.raises(Exception):
+            shard.call("process_command", 0, "turn on lights", None)  # No lights were configured
+    finally:
+        shard.stop()
+    with pytest.raises(Exception):
+        shard.call("ping")
+
+
+def test_stopped_shard_times_out_and_is_revived():
+    shard = SH.Shard("test", timeout=0.5)
+    try:
+        shard.call("ping", timeout=10)
+        os.kill(shard.process.pid, signal.SIGSTOP)
+        start = time.monotonic()
+        with pytest.raises(Exception, match="did not answer"):
+            shard.call("ping")
+        assert time.monotonic() - start < 2
+        os.kill(shard.process.pid, signal.SIGKILL)
+        shard.process.join(5)
+        shard.timeout = 10
+        shard.revive()
+        assert shard.process.is_alive()
+    finally:
+        shard.stop()
+
+
+def test_sharded_lights_take_commands():
+    lifx = S.LifxSimulator(2, 0, 0)
+    lights = V.Lights()
+    try:
+        lights.configure_lights("lifx", startup="parallel", shard=True, **lifx.settings())
+        assert list(lights.shards) == ["lifx 127.0.0.0/24"]
+        api = V.Lights.LightAPI(lights.light_objects)
+        assert api.run_commands("turn on bulb 1") == [{"SUCCESS": {"turn on": ["bulb 1"]}, "Class": "lifx"}]
+        assert lifx.bulbs[list(lifx.bulbs)[0]]["power"]
+        assert lights.shard_stats()["lifx 127.0.0.0/24"]["pid"] != os.getpid()
+    finally:
+        for shard in lights.shards.values():
+            shard.stop()
+        lifx.stop()
@@ -0,0 +1,36 @@
+import time
+
+import VocaLights as V
+import Simulators as S
+
+
+def test_parallel_startup_is_not_held_up_by_an_unplugged_bulb():
+    lifx = S.LifxSimulator(4, 0.2, 0)
+    lifx.unplugged.add(list(lifx.bulbs)[0])
+    try:
+        lights = V.Lights()
+        start = time.time()
+        lights.configure_lights("lifx", startup="parallel", timeout=0.5, **lifx.settings())
+        elapsed = time.time() - start
+        obj = lights.light_objects[0]
+        assert obj.ready == {"bulb 2", "bulb 3", "bulb 4"}
+        assert set(obj.init_times) == {"bulb 1", "bulb 2", "bulb 3", "bulb 4"}
+        assert list(obj.init_errors) == ["bulb 1"]
+        assert all(obj.init_times[name] < 0.4 for name in obj.ready)  # Connected while bulb 1 was waited on
+        assert elapsed < obj.init_times["bulb 1"] + 0.3  # Serially the other three would add 0.6 s
+    finally:
+        lifx.stop()
+
+
+def test_lazy_startup_connects_the_bulbs_a_command_is_sent_to(simulated_lifx):
+    lifx, lights, api = simulated_lifx(3, startup="lazy", timeout=0.2)
+    lifx.unplugged.add(list(lifx.bulbs)[0])
+    obj = lights.light_objects[0]
+    assert obj.ready == set() and obj.init_times == {}
+    response = obj.process_command("turn on lights")
+    assert response == [{"SUCCESS": {"turn on": ["bulb 2", "bulb 3"]}, "Class": "lifx"},
+                        {"ERROR": "bulb 1: not answering", "Light": "bulb 1", "Class": "lifx"}]
+    assert obj.ready == {"bulb 2", "bulb 3"}
+    assert set(obj.init_times) == {"bulb 1", "bulb 2", "bulb 3"}
+    assert list(obj.init_errors) == ["bulb 1"]
+    assert all(bulb["power"] == 65535 for mac, bulb in lifx.bulbs.items() if mac not in lifx.unplugged)
@@ -0,0 +1,194 @@
+import threading
+import time
+import types
+
+import pytest
+import speech_recognition as sr
+
+import VoiceCommands as VC
+import VocaLights as V
+
+
+class FakeEngine:
+
+    # Stands in for the sapi5 pyttsx3 engine, each message is spoken until release is set
+    def __init__(self):
+        self.said = []
+        self.stopped = 0
+        self.release = threading.Event()
+
+    def getProperty(self, name):
+        return [types.SimpleNamespace(id="voice")]
+
+    def setProperty(self, name, value):
+        pass
+
+    def connect(self, topic, callback):
+        self.started_word = callback
+
+    def say(self, text):
+        self.said.append(text)
+
+    def runAndWait(self):
+        self.release.wait(2)
+        self.started_word("started-word", 0, 0)
+
+    def stop(self):
+        self.stopped += 1
+
+
+@pytest.fixture
+def outputs(monkeypatch):
+    engine = FakeEngine()
+    monkeypatch.setattr(VC.pyttsx3, "init", lambda driver: engine)
+    outputs = VC.CommandOutputs()
+    yield outputs, engine
+    engine.release.set()
+
+
+def phrase(words, seconds=0.2):
+    audio = sr.AudioData(bytes(int(seconds * 16000) * 2), 16000, 2)
+    audio.words = words  # What WordsBackend recognizes it as
+    return audio
+
+
+class WordsBackend(VC.RecognizerBackend):
+
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+
+    def recognize(self, recognizer, audio):
+        time.sleep(self.delays.get(audio.words, 0))
+        return audio.words
+
+
+class FakeMicrophone:
+
+    SAMPLE_RATE = 16000
+    SAMPLE_WIDTH = 2
+
+    def __init__(self, device_index=None):
+        self.stream = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def microphone(monkeypatch):
+    # Phrases appended to the list are heard in order, one at a time, by any microphone
+    heard = []
+    lock = threading.Lock()
+
+    def listen(recognizer, source, timeout=None):
+        with lock:
+            if heard:
+                return heard.pop(0)
+        time.sleep(0.05)
+        raise sr.WaitTimeoutError()
+
+    monkeypatch.setattr(VC.sr, "Microphone", FakeMicrophone)
+    monkeypatch.setattr(VC.sr.Recognizer, "listen", listen)
+    return heard
+
+
+def test_recent_phrases_drop_a_second_microphone_within_the_window():
+    recent = VC.RecentPhrases(1.0)
+    assert not recent.repeated("Turn on  lights", "kitchen", 10.0)
+    assert recent.repeated("turn on lights", "office", 10.5)
+    assert not recent.repeated("turn on lights", "office", 12.0)  # Said again later
+
+
+def test_recent_phrases_keep_repeats_from_the_same_microphone():
+    recent = VC.RecentPhrases(1.0)
+    assert not recent.repeated("dim lights", "kitchen", 10.0)
+    assert not recent.repeated("dim lights", "kitchen", 10.2)
+
+
+def test_recent_phrases_compare_by_key():
+    recent = VC.RecentPhrases(1.0, V.Lights.LightAPI([]).phrase_key)
+    assert not recent.repeated("turn on the lights", "kitchen", 10.0)
+    assert recent.repeated("turn on light", "office", 10.3)
+    assert not recent.repeated("turn off light", "office", 10.4)
+
+
+def wait_until(condition, timeout=2):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_replies_heard_by_the_microphone_are_dropped(outputs, microphone):
+    outputs, engine = outputs
+    outputs.speak("turning on kitchen lamp")
+    assert wait_until(lambda: engine.said)
+    inputs = VC.CommandInputs(backend=WordsBackend())
+    inputs.speech = outputs
+    microphone += [phrase("on kitchen lamp"), phrase("turn off lights")]  # The end of the reply, then a command
+    stream = inputs.stream_voice_input()
+    assert next(stream) == "turn off lights"
+    stream.close()
+    assert inputs.metrics.snapshot()["counters"]["own_speech"] == 1
+
+
+def test_a_command_spoken_over_a_reply_cuts_it_off(outputs, microphone):
+    outputs, engine = outputs
+    outputs.speak("turning on kitchen lamp")
+    outputs.speak("turning on desk lamp")
+    assert wait_until(lambda: engine.said)
+    inputs = VC.CommandInputs(backend=WordsBackend())
+    inputs.speech = outputs
+    microphone.append(phrase("turn off kitchen lamp"))
+    stream = inputs.stream_voice_input()
+    assert next(stream) == "turn off kitchen lamp"
+    stream.close()
+    engine.release.set()
+    assert wait_until(lambda: engine.stopped == 1)
+    time.sleep(0.05)
+    assert engine.said == ["turning on kitchen lamp"]  # The reply waiting was dropped as well
+
+
+def test_replies_are_matched_on_their_words(outputs):
+    spoken, engine = outputs
+    spoken.spoken.append([10.0, 12.0, "Turning on kitchen lamp"])
+    assert spoken.heard_itself("kitchen lamp", 11.0, 12.2)
+    assert spoken.heard_itself("turning on kitchen lamp", 11.8, 12.2)  # Within the echo
+    assert not spoken.heard_itself("turn on kitchen lamp", 11.0, 12.2)
+    assert not spoken.heard_itself("kitchen lamp", 13.0, 14.0)  # Heard after the reply was over
+
+
+def test_phrases_are_yielded_in_the_order_they_were_said(microphone):
+    inputs = VC.CommandInputs(workers=3, backend=WordsBackend({"turn on lights": 0.3, "dim lights": 0.15}))
+    microphone += [phrase("turn on lights"), phrase("dim lights"), phrase("change color to red")]
+    stream = inputs.stream_voice_input()
+    assert [next(stream) for _ in range(3)] == ["turn on lights", "dim lights", "change color to red"]
+    stream.close()
+
+
+def test_a_microphone_that_fails_is_raised(monkeypatch):
+    class BrokenMicrophone(FakeMicrophone):
+        def __enter__(self):
+            raise OSError("No Default Input Device Available")
+
+    monkeypatch.setattr(VC.sr, "Microphone", BrokenMicrophone)
+    stream = VC.CommandInputs(backend=WordsBackend()).stream_voice_input()
+    with pytest.raises(OSError, match="No Default Input Device"):
+        next(stream)
+
+
+def test_an_interrupting_reply_drops_the_ones_waiting(outputs):
+    outputs, engine = outputs
+    outputs.speak("turning on kitchen lamp")
+    assert wait_until(lambda: engine.said)
+    outputs.speak("turning on desk lamp")
+    outputs.speak("turning on hallway")
+    outputs.speak("lights are off", interrupt=True)
+    engine.release.set()
+    assert wait_until(lambda: len(engine.said) == 2)
+    time.sleep(0.05)
+    assert engine.said == ["turning on kitchen lamp", "lights are off"]
+    assert engine.stopped == 1  # The reply being spoken was cut off
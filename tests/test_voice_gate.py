@@ -0,0 +1,69 @@
+import numpy as np
+import speech_recognition as sr
+
+import VoiceGate as VG
+
+RNG = np.random.default_rng(0)
+
+
+def audio(samples):
+    return sr.AudioData(np.clip(samples, -32767, 32767).astype(np.int16).tobytes(), VG.SAMPLE_RATE, 2)
+
+
+def silence(seconds, level=30):
+    return RNG.normal(0, level, int(seconds * VG.SAMPLE_RATE))
+
+
+def voiced(seconds, pitch=150):
+    # Harmonics of the pitch up to 3 kHz, the peaky spectrum of a vowel
+    t = np.arange(int(seconds * VG.SAMPLE_RATE)) / VG.SAMPLE_RATE
+    return sum(3000 / k * np.sin(2 * np.pi * pitch * k * t) for k in range(2, 3000 // pitch))
+
+
+def test_frame_features_shapes():
+    energy, flatness, ratio, bands = VG.frame_features(voiced(1.0))
+    frames = 1 + (VG.SAMPLE_RATE - VG.FRAME) // VG.HOP
+    assert energy.shape == flatness.shape == ratio.shape == (frames,)
+    assert bands.shape == (frames, len(VG.BANDS) - 1)
+    assert ratio.mean() > 0.6 and flatness.mean() < 0.1
+    energy, flatness, ratio, bands = VG.frame_features(RNG.normal(0, 3000, VG.SAMPLE_RATE))
+    assert flatness.mean() > 0.5
+    assert len(VG.frame_features(np.zeros(10))[0]) == 1  # Padded to one frame
+
+
+def test_longest_run():
+    assert VG.longest_run(np.array([False, False])) == 0
+    assert VG.longest_run(np.array([True, False, True, True, True, False, True, True])) == 3
+    assert VG.longest_run(np.array([True] * 4)) == 4
+
+
+def test_dtw_distance_allows_a_free_end():
+    template = RNG.normal(size=(10, 4))
+    stretched = np.repeat(template, 2, axis=0)
+    assert VG.dtw_distance(template, np.vstack([template, RNG.normal(size=(5, 4))])) < 1e-9
+    assert VG.dtw_distance(template, stretched) < VG.dtw_distance(template, RNG.normal(size=(20, 4)))
+
+
+def test_gate_passes_speech_and_rejects_quiet_and_noise():
+    gate = VG.SpeechGate()
+    assert gate.check(audio(np.concatenate([silence(0.3), voiced(0.8), silence(0.3)]))) == (True, None)
+    assert gate.check(audio(silence(1.0))) == (False, "quiet")
+    assert gate.check(audio(np.concatenate([silence(0.3), RNG.normal(0, 3000, 8000), silence(0.3)]))) == \
+        (False, "noise")
+    assert gate.check(audio(np.concatenate([silence(0.3), voiced(0.05), silence(0.3)]))) == (False, "short")
+    assert gate.check(audio(np.concatenate([silence(0.3), voiced(7.0), silence(0.3)]))) == (False, "long")
+    stats = gate.stats()
+    assert stats["passed"] == 1 and stats["total_rejected"] == 4
+    assert stats["rejected"] == {"quiet": 1, "noise": 1, "short": 1, "long": 1}
+
+
+def test_wake_phrase(tmp_path):
+    gate = VG.SpeechGate(wake_phrase="Hey lights", templates_file=str(tmp_path / "wake.npz"))
+    gate.enroll(audio(np.concatenate([silence(0.2), voiced(0.5, 120), silence(0.2)])))
+    assert (tmp_path / "wake.npz").exists()
+    assert gate.check(audio(np.concatenate([silence(0.3), voiced(0.5, 120), voiced(0.5, 200), silence(0.3)])))[0]
+    assert gate.check(audio(np.concatenate([silence(0.3), RNG.normal(0, 300, 4000) + voiced(0.25, 600),
+                                            voiced(0.5, 200), silence(0.3)]))) == (False, "wake")
+    assert VG.SpeechGate(wake_phrase="hey lights", templates_file=str(tmp_path / "wake.npz")).templates
+    assert gate.strip_wake_phrase("hey lights turn on kitchen") == "turn on kitchen"
+    assert gate.strip_wake_phrase("turn on kitchen") == "turn on kitchen"